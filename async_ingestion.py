@@ -0,0 +1,437 @@
+import time
+import asyncio
+import threading
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.indexing import aindex
+from langchain_core.indexing.base import RecordManager
+from langchain_core.vectorstores import VectorStore
+from metrics import pipeline_metrics
+
+# Pipelined ingestion on top of langchain's `aindex`. aindex awaits
+# `aadd_documents` of a batch before it reads the next one, so the write
+# path is split there: the wrapper below embeds the batch, hands the upsert
+# to a background task and returns, and aindex moves on to embedding the
+# next batch while the previous upserts are in flight. At most
+# max_concurrent_upserts upserts are pending at a time, the next batch waits
+# for a free slot. aindex records the keys of a batch right after
+# aadd_documents returns, so the keys of a batch whose upsert failed are
+# removed from the record manager by flush(), and the next run indexes them
+# again. aindex would clean up a source right after its batch, before the
+# upsert completed, so aindex runs without cleanup and the cleanup is done
+# here once every upsert completed, only for the sources whose upserts all
+# succeeded: a source with a failed upsert keeps its previous points.
+
+
+def _is_local_qdrant_client(client):
+    from qdrant_client.local.qdrant_local import QdrantLocal
+    from qdrant_client.local.async_qdrant_local import AsyncQdrantLocal
+
+    return isinstance(getattr(client, "_client", None),
+                      (QdrantLocal, AsyncQdrantLocal))
+
+
+class _QdrantWriter:
+    # upserts precomputed embeddings with the async client when the store
+    # has a remote one, with the sync client in threads otherwise;
+    # upload_parallel > 1 uses the client's multi process upload_points
+    def __init__(self, vectorstore, upload_parallel: int = 1,
+                 upload_batch_size: int = 64):
+        self.vectorstore = vectorstore
+        self.upload_parallel = upload_parallel
+        self.upload_batch_size = upload_batch_size
+        async_client = vectorstore.async_client
+        self.async_client = None if async_client is None \
+            or _is_local_qdrant_client(async_client) else async_client
+        # the local (in process) client is not thread safe
+        self._local_lock = threading.Lock() \
+            if _is_local_qdrant_client(vectorstore.client) else None
+
+    def _build_points(self, texts, embeddings, metadatas, ids):
+        from qdrant_client.http import models
+
+        vectorstore = self.vectorstore
+        payloads = vectorstore._build_payloads(
+            texts, metadatas, vectorstore.content_payload_key,
+            vectorstore.metadata_payload_key)
+        return [
+            models.PointStruct(
+                id=point_id,
+                vector={vectorstore.vector_name: embedding}
+                if vectorstore.vector_name else embedding,
+                payload=payload,
+            )
+            for point_id, embedding, payload in zip(ids, embeddings, payloads)
+        ]
+
+    def _run_sync(self, function, *args, **kwargs):
+        if self._local_lock is None:
+            return function(*args, **kwargs)
+        with self._local_lock:
+            return function(*args, **kwargs)
+
+    def _upsert_sync(self, points):
+        client = self.vectorstore.client
+        collection_name = self.vectorstore.collection_name
+        if self.upload_parallel > 1 and self._local_lock is None:
+            client.upload_points(collection_name, points,
+                                 batch_size=self.upload_batch_size,
+                                 parallel=self.upload_parallel, wait=True)
+        else:
+            self._run_sync(client.upsert, collection_name=collection_name,
+                           points=points, wait=True)
+
+    async def upsert(self, texts, embeddings, metadatas, ids):
+        points = self._build_points(texts, embeddings, metadatas, ids)
+        if self.async_client is not None:
+            if self.upload_parallel > 1:
+                await self.async_client.upload_points(
+                    self.vectorstore.collection_name, points,
+                    batch_size=self.upload_batch_size,
+                    parallel=self.upload_parallel, wait=True)
+            else:
+                await self.async_client.upsert(
+                    collection_name=self.vectorstore.collection_name,
+                    points=points, wait=True)
+        else:
+            await asyncio.to_thread(self._upsert_sync, points)
+
+    async def delete(self, ids):
+        if self.async_client is not None:
+            await self.async_client.delete(
+                collection_name=self.vectorstore.collection_name,
+                points_selector=ids, wait=True)
+            return True
+        return await asyncio.to_thread(self._run_sync,
+                                       self.vectorstore.delete, ids)
+
+
+class _PGVectorWriter:
+    # langchain_postgres' PGVector: add_embeddings is an INSERT ... ON
+    # CONFLICT DO UPDATE, the sqlalchemy engine can be used from threads
+    def __init__(self, vectorstore):
+        self.vectorstore = vectorstore
+
+    async def upsert(self, texts, embeddings, metadatas, ids):
+        if getattr(self.vectorstore, "async_mode", False):
+            await self.vectorstore.aadd_embeddings(
+                texts=texts, embeddings=embeddings, metadatas=metadatas,
+                ids=ids)
+        else:
+            await asyncio.to_thread(
+                self.vectorstore.add_embeddings, texts=texts,
+                embeddings=embeddings, metadatas=metadatas, ids=ids)
+
+    async def delete(self, ids):
+        if getattr(self.vectorstore, "async_mode", False):
+            return await self.vectorstore.adelete(ids)
+        return await asyncio.to_thread(self.vectorstore.delete, ids)
+
+
+def _get_store_writer(vectorstore, upload_parallel: int = 1,
+                      upload_batch_size: int = 64):
+    if hasattr(vectorstore, "_build_payloads") \
+            and hasattr(vectorstore, "collection_name"):
+        return _QdrantWriter(vectorstore, upload_parallel, upload_batch_size)
+    if hasattr(vectorstore, "add_embeddings"):
+        return _PGVectorWriter(vectorstore)
+    # other stores embed inside their own add method, only the whole write
+    # is moved to the background
+    return None
+
+
+class PipelinedVectorStoreWriter(VectorStore):
+    """
+    A write-only vector store wrapper for `aindex` that overlaps the upsert
+    of a batch with the embedding of the next ones. Call flush() once aindex
+    returned: it waits for the pending upserts and removes the record manager
+    keys of the failed ones.
+
+    Parameters
+    ==========
+    vectorstore: langchain vector store
+        The Qdrant or PGVector store written to
+    record_manager: langchain record manager
+        The record manager given to aindex, for the failed keys
+    max_concurrent_upserts: int
+        The number of upserts in flight at the same time
+    upload_parallel: int
+        Qdrant only, the number of upload processes of upload_points
+    """
+
+    def __init__(self, vectorstore, record_manager=None,
+                 max_concurrent_upserts: int = 4, upload_parallel: int = 1,
+                 upload_batch_size: int = 64, metrics=None,
+                 source_id_key: str = "source"):
+        self.vectorstore = vectorstore
+        self.source_id_key = source_id_key
+        self.record_manager = record_manager
+        self.max_concurrent_upserts = max(max_concurrent_upserts, 1)
+        self.metrics = metrics or pipeline_metrics
+        self.writer = _get_store_writer(vectorstore, upload_parallel,
+                                        upload_batch_size)
+        self.upserted = 0
+        self.failed_ids = []
+        self.failed_sources = set()
+        self.errors = []
+        self._semaphore = None
+        self._pending = set()
+
+    @property
+    def embeddings(self):
+        return self.vectorstore.embeddings
+
+    def __getattr__(self, name):
+        # collection_name, client ... of the wrapped store
+        if name == "vectorstore":
+            raise AttributeError(name)
+        return getattr(self.vectorstore, name)
+
+    async def _write(self, documents, texts, embeddings, metadatas, ids):
+        start_time = time.perf_counter()
+        try:
+            if self.writer is None:
+                await self.vectorstore.aadd_documents(documents, ids=ids)
+            else:
+                await self.writer.upsert(texts, embeddings, metadatas, ids)
+            self.upserted += len(ids)
+        except Exception as ex:
+            print(f"---> upsert of {len(ids)} documents failed: {ex}")
+            self.failed_ids.extend(ids)
+            self.failed_sources.update(metadata.get(self.source_id_key)
+                                       for metadata in metadatas)
+            self.errors.append(str(ex))
+        finally:
+            self.metrics.observe("vector_store_write",
+                                 time.perf_counter() - start_time)
+            self._semaphore.release()
+
+    async def aadd_documents(self, documents, ids=None, **kwargs):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent_upserts)
+        if ids is None:
+            raise ValueError("The pipelined writer needs the ids of aindex")
+        ids = list(ids)
+        texts = [document.page_content for document in documents]
+        metadatas = [document.metadata for document in documents]
+        embeddings = None
+        if self.writer is not None:
+            embeddings = await self.embeddings.aembed_documents(texts)
+        # back pressure, at most max_concurrent_upserts batches pending
+        await self._semaphore.acquire()
+        task = asyncio.create_task(
+            self._write(documents, texts, embeddings, metadatas, ids))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+        return ids
+
+    def add_texts(self, texts, metadatas=None, **kwargs) -> List[str]:
+        raise NotImplementedError(
+            "PipelinedVectorStoreWriter only supports aadd_documents")
+
+    async def adelete(self, ids=None, **kwargs):
+        # stale ids of earlier runs, never among the pending upserts
+        with self.metrics.time_stage("vector_store_write"):
+            if self.writer is None:
+                return await self.vectorstore.adelete(ids, **kwargs)
+            return await self.writer.delete(ids)
+
+    def delete(self, ids=None, **kwargs):
+        return self.vectorstore.delete(ids, **kwargs)
+
+    def similarity_search(self, query, k: int = 4, **kwargs):
+        return self.vectorstore.similarity_search(query, k=k, **kwargs)
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError(
+            "PipelinedVectorStoreWriter wraps an existing vector store")
+
+    async def flush(self):
+        """Waits for the pending upserts, then removes the keys of the failed
+        ones from the record manager. Returns the number of failed ids."""
+        while self._pending:
+            await asyncio.gather(*list(self._pending))
+        if self.failed_ids and self.record_manager is not None:
+            await self.record_manager.adelete_keys(self.failed_ids)
+        return len(self.failed_ids)
+
+
+class ThreadedRecordManager(RecordManager):
+    """Async methods for a synchronous record manager (e.g. SQLRecordManager
+    on a sqlite url), run on one dedicated thread so the connections stay on
+    the thread that created them."""
+
+    def __init__(self, record_manager):
+        super().__init__(namespace=record_manager.namespace)
+        self.record_manager = record_manager
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def _run(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, lambda: function(*args, **kwargs))
+
+    def create_schema(self):
+        return self.record_manager.create_schema()
+
+    async def acreate_schema(self):
+        return await self._run(self.record_manager.create_schema)
+
+    def get_time(self):
+        return self.record_manager.get_time()
+
+    async def aget_time(self):
+        return await self._run(self.record_manager.get_time)
+
+    def update(self, keys, *, group_ids=None, time_at_least=None):
+        return self.record_manager.update(
+            keys, group_ids=group_ids, time_at_least=time_at_least)
+
+    async def aupdate(self, keys, *, group_ids=None, time_at_least=None):
+        return await self._run(self.record_manager.update, keys,
+                               group_ids=group_ids,
+                               time_at_least=time_at_least)
+
+    def exists(self, keys):
+        return self.record_manager.exists(keys)
+
+    async def aexists(self, keys):
+        return await self._run(self.record_manager.exists, keys)
+
+    def list_keys(self, *, before=None, after=None, group_ids=None,
+                  limit=None):
+        return self.record_manager.list_keys(
+            before=before, after=after, group_ids=group_ids, limit=limit)
+
+    async def alist_keys(self, *, before=None, after=None, group_ids=None,
+                         limit=None):
+        return await self._run(self.record_manager.list_keys, before=before,
+                               after=after, group_ids=group_ids, limit=limit)
+
+    def delete_keys(self, keys):
+        return self.record_manager.delete_keys(keys)
+
+    async def adelete_keys(self, keys):
+        return await self._run(self.record_manager.delete_keys, keys)
+
+    def close(self):
+        self._executor.shutdown()
+
+
+def _collect_sources(documents, sources, source_id_key):
+    # the sources of every document of the run, also of the unchanged ones
+    # aindex does not write
+    def _collect(document):
+        source = document.metadata.get(source_id_key)
+        if source is None:
+            raise ValueError("Source ids are required for the incremental "
+                             + f"cleanup, {source_id_key} is missing from "
+                             + f"{document.metadata}")
+        sources.add(source)
+        return document
+
+    if hasattr(documents, "__aiter__"):
+        async def _async_documents():
+            async for document in documents:
+                yield _collect(document)
+        return _async_documents()
+    return (_collect(document) for document in documents)
+
+
+async def _cleanup_sources(writer, record_manager, index_start, sources,
+                           batch_size: int = 1000):
+    # the incremental cleanup of aindex, for the given sources
+    number_of_deleted = 0
+    sources = sorted(sources)
+    for start in range(0, len(sources), batch_size):
+        group_ids = sources[start:start + batch_size]
+        while uids_to_delete := await record_manager.alist_keys(
+                group_ids=group_ids, before=index_start, limit=batch_size):
+            await writer.adelete(uids_to_delete)
+            await record_manager.adelete_keys(uids_to_delete)
+            number_of_deleted += len(uids_to_delete)
+    return number_of_deleted
+
+
+async def _cleanup_all(writer, record_manager, index_start,
+                       batch_size: int = 1000):
+    number_of_deleted = 0
+    while uids_to_delete := await record_manager.alist_keys(
+            before=index_start, limit=batch_size):
+        await writer.adelete(uids_to_delete)
+        await record_manager.adelete_keys(uids_to_delete)
+        number_of_deleted += len(uids_to_delete)
+    return number_of_deleted
+
+
+async def pipelined_index(documents, record_manager, vectorstore,
+                          batch_size: int = 100,
+                          max_concurrent_upserts: int = 4,
+                          upload_parallel: int = 1,
+                          cleanup: str = "incremental",
+                          source_id_key: str = "source", metrics=None):
+    """
+    A method that indexes documents with `aindex`, the upserts of a batch
+    running while the next batches are embedded. Returns the aindex counts
+    with the number of failed upserts under "num_failed".
+
+    Parameters
+    ==========
+    documents: iterable or async iterator of langchain documents
+    record_manager: langchain record manager
+        Synchronous record managers are run on a dedicated thread
+    max_concurrent_upserts: int
+        The number of upserts in flight at the same time
+    upload_parallel: int
+        Qdrant only, the number of upload processes of upload_points
+    metrics: PipelineMetrics
+        Records the vector store writes, the global pipeline metrics by
+        default
+    """
+    async_record_manager = ThreadedRecordManager(record_manager)
+    writer = PipelinedVectorStoreWriter(
+        vectorstore,
+        record_manager=async_record_manager,
+        max_concurrent_upserts=max_concurrent_upserts,
+        upload_parallel=upload_parallel,
+        upload_batch_size=batch_size,
+        metrics=metrics,
+        source_id_key=source_id_key,
+    )
+    try:
+        run_sources = set()
+        if cleanup == "incremental":
+            documents = _collect_sources(documents, run_sources,
+                                         source_id_key)
+        # the keys of the run are updated at or after this time
+        index_start = await async_record_manager.aget_time()
+        try:
+            result = await aindex(
+                documents,
+                async_record_manager,
+                writer,
+                batch_size=batch_size,
+                cleanup=None,
+                source_id_key=source_id_key,
+            )
+        finally:
+            number_of_failed = await writer.flush()
+        if number_of_failed:
+            print(f"---> {number_of_failed} documents failed to upsert and "
+                  + f"will be indexed again next run: {writer.errors[:3]}")
+            result["num_added"] -= number_of_failed
+        if cleanup == "incremental":
+            result["num_deleted"] = await _cleanup_sources(
+                writer, async_record_manager, index_start,
+                run_sources - writer.failed_sources)
+        elif cleanup == "full":
+            if number_of_failed:
+                print("---> full cleanup skipped, some upserts failed")
+            else:
+                result["num_deleted"] = await _cleanup_all(
+                    writer, async_record_manager, index_start)
+        result["num_failed"] = number_of_failed
+        return result
+    finally:
+        async_record_manager.close()
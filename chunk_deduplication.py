@@ -0,0 +1,230 @@
+import re
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from metrics import pipeline_metrics, estimate_tokens
+
+# Cross-document chunk deduplication before embedding. index() hashes the
+# text together with the metadata, so the same license paragraph, publisher
+# footer or abstract in two files is embedded and stored twice. Here the
+# chunks of a run are grouped by the hash of their normalized text and only
+# one copy of every text is indexed, under a canonical source, while the
+# sqlite registry maps every text to all the sources containing it.
+#
+# The canonical source of a text stays the one of earlier runs while that
+# source still contains it (no re-embedding), a text whose canonical source
+# is not part of the run is not indexed again, and when the canonical source
+# dropped the text the smallest of its other sources takes over. The
+# indexed copy is a plain chunk of its canonical source, so incremental
+# cleanup in index() stays correct. A text whose canonical source dropped it
+# while its other sources were not part of the run has no indexed copy until
+# one of those sources is indexed again.
+#
+# The registry only knows the texts of earlier deduplicated runs: the points
+# a namespace got before deduplicate_chunks was enabled are not seen (the
+# record manager keeps hashes of text and metadata, not of the text), so
+# their texts are indexed once more under the canonical source of the first
+# deduplicated run. The retrieval service adds the `sources` of every result
+# from the registry.
+
+_WHITESPACE = re.compile(r"\s+")
+_BATCH_SIZE = 900
+
+
+def normalize_chunk_text(text: str):
+    # unicode compatibility forms (ligatures, non breaking spaces), case and
+    # whitespace differences do not make a different chunk
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", text)
+                           ).strip().casefold()
+
+
+def hash_chunk_text(text: str):
+    return hashlib.sha256(
+        normalize_chunk_text(text).encode("utf-8")).hexdigest()
+
+
+class ChunkRegistry:
+    """
+    An sqlite registry of the (text hash, source) pairs of a namespace, with
+    the canonical source each text is indexed under.
+
+    Parameters
+    ==========
+    namespace: string
+        The record manager namespace, one registry per collection
+    database_path: string
+        The sqlite file, can be shared by several namespaces
+    """
+
+    def __init__(self, namespace: str,
+                 database_path: str = "chunk_registry.sql"):
+        self.namespace = namespace
+        self.database_path = database_path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(database_path,
+                                           check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS chunk_sources ("
+            "namespace TEXT NOT NULL, text_hash TEXT NOT NULL, "
+            "source TEXT NOT NULL, canonical INTEGER NOT NULL, "
+            "PRIMARY KEY (namespace, text_hash, source)) WITHOUT ROWID"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS ix_chunk_sources_source "
+            "ON chunk_sources (namespace, source)"
+        )
+        self._connection.commit()
+
+    def get_canonical_sources(self, text_hashes):
+        canonical_sources = {}
+        text_hashes = list(text_hashes)
+        with self._lock:
+            for start in range(0, len(text_hashes), _BATCH_SIZE):
+                batch = text_hashes[start:start + _BATCH_SIZE]
+                rows = self._connection.execute(
+                    "SELECT text_hash, source FROM chunk_sources "
+                    "WHERE namespace = ? AND canonical = 1 AND text_hash IN "
+                    + f"({','.join('?' * len(batch))})",
+                    [self.namespace, *batch],
+                ).fetchall()
+                canonical_sources.update(rows)
+        return canonical_sources
+
+    def get_sources(self, text: str):
+        """Returns every source containing the text, canonical first."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT source FROM chunk_sources WHERE namespace = ? "
+                "AND text_hash = ? ORDER BY canonical DESC, source",
+                (self.namespace, hash_chunk_text(text)),
+            ).fetchall()
+        return [source for (source,) in rows]
+
+    def store_assignments(self, assignments, sources):
+        """
+        Replaces the pairs of the given sources with those of the run.
+
+        Parameters
+        ==========
+        assignments: dictionary
+            text hash -> (canonical source, sources of the run)
+        sources: iterable of strings
+            Every source of the run, including those without chunks
+        """
+        sources = list(sources)
+        with self._lock, self._connection:
+            for start in range(0, len(sources), _BATCH_SIZE):
+                batch = sources[start:start + _BATCH_SIZE]
+                self._connection.execute(
+                    "DELETE FROM chunk_sources WHERE namespace = ? AND source "
+                    + f"IN ({','.join('?' * len(batch))})",
+                    [self.namespace, *batch],
+                )
+            # a new canonical source replaces the one of an earlier run
+            changed_hashes = [
+                (self.namespace, text_hash)
+                for text_hash, (canonical_source, text_sources)
+                in assignments.items() if canonical_source in text_sources
+            ]
+            self._connection.executemany(
+                "UPDATE chunk_sources SET canonical = 0 WHERE namespace = ? "
+                "AND text_hash = ?", changed_hashes)
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO chunk_sources "
+                "(namespace, text_hash, source, canonical) "
+                "VALUES (?, ?, ?, ?)",
+                [
+                    (self.namespace, text_hash, source,
+                     int(source == canonical_source))
+                    for text_hash, (canonical_source, text_sources)
+                    in assignments.items()
+                    for source in text_sources
+                ],
+            )
+
+    def clear(self):
+        """Forgets every text of the namespace, e.g. once its collection
+        was emptied."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM chunk_sources WHERE namespace = ?",
+                (self.namespace,))
+
+    def close(self):
+        self._connection.close()
+
+
+def deduplicate_chunks(documents, registry: ChunkRegistry = None,
+                       source_id_key: str = "source", metrics=None):
+    """
+    A method that keeps one chunk per normalized text of the run, picking
+    the copy of its canonical source.
+
+    Parameters
+    ==========
+    documents: list of langchain documents
+        Every chunk of the run (the non streaming ingestion)
+    registry: ChunkRegistry
+        The registry of the namespace, without it only the duplicates of the
+        run are collapsed; with it, also the texts registered by earlier
+        deduplicated runs (not the other points of the namespace)
+
+    Returns
+    =======
+    unique_documents, assignments, report: list, dictionary, dictionary
+        The chunks to index, the assignments to store with
+        registry.store_assignments once indexing succeeded, and the savings
+    """
+    metrics = metrics or pipeline_metrics
+    documents_by_hash = {}
+    for document in documents:
+        documents_by_hash.setdefault(
+            hash_chunk_text(document.page_content), []).append(document)
+    run_sources = {document.metadata.get(source_id_key)
+                   for document in documents}
+    registered_sources = registry.get_canonical_sources(
+        documents_by_hash) if registry is not None else {}
+
+    unique_documents = []
+    assignments = {}
+    duplicates_of_namespace = 0
+    for text_hash, copies in documents_by_hash.items():
+        copies_by_source = {}
+        for document in copies:
+            copies_by_source.setdefault(
+                document.metadata.get(source_id_key), document)
+        registered_source = registered_sources.get(text_hash)
+        if registered_source is not None \
+                and registered_source not in run_sources:
+            # indexed by a source of an earlier run, not re-embedded
+            canonical_source = registered_source
+            duplicates_of_namespace += 1
+        else:
+            canonical_source = registered_source \
+                if registered_source in copies_by_source \
+                else min(copies_by_source, key=str)
+            unique_documents.append(copies_by_source[canonical_source])
+        assignments[text_hash] = (canonical_source, sorted(copies_by_source,
+                                                           key=str))
+
+    skipped_texts = len(documents) - len(unique_documents)
+    skipped_tokens = sum(estimate_tokens(document.page_content)
+                         for document in documents) - sum(
+        estimate_tokens(document.page_content)
+        for document in unique_documents)
+    report = {
+        "chunks": len(documents),
+        "unique_texts": len(documents_by_hash),
+        "indexed_chunks": len(unique_documents),
+        "duplicates_within_run": len(documents) - len(documents_by_hash),
+        "duplicates_of_namespace": duplicates_of_namespace,
+        "embedding_texts_saved": skipped_texts,
+        "embedding_tokens_saved_estimated": skipped_tokens,
+        "points_saved": skipped_texts,
+    }
+    metrics.increment("deduplicated_chunks", skipped_texts)
+    metrics.increment("deduplicated_tokens_estimated", skipped_tokens)
+    return unique_documents, assignments, report
@@ -0,0 +1,274 @@
+import sys
+import asyncio
+import argparse
+
+# Command line entry point for the indexing operations. Every subcommand
+# imports what it needs when it runs, so `--help` stays instant and a query
+# only loads the configured embedding model and vector store backends.
+
+
+def _setup_environment():
+    from dotenv import load_dotenv
+    from utils import setup_langsmith_api_keys
+
+    load_dotenv()
+    setup_langsmith_api_keys()
+
+
+def _initialize_vector_store(arguments):
+    from langchain_indexing_api import initialize_vector_store
+
+    initialized = asyncio.run(
+        initialize_vector_store(
+            use_local_vector_store=arguments.vector_store_location == "local"
+        )
+    )
+    if initialized is None:
+        sys.exit("The vector store could not be initialized.")
+    return initialized
+
+
+def ingest(arguments):
+    _setup_environment()
+    from langchain_indexing_api import index_loaded_and_splitted_documents
+
+    document_path = {"document_path": arguments.path} if arguments.path else {}
+    if arguments.fan_out:
+        from utils import get_config_variable
+        from langchain_indexing_api import fan_out_index_documents
+
+        targets = get_config_variable(parameter_name="fan_out_targets")
+        if not isinstance(targets, list) or not targets:
+            sys.exit("config.json has no fan_out_targets.")
+        asyncio.run(
+            fan_out_index_documents(
+                targets,
+                use_local_vector_store=arguments.vector_store_location
+                == "local",
+                **document_path,
+            )
+        )
+        return
+    vectorstore, record_manager = _initialize_vector_store(arguments)
+    asyncio.run(
+        index_loaded_and_splitted_documents(
+            vectorstore=vectorstore,
+            record_manager=record_manager,
+            **document_path,
+        )
+    )
+
+
+def query(arguments):
+    _setup_environment()
+    from langchain_indexing_api import (
+        ask_index_similarity_search,
+        ask_index_batch_similarity_search,
+    )
+
+    vectorstore, record_manager = _initialize_vector_store(arguments)
+    if arguments.local_replica:
+        from langchain_indexing_api import initialize_local_replica
+
+        vectorstore = asyncio.run(initialize_local_replica(vectorstore))
+        if vectorstore is None:
+            sys.exit("The local replica could not be built.")
+    if len(arguments.query) > 1:
+        asyncio.run(
+            ask_index_batch_similarity_search(vectorstore, arguments.query,
+                                              k=arguments.k,
+                                              record_manager=record_manager)
+        )
+    else:
+        asyncio.run(
+            ask_index_similarity_search(vectorstore, query=arguments.query[0],
+                                        k=arguments.k,
+                                        record_manager=record_manager)
+        )
+
+
+def clear(arguments):
+    _setup_environment()
+    from langchain_indexing_api import _clear
+
+    if not arguments.yes:
+        answer = input("This deletes every indexed document of the "
+                       + "configured collection, continue? [y/N] ")
+        if answer.strip().lower() != "y":
+            return
+    vectorstore, record_manager = _initialize_vector_store(arguments)
+    asyncio.run(_clear(vectorstore=vectorstore,
+                       record_manager=record_manager))
+
+
+def migrate(arguments):
+    from dotenv import load_dotenv
+    from utils import migrate_collection
+
+    load_dotenv()
+    migrate_collection(
+        source_url=arguments.source_url,
+        destination_url=arguments.destination_url,
+        source_collection_name=arguments.collection_name,
+        batch_size=arguments.batch_size,
+        max_workers=arguments.max_workers,
+        recreate_on_collision=not arguments.keep_existing,
+    )
+
+
+def inventory(arguments):
+    import runner
+
+    if arguments.output.endswith(".xlsx"):
+        # the original serial producer listing
+        runner.main(directory_path=arguments.directory,
+                    output_path=arguments.output)
+        return
+    runner.build_inventory(
+        directory_path=arguments.directory,
+        output_path=arguments.output,
+        cache_path=arguments.cache_path,
+        max_workers=arguments.max_workers,
+        use_processes=not arguments.threads,
+    )
+
+
+def evaluate_quantization(arguments):
+    import numpy as np
+    from quantization_evaluation import (
+        evaluate_quantization,
+        load_evaluation_vectors,
+        print_evaluation_table,
+        save_evaluation,
+    )
+
+    client = None
+    if not arguments.snapshot_directory:
+        from dotenv import load_dotenv
+        from qdrant_client import QdrantClient
+
+        load_dotenv()
+        client = QdrantClient(url=arguments.url, timeout=600)
+    vectors, distance = load_evaluation_vectors(
+        snapshot_directory=arguments.snapshot_directory,
+        client=client,
+        collection_name=arguments.collection_name,
+    )
+    rows = evaluate_quantization(
+        vectors,
+        queries=np.load(arguments.queries) if arguments.queries else None,
+        k=arguments.k,
+        dimensions=arguments.dimensions,
+        number_of_sampled_queries=arguments.sampled_queries,
+        rescore_factor=arguments.rescore_factor,
+        distance=distance,
+    )
+    print_evaluation_table(rows)
+    if arguments.output:
+        save_evaluation(rows, arguments.output)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Index documents into the configured vector store. The "
+        + "embedding model, vector store and collection come from config.json."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def _add_vector_store_location(subparser):
+        subparser.add_argument(
+            "--vector-store-location", choices=["local", "cloud"],
+            default="cloud",
+            help="Use QDRANT_LOCAL_URL or QDRANT_CLOUD_URL_RIZZBUZZ")
+
+    ingest_parser = subparsers.add_parser(
+        "ingest", help="Load, split and index the documents of a directory")
+    ingest_parser.add_argument(
+        "--path", help="The document directory, defaults to "
+        + "langchain_indexing_api.DEFAULT_DOCUMENT_PATH")
+    ingest_parser.add_argument(
+        "--fan-out", action="store_true",
+        help="Parse once and index into every target of fan_out_targets")
+    _add_vector_store_location(ingest_parser)
+    ingest_parser.set_defaults(handler=ingest)
+
+    query_parser = subparsers.add_parser(
+        "query", help="Run similarity searches against the collection, "
+        + "several queries are embedded and searched as one batch")
+    query_parser.add_argument("query", nargs="+")
+    query_parser.add_argument("-k", type=int, default=4)
+    query_parser.add_argument(
+        "--local-replica", action="store_true",
+        help="Search an in-process replica of the collection, loaded from "
+        + "local_replica_snapshot_directory or scrolled from the collection")
+    _add_vector_store_location(query_parser)
+    query_parser.set_defaults(handler=query)
+
+    clear_parser = subparsers.add_parser(
+        "clear", help="Delete every indexed document of the collection")
+    clear_parser.add_argument("--yes", action="store_true",
+                              help="Do not ask for confirmation")
+    _add_vector_store_location(clear_parser)
+    clear_parser.set_defaults(handler=clear)
+
+    migrate_parser = subparsers.add_parser(
+        "migrate", help="Copy a collection between qdrant instances")
+    migrate_parser.add_argument("--source-url", required=True)
+    migrate_parser.add_argument("--destination-url", required=True)
+    migrate_parser.add_argument("--collection-name", required=True)
+    migrate_parser.add_argument("--batch-size", type=int, default=1000)
+    migrate_parser.add_argument("--max-workers", type=int, default=4)
+    migrate_parser.add_argument(
+        "--keep-existing", action="store_true",
+        help="Fail instead of recreating an existing destination collection")
+    migrate_parser.set_defaults(handler=migrate)
+
+    inventory_parser = subparsers.add_parser(
+        "inventory", help="List the files of a document archive")
+    inventory_parser.add_argument("--directory",
+                                  default="../cellectra_documents/")
+    inventory_parser.add_argument(
+        "--output", default="document_inventory.csv",
+        help="A .csv or .parquet file streamed as files are read, or an "
+        + ".xlsx file for the serial producer listing")
+    inventory_parser.add_argument("--cache-path",
+                                  default="inventory_cache.json")
+    inventory_parser.add_argument("--max-workers", type=int)
+    inventory_parser.add_argument(
+        "--threads", action="store_true",
+        help="Read the pdf files with a thread pool instead of processes")
+    inventory_parser.set_defaults(handler=inventory)
+
+    evaluation_parser = subparsers.add_parser(
+        "evaluate-quantization",
+        help="Measure recall@k, latency and memory of truncated and "
+        + "quantized vectors of a collection, offline")
+    vector_source = evaluation_parser.add_mutually_exclusive_group(
+        required=True)
+    vector_source.add_argument("--snapshot-directory",
+                               help="A snapshot written by "
+                               + "collection_snapshot.py")
+    vector_source.add_argument("--collection-name",
+                               help="Scroll this collection from --url")
+    evaluation_parser.add_argument("--url", default="http://localhost:6333")
+    evaluation_parser.add_argument(
+        "--queries", help="A .npy file of query vectors, by default "
+        + "collection vectors are held out as queries")
+    evaluation_parser.add_argument("--sampled-queries", type=int,
+                                   default=200)
+    evaluation_parser.add_argument("-k", type=int, default=10)
+    evaluation_parser.add_argument("--dimensions", type=int, nargs="*",
+                                   default=[256, 512, 768])
+    evaluation_parser.add_argument("--rescore-factor", type=int, default=4)
+    evaluation_parser.add_argument("--output", help="Write the rows as json")
+    evaluation_parser.set_defaults(handler=evaluate_quantization)
+    return parser
+
+
+def main(argv=None):
+    arguments = build_parser().parse_args(argv)
+    arguments.handler(arguments)
+
+
+if __name__ == "__main__":
+    main()
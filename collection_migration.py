@@ -0,0 +1,221 @@
+import os
+import re
+import json
+import time
+import threading
+from contextlib import nullcontext
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from qdrant_client import models
+from qdrant_client._pydantic_compat import to_dict
+from qdrant_client.local.qdrant_local import QdrantLocal
+from utils import iterate_collection_pages
+
+
+def _load_checkpoint(checkpoint_path):
+    if os.path.isfile(checkpoint_path):
+        with open(checkpoint_path, "r") as checkpoint_file:
+            return json.load(checkpoint_file)
+    return None
+
+
+def _save_checkpoint(checkpoint_path, checkpoint):
+    temporary_path = f"{checkpoint_path}.tmp"
+    with open(temporary_path, "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(temporary_path, checkpoint_path)
+
+
+def _get_default_checkpoint_path(destination_client, collection_name,
+                                 destination_collection_name):
+    # one checkpoint per (source collection, destination client and
+    # collection), migrating the same collection to another destination
+    # must not resume from the checkpoint of the first one
+    client = getattr(destination_client, "_client", None)
+    location = (getattr(client, "rest_uri", None)
+                or getattr(client, "location", None) or "unknown")
+    destination = re.sub(r"[^\w.-]+", "_",
+                         f"{location}_{destination_collection_name}")
+    return f"migration_checkpoint_{collection_name}_to_{destination}.json"
+
+
+def _prepare_destination(source_client, destination_client, collection_name,
+                         destination_collection_name, recreate_on_collision):
+    # the whole collection configuration and the payload indexes, as
+    # QdrantClient.migrate recreates them
+    if destination_client.collection_exists(destination_collection_name):
+        if not recreate_on_collision:
+            raise ValueError(
+                f"Collection {destination_collection_name} already exists "
+                + "in the destination, set recreate_on_collision to "
+                + "replace it")
+        destination_client.delete_collection(destination_collection_name)
+    source_info = source_client.get_collection(collection_name)
+    source_config = source_info.config
+    destination_client.create_collection(
+        destination_collection_name,
+        vectors_config=source_config.params.vectors,
+        sparse_vectors_config=source_config.params.sparse_vectors,
+        shard_number=source_config.params.shard_number,
+        replication_factor=source_config.params.replication_factor,
+        write_consistency_factor=(
+            source_config.params.write_consistency_factor),
+        on_disk_payload=source_config.params.on_disk_payload,
+        hnsw_config=models.HnswConfigDiff(
+            **to_dict(source_config.hnsw_config)),
+        optimizers_config=models.OptimizersConfigDiff(
+            **to_dict(source_config.optimizer_config)),
+        wal_config=models.WalConfigDiff(**to_dict(source_config.wal_config)),
+        quantization_config=source_config.quantization_config,
+    )
+    for field_name, field_info in (source_info.payload_schema or {}).items():
+        destination_client.create_payload_index(
+            destination_collection_name,
+            field_name=field_name,
+            field_schema=field_info.data_type if field_info.params is None
+            else field_info.params,
+        )
+
+
+def _upsert_page(destination_client, collection_name, points, upsert_lock):
+    with upsert_lock:
+        destination_client.upsert(
+            collection_name=collection_name,
+            points=[
+                models.PointStruct(id=point.id, vector=point.vector,
+                                   payload=point.payload)
+                for point in points
+            ],
+            wait=True,
+        )
+    return len(points)
+
+
+def migrate_collection_with_checkpoints(
+    source_client,
+    destination_client,
+    collection_name: str,
+    destination_collection_name: str = None,
+    page_size: int = 1000,
+    max_workers: int = 4,
+    checkpoint_path: str = None,
+    recreate_on_collision: bool = True,
+    report_interval_seconds: float = 5,
+):
+    """
+    A method that copies a collection page by page, upserting up to
+    max_workers pages into the destination concurrently. After every page
+    that is committed in order, the offset of the next page is written to a
+    checkpoint file, so an interrupted migration resumes from there (pages
+    in flight at the time are simply upserted again). The point counts are
+    compared at the end and the progress is reported as points/sec and ETA.
+
+    Parameters
+    ==========
+    page_size: int
+        The number of points read and upserted per request
+    max_workers: int
+        The number of pages upserted concurrently
+    checkpoint_path: string
+        The checkpoint file, defaults to one named after the collection, the
+        destination url (or path) and the destination collection
+    recreate_on_collision: bool
+        Replace an existing destination collection when starting fresh
+
+    Returns
+    =======
+    report: dictionary
+        The number of migrated points, the point counts and the rate
+    """
+    destination_collection_name = (destination_collection_name
+                                   or collection_name)
+    checkpoint_path = checkpoint_path or _get_default_checkpoint_path(
+        destination_client, collection_name, destination_collection_name)
+    checkpoint = _load_checkpoint(checkpoint_path)
+    if checkpoint is None:
+        _prepare_destination(source_client, destination_client,
+                             collection_name, destination_collection_name,
+                             recreate_on_collision)
+        checkpoint = {"offset": None, "migrated_points": 0}
+        _save_checkpoint(checkpoint_path, checkpoint)
+    else:
+        print(f"---> resuming migration of {collection_name} after "
+              + f"{checkpoint['migrated_points']} points")
+
+    source_count = source_client.count(collection_name, exact=True).count
+    start_time = time.time()
+    last_report_time = start_time
+    points_this_run = 0
+    in_flight = deque()
+    # local (in-memory / on-disk) clients are not thread safe, their upserts
+    # are serialized while reading the source still overlaps with them
+    upsert_lock = (
+        threading.Lock()
+        if isinstance(getattr(destination_client, "_client", None),
+                      QdrantLocal)
+        else nullcontext()
+    )
+
+    def _commit_oldest_page():
+        nonlocal points_this_run, last_report_time
+        future, next_offset = in_flight.popleft()
+        number_of_points = future.result()
+        points_this_run += number_of_points
+        checkpoint["migrated_points"] += number_of_points
+        checkpoint["offset"] = next_offset
+        _save_checkpoint(checkpoint_path, checkpoint)
+        now = time.time()
+        if now - last_report_time >= report_interval_seconds:
+            last_report_time = now
+            rate = points_this_run / max(now - start_time, 1e-9)
+            remaining = max(source_count - checkpoint["migrated_points"], 0)
+            print(
+                f"---> migrated {checkpoint['migrated_points']}/{source_count}"
+                + f" points, {round(rate, 1)} points/sec, "
+                + f"ETA {round(remaining / rate, 1) if rate else '?'} seconds"
+            )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for points, next_offset in iterate_collection_pages(
+                source_client,
+                collection_name,
+                page_size=page_size,
+                offset=checkpoint["offset"],
+            ):
+                if points:
+                    in_flight.append((
+                        executor.submit(_upsert_page, destination_client,
+                                        destination_collection_name, points,
+                                        upsert_lock),
+                        next_offset,
+                    ))
+                while len(in_flight) >= max_workers:
+                    _commit_oldest_page()
+            while in_flight:
+                _commit_oldest_page()
+        except Exception:
+            # only the pages committed in order are in the checkpoint
+            for future, _ in in_flight:
+                future.cancel()
+            raise
+
+    elapsed_seconds = time.time() - start_time
+    destination_count = destination_client.count(
+        destination_collection_name, exact=True).count
+    report = {
+        "migrated_points": checkpoint["migrated_points"],
+        "source_count": source_count,
+        "destination_count": destination_count,
+        "elapsed_seconds": round(elapsed_seconds, 2),
+        "points_per_second": round(
+            points_this_run / max(elapsed_seconds, 1e-9), 1),
+    }
+    if destination_count == source_count:
+        os.remove(checkpoint_path)
+        print(f"---> migration of {collection_name} completed: {report}")
+    else:
+        print(
+            f"---> point counts differ after migrating {collection_name}, "
+            + f"the checkpoint is kept at {checkpoint_path}: {report}")
+    return report
@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import numpy as np
+from qdrant_client import models
+from utils import iterate_collection_pages
+
+
+# A local snapshot format for qdrant collections:
+#   manifest.json       collection name, point count, dimension, dtype,
+#                       distance, vector name and payload columns
+#   vectors.npy         a contiguous (count x dimension) float32/float16 array,
+#                       opened memory mapped on import
+#   ids.jsonl           the point id of every row
+#   payload_columns/    one json lines file per payload key, row aligned with
+#                       vectors.npy, an empty line marks a missing value
+
+
+def _get_vector_params(client, collection_name, vector_name=None):
+    vectors_config = client.get_collection(
+        collection_name).config.params.vectors
+    if isinstance(vectors_config, dict):
+        if vector_name is None:
+            raise ValueError(
+                f"Collection {collection_name} has named vectors "
+                + f"{list(vectors_config)}, pass the vector_name to export")
+        return vectors_config[vector_name]
+    return vectors_config
+
+
+class _PayloadColumnWriter:
+    def __init__(self, directory):
+        self.directory = directory
+        self.columns = {}
+        self.files = {}
+        self.rows_written = {}
+
+    def _open_column(self, key):
+        file_name = f"column_{len(self.columns)}.jsonl"
+        self.columns[key] = file_name
+        self.files[key] = open(os.path.join(self.directory, file_name), "w")
+        self.rows_written[key] = 0
+
+    def _pad(self, key, row):
+        missing_rows = row - self.rows_written[key]
+        if missing_rows > 0:
+            self.files[key].write("\n" * missing_rows)
+            self.rows_written[key] = row
+
+    def write(self, row, payload):
+        for key, value in (payload or {}).items():
+            if key not in self.columns:
+                self._open_column(key)
+            self._pad(key, row)
+            self.files[key].write(json.dumps(value) + "\n")
+            self.rows_written[key] += 1
+
+    def close(self, number_of_rows):
+        for key, column_file in self.files.items():
+            self._pad(key, number_of_rows)
+            column_file.close()
+
+
+def export_collection_snapshot(
+    client,
+    collection_name: str,
+    snapshot_directory: str,
+    dtype: str = "float32",
+    page_size: int = 1000,
+    vector_name: str = None,
+):
+    """
+    A method that writes a collection to a local snapshot, streaming the
+    pages of a scroll straight into a memory mapped vector array and payload
+    column files
+
+    Parameters
+    ==========
+    dtype: string
+        "float32" or "float16" for the stored vectors
+    vector_name: string
+        The vector to export for collections with named vectors
+
+    Returns
+    =======
+    manifest: dictionary
+        The manifest of the written snapshot
+    """
+    try:
+        start_time = time.time()
+        vector_params = _get_vector_params(client, collection_name,
+                                           vector_name)
+        number_of_points = client.count(collection_name, exact=True).count
+        os.makedirs(os.path.join(snapshot_directory, "payload_columns"),
+                    exist_ok=True)
+        vectors = np.lib.format.open_memmap(
+            os.path.join(snapshot_directory, "vectors.npy"),
+            mode="w+",
+            dtype=dtype,
+            shape=(number_of_points, vector_params.size),
+        )
+        payload_writer = _PayloadColumnWriter(
+            os.path.join(snapshot_directory, "payload_columns"))
+
+        row = 0
+        with open(os.path.join(snapshot_directory, "ids.jsonl"),
+                  "w") as ids_file:
+            for points, _ in iterate_collection_pages(
+                client,
+                collection_name,
+                page_size=page_size,
+                with_payload=True,
+                with_vectors=[vector_name] if vector_name else True,
+            ):
+                # points added after the count are left for the next export
+                points = points[:number_of_points - row]
+                if not points:
+                    break
+                page_vectors = [
+                    point.vector[vector_name] if vector_name
+                    else point.vector
+                    for point in points
+                ]
+                vectors[row:row + len(points)] = np.asarray(page_vectors,
+                                                            dtype=dtype)
+                for point in points:
+                    ids_file.write(json.dumps(point.id) + "\n")
+                    payload_writer.write(row, point.payload)
+                    row += 1
+        vectors.flush()
+        payload_writer.close(row)
+
+        manifest = {
+            "collection_name": collection_name,
+            "count": row,
+            "dimension": vector_params.size,
+            "dtype": dtype,
+            "distance": vector_params.distance.value,
+            "vector_name": vector_name,
+            "payload_columns": payload_writer.columns,
+        }
+        with open(os.path.join(snapshot_directory, "manifest.json"),
+                  "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=4)
+        print(
+            f"---> exported {row} points of {collection_name} to "
+            + f"{snapshot_directory} in {round(time.time()-start_time, 2)} "
+            + "seconds"
+        )
+        return manifest
+    except Exception as ex:
+        print("An error occurred while exporting the collection "
+              + f"{collection_name}.\nError : {ex}")
+
+
+def load_collection_snapshot(snapshot_directory: str):
+    # returns the manifest and the memory mapped vectors of a snapshot
+    with open(os.path.join(snapshot_directory, "manifest.json"),
+              "r") as manifest_file:
+        manifest = json.load(manifest_file)
+    vectors = np.load(os.path.join(snapshot_directory, "vectors.npy"),
+                      mmap_mode="r")[:manifest["count"]]
+    return manifest, vectors
+
+
+def iterate_snapshot_ids(snapshot_directory: str):
+    with open(os.path.join(snapshot_directory, "ids.jsonl"),
+              "r") as ids_file:
+        for line in ids_file:
+            yield json.loads(line)
+
+
+def iterate_snapshot_payloads(snapshot_directory: str, manifest: dict):
+    column_files = {
+        key: open(os.path.join(snapshot_directory, "payload_columns",
+                               file_name), "r")
+        for key, file_name in manifest["payload_columns"].items()
+    }
+    try:
+        for _ in range(manifest["count"]):
+            payload = {}
+            for key, column_file in column_files.items():
+                line = column_file.readline().rstrip("\n")
+                if line:
+                    payload[key] = json.loads(line)
+            yield payload
+    finally:
+        for column_file in column_files.values():
+            column_file.close()
+
+
+def import_collection_snapshot(
+    client,
+    snapshot_directory: str,
+    collection_name: str = None,
+    recreate: bool = True,
+    batch_size: int = 256,
+    parallel: int = 1,
+):
+    """
+    A method that restores a local snapshot into a collection with a bulk
+    upload straight from the memory mapped vectors
+
+    Parameters
+    ==========
+    collection_name: string
+        The destination collection, defaults to the exported collection name
+    recreate: bool
+        Drop and create the destination collection before the upload
+    parallel: int
+        The number of upload processes (remote qdrant instances only)
+    """
+    try:
+        start_time = time.time()
+        manifest, vectors = load_collection_snapshot(snapshot_directory)
+        collection_name = collection_name or manifest["collection_name"]
+        vector_name = manifest["vector_name"]
+        vector_params = models.VectorParams(
+            size=manifest["dimension"],
+            distance=models.Distance(manifest["distance"]),
+        )
+        if recreate:
+            client.delete_collection(collection_name)
+            client.create_collection(
+                collection_name,
+                vectors_config=(
+                    {vector_name: vector_params} if vector_name
+                    else vector_params),
+            )
+        client.upload_collection(
+            collection_name=collection_name,
+            vectors={vector_name: vectors} if vector_name else vectors,
+            payload=iterate_snapshot_payloads(snapshot_directory, manifest),
+            ids=iterate_snapshot_ids(snapshot_directory),
+            batch_size=batch_size,
+            parallel=parallel,
+            wait=True,
+        )
+        print(
+            f"---> imported {manifest['count']} points into "
+            + f"{collection_name} in {round(time.time()-start_time, 2)} "
+            + "seconds"
+        )
+        return manifest
+    except Exception as ex:
+        print("An error occurred while importing the snapshot "
+              + f"{snapshot_directory}.\nError : {ex}")
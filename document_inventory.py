@@ -0,0 +1,34 @@
+import os
+import json
+
+# The cache of the document inventory (runner.build_inventory), shared with
+# the scheduling of the pdf loading (utils.order_files_for_scheduling). Its
+# rows are keyed by absolute path, so both find the row of a file whatever
+# their working directory and whether they were given relative or absolute
+# paths.
+
+
+def get_inventory_key(file_path):
+    return os.path.abspath(file_path)
+
+
+def is_inventory_row_current(row, stat):
+    # a cached row describes the file while its size and mtime are unchanged
+    return bool(row) and row.get('size_bytes') == stat.st_size \
+        and row.get('modified_time') == stat.st_mtime
+
+
+def load_inventory_cache(cache_path='inventory_cache.json'):
+    # the relative keys of older caches are made absolute too
+    if not os.path.isfile(cache_path):
+        return {}
+    with open(cache_path, 'r') as cache_file:
+        return {get_inventory_key(file_path): row
+                for file_path, row in json.load(cache_file).items()}
+
+
+def save_inventory_cache(cache, cache_path):
+    temporary_path = f"{cache_path}.tmp"
+    with open(temporary_path, 'w') as cache_file:
+        json.dump(cache, cache_file)
+    os.replace(temporary_path, cache_path)
@@ -0,0 +1,203 @@
+import time
+import array
+import sqlite3
+import hashlib
+import threading
+from typing import List
+from langchain_core.embeddings import Embeddings
+
+
+def get_embedding_model_name(embedding_model):
+    # OpenAIEmbeddings / OllamaEmbeddings expose `model`, the hugging face
+    # encoders expose `model_name`
+    for attribute_name in ("model", "model_name"):
+        model_name = getattr(embedding_model, attribute_name, None)
+        if isinstance(model_name, str):
+            return model_name
+    return type(embedding_model).__name__
+
+
+class LocalEmbeddingCache(Embeddings):
+    """
+    An on-disk, content addressed embedding cache that wraps any langchain
+    embedding model. Vectors are keyed by model name + dimension + the hash of
+    the chunk text, so collections built from overlapping documents with the
+    same model and dimension share their embeddings. The dimension of the
+    keys is the size of the vectors the model returns, learnt from the first
+    text embedded, not the configured one, which can differ (MedCPT returns
+    768 dimensional vectors whatever the config says). The cache is bounded
+    by max_entries and evicts the least recently used vectors first.
+
+    Parameters
+    ==========
+    embedding_model: langchain embeddings
+        The embedding model used for cache misses
+    dimension: int
+        The configured dimension of the vectors, reported next to the
+        dimension the model actually returns
+    cache_path: string
+        The sqlite file holding the cached vectors
+    max_entries: int
+        The maximum number of vectors kept in the cache
+    """
+
+    def __init__(
+        self,
+        embedding_model,
+        dimension: int,
+        cache_path: str = "embedding_cache.sqlite",
+        max_entries: int = 2_000_000,
+    ):
+        self.embedding_model = embedding_model
+        self.model = get_embedding_model_name(embedding_model)
+        self.dimension = dimension
+        self.vector_dimension = None
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(cache_path,
+                                           check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, "
+            "last_accessed REAL NOT NULL) WITHOUT ROWID"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS ix_embeddings_last_accessed "
+            "ON embeddings (last_accessed)"
+        )
+        self._connection.commit()
+        # a running count of the entries, so that storing a batch does not
+        # scan the table; get_statistics recounts it, which also picks up
+        # the writes of other processes sharing the file
+        (self._number_of_entries,) = self._connection.execute(
+            "SELECT COUNT(*) FROM embeddings"
+        ).fetchone()
+
+    def __repr__(self):
+        return (f"LocalEmbeddingCache(model={self.model}, "
+                + f"dimension={self.dimension}, "
+                + f"embedding_model={self.embedding_model!r})")
+
+    def _key(self, text: str):
+        text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return f"{self.model}:{self.vector_dimension}:{text_hash}"
+
+    def _learn_vector_dimension(self, text: str):
+        # the keys need the output size of the model before the first
+        # lookup, so the first text is embedded on its own; its vector is
+        # returned to be used (and stored) like any other miss
+        vector = self.embedding_model.embed_documents([text])[0]
+        self.vector_dimension = len(vector)
+        if self.dimension and self.vector_dimension != self.dimension:
+            print(f"---> warning: {self.model} returns "
+                  + f"{self.vector_dimension} dimensional vectors, the "
+                  + f"configured dimension is {self.dimension}")
+        return vector
+
+    def _get_cached_vectors(self, keys):
+        cached_vectors = {}
+        unique_keys = list(dict.fromkeys(keys))
+        # stay under sqlite's bound parameter limit
+        for start in range(0, len(unique_keys), 900):
+            key_batch = unique_keys[start:start + 900]
+            placeholders = ",".join("?" * len(key_batch))
+            rows = self._connection.execute(
+                "SELECT key, vector FROM embeddings "
+                + f"WHERE key IN ({placeholders})",
+                key_batch,
+            ).fetchall()
+            for key, vector in rows:
+                cached_vectors[key] = array.array("f", vector).tolist()
+        if cached_vectors:
+            now = time.time()
+            self._connection.executemany(
+                "UPDATE embeddings SET last_accessed = ? WHERE key = ?",
+                [(now, key) for key in cached_vectors],
+            )
+        return cached_vectors
+
+    def _store_vectors(self, keys, vectors):
+        now = time.time()
+        # a key stored meanwhile by another writer holds the same vector,
+        # only the new rows are counted
+        cursor = self._connection.executemany(
+            "INSERT OR IGNORE INTO embeddings (key, vector, last_accessed) "
+            "VALUES (?, ?, ?)",
+            [
+                (key, array.array("f", vector).tobytes(), now)
+                for key, vector in zip(keys, vectors)
+            ],
+        )
+        self._number_of_entries += max(cursor.rowcount, 0)
+        self._evict()
+
+    def _evict(self):
+        overflow = self._number_of_entries - self.max_entries
+        if overflow > 0:
+            cursor = self._connection.execute(
+                "DELETE FROM embeddings WHERE key IN (SELECT key FROM "
+                "embeddings ORDER BY last_accessed LIMIT ?)",
+                (overflow,),
+            )
+            self._number_of_entries -= max(cursor.rowcount, 0)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        computed_vectors = {}
+        if self.vector_dimension is None:
+            first_vector = self._learn_vector_dimension(texts[0])
+            computed_vectors[self._key(texts[0])] = first_vector
+        keys = [self._key(text) for text in texts]
+        with self._lock:
+            cached_vectors = self._get_cached_vectors(
+                [key for key in keys if key not in computed_vectors])
+            self._connection.commit()
+
+        # embed every missing text once, even if it is repeated in the batch
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached_vectors and key not in computed_vectors \
+                    and key not in missing:
+                missing[key] = text
+        with self._lock:
+            self.hits += len(keys) - len(missing) - len(computed_vectors)
+            self.misses += len(missing) + len(computed_vectors)
+
+        if missing:
+            computed_vectors.update(zip(
+                missing.keys(),
+                self.embedding_model.embed_documents(list(missing.values())),
+            ))
+        if computed_vectors:
+            with self._lock:
+                self._store_vectors(list(computed_vectors.keys()),
+                                    list(computed_vectors.values()))
+                self._connection.commit()
+            cached_vectors.update(computed_vectors)
+        return [list(cached_vectors[key]) for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        # queries are not cached, some models embed them differently
+        return self.embedding_model.embed_query(text)
+
+    def get_statistics(self):
+        with self._lock:
+            (self._number_of_entries,) = self._connection.execute(
+                "SELECT COUNT(*) FROM embeddings"
+            ).fetchone()
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "entries": self._number_of_entries,
+            "max_entries": self.max_entries,
+            "vector_dimension": self.vector_dimension,
+        }
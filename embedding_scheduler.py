@@ -0,0 +1,257 @@
+import time
+import random
+import asyncio
+import functools
+import threading
+from typing import List
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from langchain_core.embeddings import Embeddings
+
+
+@functools.lru_cache(maxsize=1)
+def _get_token_encoder():
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
+
+
+def count_tokens(text: str):
+    encoder = _get_token_encoder()
+    if encoder is None:
+        # rough estimate used when tiktoken is not available
+        return len(text) // 4 + 1
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+class TokenBudget:
+    """A token bucket that refills tokens_per_minute tokens every minute,
+    shared by the calls of every event loop and thread."""
+
+    def __init__(self, tokens_per_minute: int):
+        self.capacity = tokens_per_minute
+        self.available = float(tokens_per_minute)
+        self.refill_rate = tokens_per_minute / 60
+        self.updated_at = time.monotonic()
+        # embed_documents runs each call in an event loop of its own, an
+        # asyncio lock can not be shared between them
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(
+            self.capacity,
+            self.available + (now - self.updated_at) * self.refill_rate,
+        )
+        self.updated_at = now
+
+    async def acquire(self, tokens: int):
+        # the tokens are reserved right away, in order, and the caller waits
+        # until the bucket has refilled the deficit; a request larger than
+        # the whole budget waits for a full bucket
+        tokens = min(tokens, self.capacity)
+        with self._lock:
+            self._refill()
+            self.available -= tokens
+            deficit = -self.available
+        if deficit > 0:
+            await asyncio.sleep(deficit / self.refill_rate)
+
+
+class RateLimitError(Exception):
+    def __init__(self, retry_after: float = None):
+        super().__init__("rate limited by the embedding endpoint")
+        self.retry_after = retry_after
+
+
+class AsyncEmbeddingScheduler(Embeddings):
+    """
+    An embedding model that calls the OpenAI or Ollama embedding endpoint
+    directly with several requests in flight. Batches are packed by token
+    count, shrink after a 429 and grow back on success, 429s are retried with
+    backoff (honoring Retry-After) and the tokens sent are kept under a
+    tokens-per-minute budget.
+
+    Parameters
+    ==========
+    provider: string
+        "openai" or "ollama"
+    model: string
+        The embedding model name
+    dimensions: int
+        The output dimension (openai only)
+    base_url: string
+        The endpoint, e.g. a local stub server while testing
+    max_concurrent_requests: int
+        The number of requests in flight
+    max_batch_tokens: int
+        The upper bound of the number of tokens packed into one request
+    tokens_per_minute: int
+        The token budget of the account
+    """
+
+    def __init__(
+        self,
+        provider: str = "openai",
+        model: str = "text-embedding-3-large",
+        dimensions: int = None,
+        base_url: str = None,
+        api_key: str = None,
+        max_concurrent_requests: int = 8,
+        max_batch_tokens: int = 8000,
+        max_batch_size: int = 2048,
+        tokens_per_minute: int = 1_000_000,
+        max_retries: int = 8,
+        timeout: float = 600,
+        embed_instruction: str = "passage: ",
+        query_instruction: str = "query: ",
+    ):
+        if provider not in ("openai", "ollama"):
+            raise ValueError(f"Unsupported embedding provider: {provider}")
+        self.provider = provider
+        self.model = model
+        self.dimensions = dimensions
+        if base_url is None:
+            base_url = ("https://api.openai.com/v1" if provider == "openai"
+                        else "http://localhost:11434")
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.max_concurrent_requests = max_concurrent_requests
+        self.max_batch_tokens = max_batch_tokens
+        # the ollama endpoint embeds a single prompt per request
+        self.max_batch_size = max_batch_size if provider == "openai" else 1
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.timeout = timeout
+        # same prefixes as langchain's OllamaEmbeddings, so vectors match
+        self.embed_instruction = embed_instruction
+        self.query_instruction = query_instruction
+        self.statistics = {"requests": 0, "rate_limited": 0, "tokens": 0}
+        # shared by every call (index() embeds batch after batch), so the
+        # budget and the shrinking after a 429 hold across calls
+        self.budget = TokenBudget(tokens_per_minute)
+        self._batch_token_target = max_batch_tokens
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return (f"AsyncEmbeddingScheduler(provider={self.provider}, "
+                + f"model={self.model}, base_url={self.base_url})")
+
+    def _pack_batch(self, pending, token_counts, batch_token_target):
+        batch = [pending.popleft()]
+        batch_tokens = token_counts[batch[0]]
+        while (pending
+               and len(batch) < self.max_batch_size
+               and batch_tokens + token_counts[pending[0]]
+               <= batch_token_target):
+            index = pending.popleft()
+            batch.append(index)
+            batch_tokens += token_counts[index]
+        return batch, batch_tokens
+
+    async def _post(self, client, texts):
+        if self.provider == "openai":
+            body = {"model": self.model, "input": texts,
+                    "encoding_format": "float"}
+            if self.dimensions:
+                body["dimensions"] = self.dimensions
+            headers = {}
+            if self.api_key:
+                headers["Authorization"] = f"Bearer {self.api_key}"
+            response = await client.post(f"{self.base_url}/embeddings",
+                                         json=body, headers=headers)
+        else:
+            response = await client.post(
+                f"{self.base_url}/api/embeddings",
+                json={"model": self.model, "prompt": texts[0]},
+            )
+        if response.status_code == 429:
+            retry_after = response.headers.get("retry-after")
+            raise RateLimitError(float(retry_after) if retry_after else None)
+        response.raise_for_status()
+        if self.provider == "openai":
+            data = sorted(response.json()["data"], key=lambda d: d["index"])
+            return [item["embedding"] for item in data]
+        return [response.json()["embedding"]]
+
+    async def _embed_batch(self, client, budget, texts, batch_tokens):
+        for attempt in range(self.max_retries + 1):
+            await budget.acquire(batch_tokens)
+            try:
+                # the workers of every event loop and thread share them
+                with self._lock:
+                    self.statistics["requests"] += 1
+                vectors = await self._post(client, texts)
+                with self._lock:
+                    self.statistics["tokens"] += batch_tokens
+                return vectors
+            except (RateLimitError, httpx.TransportError) as ex:
+                if attempt == self.max_retries:
+                    raise
+                if isinstance(ex, RateLimitError):
+                    with self._lock:
+                        self.statistics["rate_limited"] += 1
+                        self._batch_token_target = max(
+                            1, self._batch_token_target // 2)
+                delay = getattr(ex, "retry_after", None)
+                if delay is None:
+                    delay = min(60, 2 ** attempt) * (0.5 + random.random())
+                await asyncio.sleep(delay)
+
+    async def _aembed(self, texts: List[str]) -> List[List[float]]:
+        results = [None] * len(texts)
+        token_counts = [count_tokens(text) for text in texts]
+        pending = deque(range(len(texts)))
+
+        async with httpx.AsyncClient(timeout=self.timeout) as client:
+
+            async def _worker():
+                while pending:
+                    batch, batch_tokens = self._pack_batch(
+                        pending, token_counts, self._batch_token_target)
+                    vectors = await self._embed_batch(
+                        client, self.budget, [texts[i] for i in batch],
+                        batch_tokens)
+                    for index, vector in zip(batch, vectors):
+                        results[index] = vector
+                    # grow the batches back after successful requests
+                    with self._lock:
+                        self._batch_token_target = min(
+                            self.max_batch_tokens,
+                            int(self._batch_token_target * 1.1) + 1,
+                        )
+
+            number_of_workers = min(self.max_concurrent_requests,
+                                    len(texts))
+            await asyncio.gather(
+                *[_worker() for _ in range(number_of_workers)])
+        return results
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.provider == "ollama":
+            texts = [f"{self.embed_instruction}{text}" for text in texts]
+        return await self._aembed(texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        if self.provider == "ollama":
+            text = f"{self.query_instruction}{text}"
+        return (await self._aembed([text]))[0]
+
+    def _run(self, coroutine):
+        # index() calls us synchronously, possibly from a thread that already
+        # runs an event loop, so the requests get a loop of their own
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, coroutine).result()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        return self._run(self.aembed_documents(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._run(self.aembed_query(text))
@@ -1,18 +1,359 @@
+import os
 import asyncio
-from langchain_huggingface import HuggingFaceEmbeddings
-from transformers import AutoTokenizer, AutoModel
+import multiprocessing
+from typing import List
+from concurrent.futures import ProcessPoolExecutor
+from langchain_core.embeddings import Embeddings
 
+# Local CPU encoders for hugging face models such as
+# ncbi/MedCPT-Article-Encoder. transformers / torch are only imported when an
+# encoder is built, and in the worker processes of the persistent pool. The
+# other models keep sentence-transformers and its own pooling, so the vectors
+# of their collections do not change, but run through
+# SentenceTransformerEmbeddings whose process pool is also started once.
 
-async def get_hf_encoder(hf_encoder_name: str = "default"):
+_MEDCPT_PREFIX = "ncbi/MedCPT-"
+
+
+def get_default_pooling(model_name: str):
+    # MedCPT uses the [CLS] embedding, mean pooling otherwise
+    return "cls" if model_name.startswith(_MEDCPT_PREFIX) else "mean"
+
+
+class _TorchEncoder:
+    # tokenizer + model of one process, shared by the in-process path and
+    # the pool workers
+    def __init__(self, model_name: str, max_length: int = 512,
+                 pooling: str = "cls", normalize: bool = False,
+                 quantize: bool = False, num_threads: int = None):
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.torch = torch
+        self.max_length = max_length
+        self.pooling = pooling
+        self.normalize = normalize
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = AutoModel.from_pretrained(model_name)
+        model.eval()
+        if quantize:
+            # int8 weights for the linear layers, activations stay float
+            model = torch.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model = model
+
+    def encode_token_ids(self, batch_token_ids) -> List[List[float]]:
+        # dynamic padding: the batch is padded to its longest sequence only
+        torch = self.torch
+        longest = max(len(token_ids) for token_ids in batch_token_ids)
+        input_ids = torch.full((len(batch_token_ids), longest),
+                               self.tokenizer.pad_token_id or 0,
+                               dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        for row, token_ids in enumerate(batch_token_ids):
+            input_ids[row, :len(token_ids)] = torch.tensor(token_ids)
+            attention_mask[row, :len(token_ids)] = 1
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        with torch.inference_mode():
+            hidden_states = self.model(**inputs).last_hidden_state
+            if self.pooling == "mean":
+                mask = inputs["attention_mask"].unsqueeze(-1).to(
+                    hidden_states.dtype)
+                embeddings = ((hidden_states * mask).sum(dim=1)
+                              / mask.sum(dim=1).clamp(min=1))
+            else:
+                embeddings = hidden_states[:, 0, :]
+            if self.normalize:
+                embeddings = torch.nn.functional.normalize(embeddings,
+                                                           dim=-1)
+        return embeddings.tolist()
+
+
+_worker_encoder = None
+
+
+def _initialize_worker(encoder_options):
+    global _worker_encoder
+    _worker_encoder = _TorchEncoder(**encoder_options)
+
+
+def _encode_in_worker(batch_token_ids):
+    return _worker_encoder.encode_token_ids(batch_token_ids)
+
+
+class LocalEncoderEmbeddings(Embeddings):
+    """
+    A langchain embeddings class running a hugging face encoder on the CPU.
+    Texts are tokenized once, sorted by token length and cut into batches so
+    that every batch is padded to its own longest text only, the model runs
+    under torch.inference_mode with a fixed number of intra-op threads, and
+    with num_workers > 1 the batches are spread over a pool of worker
+    processes that is created once and reused by every call.
+
+    Parameters
+    ==========
+    model_name: string
+        The hugging face model, e.g. ncbi/MedCPT-Article-Encoder
+    query_model_name: string
+        An optional separate model for queries, e.g. ncbi/MedCPT-Query-Encoder
+    batch_size: int
+        The number of texts per forward pass
+    max_length: int
+        The number of tokens texts are truncated to
+    num_workers: int
+        The number of worker processes, 1 runs the model in this process
+    num_threads: int
+        The intra-op threads per process, defaults to the cpu count divided
+        by the number of workers
+    quantize: bool
+        Apply dynamic int8 quantization to the linear layers
+    pooling: string
+        "cls" or "mean", defaults to "cls" for MedCPT and "mean" otherwise
+    normalize: bool
+        L2 normalize the embeddings
+    """
+
+    def __init__(
+        self,
+        model_name: str = "ncbi/MedCPT-Article-Encoder",
+        query_model_name: str = None,
+        batch_size: int = 32,
+        max_length: int = 512,
+        num_workers: int = 1,
+        num_threads: int = None,
+        quantize: bool = False,
+        pooling: str = None,
+        normalize: bool = False,
+    ):
+        self.model = model_name
+        self.query_model_name = query_model_name
+        self.batch_size = batch_size
+        self.num_workers = max(num_workers or 1, 1)
+        self.encoder_options = {
+            "model_name": model_name,
+            "max_length": max_length,
+            "pooling": pooling or get_default_pooling(model_name),
+            "normalize": normalize,
+            "quantize": quantize,
+            "num_threads": num_threads or max(
+                (os.cpu_count() or 1) // self.num_workers, 1),
+        }
+        self._tokenizer = None
+        self._encoder = None
+        self._query_encoder = None
+        self._pool = None
+
+    def __repr__(self):
+        return (f"LocalEncoderEmbeddings(model={self.model!r}, "
+                + f"num_workers={self.num_workers}, "
+                + f"quantize={self.encoder_options['quantize']})")
+
+    @property
+    def tokenizer(self):
+        # the parent only needs the tokenizer when the workers encode
+        if self._tokenizer is None:
+            from transformers import AutoTokenizer
+
+            self._tokenizer = AutoTokenizer.from_pretrained(self.model)
+        return self._tokenizer
+
+    @property
+    def encoder(self):
+        if self._encoder is None:
+            self._encoder = _TorchEncoder(**self.encoder_options)
+        return self._encoder
+
+    def _tokenize(self, texts: List[str], tokenizer=None):
+        # unpadded token ids, padding is done per batch
+        return (tokenizer or self.tokenizer)(
+            texts, truncation=True,
+            max_length=self.encoder_options["max_length"],
+            padding=False)["input_ids"]
+
+    def _get_pool(self):
+        if self._pool is None:
+            # spawn, forking a process that already initialized torch's
+            # thread pools can deadlock
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_initialize_worker,
+                initargs=(self.encoder_options,),
+            )
+        return self._pool
+
+    def _make_batches(self, texts: List[str]):
+        token_ids = self._tokenize(
+            texts,
+            tokenizer=(self.encoder.tokenizer if self.num_workers == 1
+                       else None))
+        order = sorted(range(len(texts)), key=lambda i: len(token_ids[i]))
+        return [
+            order[start:start + self.batch_size]
+            for start in range(0, len(order), self.batch_size)
+        ], token_ids
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        batches, token_ids = self._make_batches(texts)
+        batch_token_ids = [[token_ids[i] for i in batch] for batch in batches]
+        if self.num_workers > 1:
+            batch_embeddings = self._get_pool().map(_encode_in_worker,
+                                                    batch_token_ids)
+        else:
+            batch_embeddings = map(self.encoder.encode_token_ids,
+                                   batch_token_ids)
+
+        embeddings = [None] * len(texts)
+        for batch, vectors in zip(batches, batch_embeddings):
+            for i, vector in zip(batch, vectors):
+                embeddings[i] = vector
+        return embeddings
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.query_model_name is not None:
+            if self._query_encoder is None:
+                self._query_encoder = _TorchEncoder(**{
+                    **self.encoder_options,
+                    "model_name": self.query_model_name,
+                })
+            encoder = self._query_encoder
+            return encoder.encode_token_ids(
+                self._tokenize([text], tokenizer=encoder.tokenizer))[0]
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await asyncio.to_thread(self.embed_documents, texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await asyncio.to_thread(self.embed_query, text)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+class SentenceTransformerEmbeddings(Embeddings):
+    """
+    A langchain embeddings class running a sentence-transformers model on the
+    CPU, giving the same vectors as langchain's HuggingFaceEmbeddings. With
+    num_workers > 1 the texts are spread over a sentence-transformers process
+    pool that is started on the first call and reused by every later call,
+    rather than started and stopped for each call as with
+    HuggingFaceEmbeddings(multi_process=True).
+
+    Parameters
+    ==========
+    model_name: string
+        The hugging face model, e.g. sentence-transformers/all-mpnet-base-v2
+    batch_size: int
+        The number of texts per forward pass
+    num_workers: int
+        The number of worker processes, 1 runs the model in this process
+    normalize: bool
+        L2 normalize the embeddings
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        batch_size: int = 32,
+        num_workers: int = 1,
+        normalize: bool = False,
+    ):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.num_workers = max(num_workers or 1, 1)
+        self.normalize = normalize
+        self._model = None
+        self._pool = None
+
+    def __repr__(self):
+        return (f"SentenceTransformerEmbeddings(model={self.model_name!r}, "
+                + f"num_workers={self.num_workers})")
+
+    @property
+    def model(self):
+        if self._model is None:
+            from sentence_transformers import SentenceTransformer
+
+            self._model = SentenceTransformer(self.model_name, device="cpu")
+        return self._model
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = self.model.start_multi_process_pool(
+                target_devices=["cpu"] * self.num_workers)
+        return self._pool
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        texts = [text.replace("\n", " ") for text in texts]
+        if self.num_workers > 1:
+            embeddings = self.model.encode_multi_process(
+                texts, self._get_pool(), batch_size=self.batch_size)
+            if self.normalize:
+                import numpy as np
+
+                embeddings = embeddings / np.maximum(
+                    np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        else:
+            embeddings = self.model.encode(
+                texts, batch_size=self.batch_size,
+                normalize_embeddings=self.normalize)
+        return embeddings.tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        # a single text is not worth a round trip through the pool
+        return self.model.encode(
+            text.replace("\n", " "),
+            normalize_embeddings=self.normalize).tolist()
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await asyncio.to_thread(self.embed_documents, texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await asyncio.to_thread(self.embed_query, text)
+
+    def close(self):
+        if self._pool is not None:
+            from sentence_transformers import SentenceTransformer
+
+            SentenceTransformer.stop_multi_process_pool(self._pool)
+            self._pool = None
+
+
+async def get_hf_encoder(hf_encoder_name: str = "default", **encoder_options):
+    """
+    A method that returns a LocalEncoderEmbeddings for the MedCPT models,
+    "default" being ncbi/MedCPT-Article-Encoder, and a
+    SentenceTransformerEmbeddings for the other models. encoder_options are
+    passed to LocalEncoderEmbeddings (batch_size, num_workers, quantize ...),
+    SentenceTransformerEmbeddings only uses batch_size and num_workers.
+    """
     try:
         if hf_encoder_name == "default":
-            return AutoModel.from_pretrained("ncbi/MedCPT-Article-Encoder")
-        embedding_model = HuggingFaceEmbeddings(
-            model_name=hf_encoder_name,
-            multi_process=True,
-            model_kwargs={"device": "cpu"},
-            encode_kwargs={"normalize_embeddings": False},  # Set `True` for cosine similarity
-        )
+            hf_encoder_name = "ncbi/MedCPT-Article-Encoder"
+        if not hf_encoder_name.startswith(_MEDCPT_PREFIX):
+            embedding_model = SentenceTransformerEmbeddings(
+                model_name=hf_encoder_name,
+                batch_size=encoder_options.get("batch_size", 32),
+                num_workers=encoder_options.get("num_workers", 1),
+            )
+            await asyncio.to_thread(lambda: embedding_model.model)
+            return embedding_model
+        embedding_model = LocalEncoderEmbeddings(model_name=hf_encoder_name,
+                                                 **encoder_options)
+        # loads the model now rather than on the first batch
+        if embedding_model.num_workers > 1:
+            await asyncio.to_thread(lambda: embedding_model.tokenizer)
+        else:
+            await asyncio.to_thread(lambda: embedding_model.encoder)
         return embedding_model
     except Exception as ex:
         print("An error occurred while fetching hugging face encoder named "
@@ -20,33 +361,11 @@ async def get_hf_encoder(hf_encoder_name: str = "default"):
 
 
 # wanted_model_name = "ncbi/MedCPT-Article-Encoder"
-# embeddings =  asyncio.run(get_hf_encoder())
-# # # Type : <class 'langchain_huggingface.embeddings.huggingface.HuggingFaceEmbeddings'>
+# embeddings = asyncio.run(get_hf_encoder())
+# # # Type : <class 'hugging_face_encoders.LocalEncoderEmbeddings'>
 
 # print((f"\t\tembeddings : {embeddings}\n\t\tType : {type(embeddings)}"))
 # text = "This is a test document."
 # query_result = embeddings.embed_query(text)
-# print(f"query_result : {query_result[:5]}\nType : {type(query_result)}\nLength : {len(query_result)}")
+# print(f"query_result : {query_result[:5]}\nType : {type(query_result)}\nLength : {len(query_result)}")     # noqa E501
 # # # Type : <class 'list'>
-
-
-
-
-# # # Load model directly
-# # from transformers import AutoTokenizer, AutoModel
-
-# # tokenizer = AutoTokenizer.from_pretrained("ncbi/MedCPT-Article-Encoder")
-# # # # Type:<class 'transformers.models.bert.tokenization_bert_fast.BertTokenizerFast'>
-
-# # model = AutoModel.from_pretrained("ncbi/MedCPT-Article-Encoder")
-# # # Type:<class 'transformers.models.bert.modeling_bert.BertModel'>
-
-# # print(f"tokenizer : {tokenizer}\nType:{type(tokenizer)}\n\n\n")
-# # print(f"model : {model}\nType:{type(model)}")
-
-# # text = "This is a test document."
-# # inputs = tokenizer(text, return_tensors="pt")
-# # outputs = model(**inputs)
-# # print(f"outputs : {outputs}\nType : {type(outputs)}")
-# # # Type : <class 'transformers.modeling_outputs.BaseModelOutputWithPoolingAndCrossAttentions'>
-
@@ -1,70 +1,214 @@
 import os
+import re
 import time
 import asyncio
-from dotenv import load_dotenv
-from qdrant_client import QdrantClient
-from langchain_openai import OpenAIEmbeddings
-from hugging_face_encoders import get_hf_encoder
-from langchain_community.vectorstores import Qdrant
-from langchain_postgres.vectorstores import PGVector
-from langchain.indexes import SQLRecordManager, index
-from langchain_community.embeddings import OllamaEmbeddings
+import itertools
+import contextlib
+from embedding_cache import LocalEmbeddingCache
+from metrics import (
+    PipelineMetrics,
+    pipeline_metrics,
+    write_metrics,
+    record_file_reports,
+    InstrumentedEmbeddings,
+    InstrumentedRecordManager,
+    InstrumentedVectorStore,
+)
+from langchain_core.indexing import index
+from async_ingestion import pipelined_index
+from chunk_deduplication import ChunkRegistry, deduplicate_chunks
+from retrieval_service import get_retrieval_service, notify_collection_changed
 from utils import (
+    prefetch_documents,
+    tee_documents,
+    print_file_reports,
+    lazy_load_and_split_documents,
+    load_and_split_directory,
     load_document_data_from_file,
-    setup_langsmith_api_keys,
     get_config_variable,
 )
 
-setup_langsmith_api_keys()
+# Importing this module has no side effects: the embedding model and vector
+# store backends are imported inside initialize_vector_store, only for the
+# configured `embedding_model` / `vector_store`, and the entry points live in
+# cli.py.
+
+DEFAULT_DOCUMENT_PATH = "documents/cel_docs/second_additions/aug_28/"
+
+
+def get_embedding_scheduler_options():
+    return {
+        "base_url": get_config_variable(
+            parameter_name="embedding_base_url"),
+        "max_concurrent_requests": get_config_variable(
+            parameter_name="embedding_scheduler_max_concurrent_requests"),
+        "max_batch_tokens": get_config_variable(
+            parameter_name="embedding_scheduler_max_batch_tokens"),
+        "tokens_per_minute": get_config_variable(
+            parameter_name="embedding_scheduler_tokens_per_minute"),
+    }
+
+
+def get_hf_encoder_options():
+    return {
+        "batch_size": get_config_variable(
+            parameter_name="hf_encoder_batch_size"),
+        "max_length": get_config_variable(
+            parameter_name="hf_encoder_max_length"),
+        "num_workers": get_config_variable(
+            parameter_name="hf_encoder_num_workers"),
+        "num_threads": get_config_variable(
+            parameter_name="hf_encoder_num_threads"),
+        "quantize": get_config_variable(
+            parameter_name="hf_encoder_quantize") is True,
+    }
+
+
+_query_chunk_registries = {}
 
 
-load_dotenv()
-OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
+def get_retrieval_service_options(record_manager=None):
+    # the chunk registry of the namespace resolves the sources of the
+    # deduplicated texts, one registry connection per namespace
+    chunk_registry = None
+    if record_manager is not None and get_config_variable(
+            parameter_name="deduplicate_chunks") is True:
+        registry_key = (record_manager.namespace, get_config_variable(
+            parameter_name="chunk_registry_path"))
+        if registry_key not in _query_chunk_registries:
+            _query_chunk_registries[registry_key] = ChunkRegistry(
+                registry_key[0], database_path=registry_key[1])
+        chunk_registry = _query_chunk_registries[registry_key]
+    return {
+        "query_cache_size": get_config_variable(
+            parameter_name="retrieval_query_cache_size"),
+        "query_ttl_seconds": get_config_variable(
+            parameter_name="retrieval_query_cache_ttl_seconds"),
+        "result_cache_size": get_config_variable(
+            parameter_name="retrieval_result_cache_size"),
+        "result_ttl_seconds": get_config_variable(
+            parameter_name="retrieval_result_cache_ttl_seconds"),
+        "max_concurrent_searches": get_config_variable(
+            parameter_name="retrieval_max_concurrent_searches"),
+        # only openai embeds queries and documents the same way, the other
+        # models add query instructions or use a query encoder
+        "batch_query_embeddings": get_config_variable(
+            parameter_name="retrieval_batch_query_embeddings") is True
+        and get_config_variable(parameter_name="embedding_model") == "openai",
+        "chunk_registry": chunk_registry,
+    }
 
 
-async def initialize_vector_store(use_local_vector_store: bool = True):
+async def initialize_vector_store(use_local_vector_store: bool = True,
+                                  target: dict = None,
+                                  metrics: PipelineMetrics = None):
+    """Builds the embedding model, vector store and record manager from
+    config.json; the keys of target (embedding_model, dimension,
+    ollama_embedding_model_name, vector_store, collection_name,
+    record_manager_db_url, namespace) override the config ones, see
+    get_target_namespace for the namespace of a target. The embedding and
+    record manager calls are recorded by metrics, the global pipeline
+    metrics by default."""
+    def _get_variable(parameter_name):
+        if target and parameter_name in target:
+            return target[parameter_name]
+        return get_config_variable(parameter_name=parameter_name)
+
     try:
         print("\n\n-----> Index initialization <-----")
         # embedding model setup
-        embedding_model_type = get_config_variable(
-            parameter_name="embedding_model")
+        embedding_model_type = _get_variable("embedding_model")
+        use_embedding_scheduler = get_config_variable(
+            parameter_name="use_embedding_scheduler") is True
         if embedding_model_type == "openai":
-            dimensions = get_config_variable(parameter_name="dimension")
-            embedding_model = OpenAIEmbeddings(
-                model="text-embedding-3-large", dimensions=dimensions
-            )
+            dimensions = _get_variable("dimension")
+            if use_embedding_scheduler:
+                from embedding_scheduler import AsyncEmbeddingScheduler
+
+                embedding_model = AsyncEmbeddingScheduler(
+                    provider="openai",
+                    model="text-embedding-3-large",
+                    dimensions=dimensions,
+                    api_key=os.environ["OPENAI_API_KEY"],
+                    **get_embedding_scheduler_options(),
+                )
+            else:
+                from langchain_openai import OpenAIEmbeddings
+
+                embedding_model = OpenAIEmbeddings(
+                    model="text-embedding-3-large", dimensions=dimensions
+                )
         elif embedding_model_type == "ollama":
-            ollama_embedding_model_name = get_config_variable(
-                parameter_name="ollama_embedding_model_name"
-            )
-            dimensions = get_config_variable(parameter_name="dimension")
-            embedding_model = OllamaEmbeddings(
-                model=ollama_embedding_model_name)
+            ollama_embedding_model_name = _get_variable(
+                "ollama_embedding_model_name")
+            dimensions = _get_variable("dimension")
+            if use_embedding_scheduler:
+                from embedding_scheduler import AsyncEmbeddingScheduler
+
+                embedding_model = AsyncEmbeddingScheduler(
+                    provider="ollama",
+                    model=ollama_embedding_model_name,
+                    **get_embedding_scheduler_options(),
+                )
+            else:
+                from langchain_community.embeddings import OllamaEmbeddings
+
+                embedding_model = OllamaEmbeddings(
+                    model=ollama_embedding_model_name)
         elif embedding_model_type == "MedCPT-Article-Encoder":
+            from hugging_face_encoders import get_hf_encoder
+
             embedding_model = await get_hf_encoder(
-                hf_encoder_name="ncbi/MedCPT-Article-Encoder"
+                hf_encoder_name="ncbi/MedCPT-Article-Encoder",
+                **get_hf_encoder_options(),
+            )
+
+        # instrumented below the cache, so only real embedding calls count
+        embedding_model = InstrumentedEmbeddings(embedding_model,
+                                                 metrics=metrics)
+        if get_config_variable(parameter_name="use_embedding_cache") is True:
+            embedding_model = LocalEmbeddingCache(
+                embedding_model,
+                dimension=_get_variable("dimension"),
+                cache_path=get_config_variable(
+                    parameter_name="embedding_cache_path"),
+                max_entries=get_config_variable(
+                    parameter_name="embedding_cache_max_entries"),
             )
 
         # vector store setup
-        collection_name = get_config_variable(parameter_name="collection_name")
-        namespace = f"qdrant_store_local/{collection_name}"
+        collection_name = _get_variable("collection_name")
+        namespace = get_target_namespace(target)
 
-        vector_store_type = get_config_variable(parameter_name="vector_store")
+        vector_store_type = _get_variable("vector_store")
         if vector_store_type == "qdrant":
+            from qdrant_client import QdrantClient
+            from langchain_community.vectorstores import Qdrant
+
             if use_local_vector_store:
                 vector_store_url = os.environ["QDRANT_LOCAL_URL"]
-                qdrant_client = QdrantClient(url=vector_store_url, timeout=600)
+                client_options = {"url": vector_store_url, "timeout": 600}
             else:
                 vector_store_url = os.environ["QDRANT_CLOUD_URL_RIZZBUZZ"]
-                qdrant_client = QdrantClient(
-                    url=vector_store_url,
-                    api_key=os.environ["QDRANT_API_KEY_RIZZBUZZ"],
-                    timeout=600,
-                )
+                client_options = {
+                    "url": vector_store_url,
+                    "api_key": os.environ["QDRANT_API_KEY_RIZZBUZZ"],
+                    "timeout": 600,
+                }
+            # gRPC (port 6334) for the upserts and searches of the client
+            client_options["prefer_grpc"] = get_config_variable(
+                parameter_name="qdrant_prefer_grpc") is True
+            qdrant_client = QdrantClient(**client_options)
+            qdrant_async_client = None
+            if get_config_variable(parameter_name="async_ingestion") is True:
+                from qdrant_client import AsyncQdrantClient
+
+                qdrant_async_client = AsyncQdrantClient(**client_options)
             vectorstore = Qdrant(
                 client=qdrant_client,
                 collection_name=collection_name,
                 embeddings=embedding_model,
+                async_client=qdrant_async_client,
             )
             print(
                 "---> Qdrant vector store to be initialized : "
@@ -73,12 +217,35 @@ async def initialize_vector_store(use_local_vector_store: bool = True):
             print(f"---> vector_store_url: {vector_store_url}")
         elif vector_store_type == "pgvector":
             local_connection = os.environ["LOCAL_DATABASE_URL"]
-            vectorstore = PGVector(
-                embeddings=embedding_model,
-                collection_name=collection_name,
-                connection=local_connection,
-                use_jsonb=True,
-            )
+            if get_config_variable(
+                    parameter_name="pgvector_bulk_load") is True:
+                # COPY + merge writes, pooled connections, deferred index
+                from pgvector_bulk import BulkPGVector
+
+                vectorstore = BulkPGVector(
+                    embeddings=embedding_model,
+                    collection_name=collection_name,
+                    connection=local_connection,
+                    use_jsonb=True,
+                    dimension=_get_variable("dimension"),
+                    pool_size=get_config_variable(
+                        parameter_name="pgvector_pool_size"),
+                    vector_index=get_config_variable(
+                        parameter_name="pgvector_vector_index"),
+                    initial_load_threshold=get_config_variable(
+                        parameter_name="pgvector_initial_load_threshold"),
+                    index_options=get_config_variable(
+                        parameter_name="pgvector_index_options"),
+                )
+            else:
+                from langchain_postgres.vectorstores import PGVector
+
+                vectorstore = PGVector(
+                    embeddings=embedding_model,
+                    collection_name=collection_name,
+                    connection=local_connection,
+                    use_jsonb=True,
+                )
             print(
                 "---> PGvector vector store to be initialized : "
                 + f"{vectorstore}\n---> Type : {type(vectorstore)}"
@@ -89,12 +256,35 @@ async def initialize_vector_store(use_local_vector_store: bool = True):
             pass
 
         # record manager setup
-        record_manager_db_url = get_config_variable(
-            parameter_name="record_manager_db_url"
-        )
-        record_manager = SQLRecordManager(namespace,
-                                          db_url=record_manager_db_url)
+        record_manager_db_url = _get_variable("record_manager_db_url")
+        record_manager_backend = get_config_variable(
+            parameter_name="record_manager_backend")
+        if record_manager_backend == "bulk_sqlite":
+            from record_manager import BulkSQLiteRecordManager
+
+            record_manager = BulkSQLiteRecordManager.from_db_url(
+                namespace,
+                db_url=record_manager_db_url,
+                use_bloom_filter=get_config_variable(
+                    parameter_name="record_manager_use_bloom_filter") is True,
+            )
+        else:
+            from langchain.indexes import SQLRecordManager
+
+            record_manager = SQLRecordManager(namespace,
+                                              db_url=record_manager_db_url)
         record_manager.create_schema()
+        if record_manager_backend == "bulk_sqlite":
+            # an existing namespace switched from SQLRecordManager keeps its
+            # records instead of being indexed again
+            number_of_copied_records = \
+                record_manager.copy_from_sql_record_manager_if_empty()
+            if number_of_copied_records:
+                print(f"---> {number_of_copied_records} records of "
+                      + f"{namespace} copied from the SQLRecordManager table")
+        print(f"---> record manager backend: {record_manager_backend}")
+        record_manager = InstrumentedRecordManager(record_manager,
+                                                   metrics=metrics)
         print(f"---> collection name: {collection_name}")
         print(f"---> embedding_model: {embedding_model}")
         print(f"---> type: {type(embedding_model)}\n\n")
@@ -106,15 +296,65 @@ async def initialize_vector_store(use_local_vector_store: bool = True):
         )
 
 
-current_vector_store, current_record_manager = asyncio.run(
-    initialize_vector_store(use_local_vector_store=False)
-)
+async def initialize_local_replica(vectorstore):
+    """Builds an in-process read-only replica of the collection of the
+    vector store, from the configured local snapshot when there is one (no
+    network needed), from a scroll of the collection otherwise."""
+    try:
+        from local_replica import LocalVectorReplica
+
+        replica_options = {
+            "use_hnsw": get_config_variable(
+                parameter_name="local_replica_use_hnsw"),
+        }
+        snapshot_directory = get_config_variable(
+            parameter_name="local_replica_snapshot_directory")
+        if snapshot_directory:
+            replica = await asyncio.to_thread(
+                LocalVectorReplica.from_snapshot,
+                snapshot_directory,
+                vectorstore.embeddings,
+                client=vectorstore.client,
+                dtype=get_config_variable(
+                    parameter_name="local_replica_dtype"),
+                **replica_options,
+            )
+        else:
+            replica = await asyncio.to_thread(
+                LocalVectorReplica.from_collection,
+                vectorstore.client,
+                vectorstore.collection_name,
+                vectorstore.embeddings,
+                dtype=get_config_variable(
+                    parameter_name="local_replica_dtype"),
+                **replica_options,
+            )
+        print(f"---> local replica: {replica.get_statistics()}")
+        return replica
+    except Exception as ex:
+        print(
+            "Exception occurred while trying to initialize the local "
+            + f"replica.\nError: {ex}"
+        )
 
 
 async def load_and_split_documents(path):
     try:
+        if get_config_variable(
+                parameter_name="isolated_pdf_extraction") is True:
+            return await asyncio.to_thread(
+                lambda: list(lazy_load_and_split_documents(path=path)))
         returned_data = await load_document_data_from_file(
-            document_type="pdf", file_name="", multi_pdf=True, path=path
+            document_type="pdf",
+            file_name="",
+            multi_pdf=True,
+            path=path,
+            parallel=get_config_variable(
+                parameter_name="parallel_pdf_loading"),
+            max_workers=get_config_variable(
+                parameter_name="pdf_loader_max_workers"),
+            use_parse_manifest=get_config_variable(
+                parameter_name="use_parse_manifest"),
         )
         return returned_data
     except Exception as ex:
@@ -124,12 +364,45 @@ async def load_and_split_documents(path):
         )
 
 
+async def load_and_split_all_file_types(path):
+    # the pdf, markdown, text and csv files of the tree, each type with the
+    # pool size of `ingestion_pool_sizes`
+    try:
+        pool_sizes = get_config_variable(parameter_name="ingestion_pool_sizes")
+        documents, file_reports = await load_and_split_directory(
+            path=path,
+            pool_sizes=pool_sizes if isinstance(pool_sizes, dict) else None,
+            use_parse_manifest=get_config_variable(
+                parameter_name="use_parse_manifest") is True,
+        )
+        print_file_reports(file_reports)
+        record_file_reports(file_reports)
+        return documents
+    except Exception as ex:
+        print(
+            "Exception occurred while trying to load and split the files of "
+            + f"{path}.\nError: {ex}"
+        )
+
+
 async def _clear(vectorstore, record_manager):
     try:
         """Hacky helper method to clear content. See the `full` mode section
         to understand why it works."""
         index([], record_manager, vectorstore, cleanup="full",
               source_id_key="source")
+        if get_config_variable(parameter_name="deduplicate_chunks") is True:
+            # the registered canonical copies are gone with the collection
+            chunk_registry = ChunkRegistry(
+                record_manager.namespace,
+                database_path=get_config_variable(
+                    parameter_name="chunk_registry_path"),
+            )
+            try:
+                chunk_registry.clear()
+            finally:
+                chunk_registry.close()
+        notify_collection_changed(vectorstore)
         print(
             f"\n-->Vector store collection {vectorstore.collection_name} "
             + f"that uses the embedding model {vectorstore.embeddings.model}"
@@ -141,30 +414,180 @@ async def _clear(vectorstore, record_manager):
         )
 
 
-# asyncio.run(_clear(vectorstore = current_vector_store,
-#                    record_manager = current_record_manager))
+def print_embedding_cache_statistics(vectorstore):
+    embeddings = vectorstore.embeddings
+    if isinstance(embeddings, LocalEmbeddingCache):
+        print("---> embedding cache statistics: "
+              + f"{embeddings.get_statistics()}")
 
 
-async def index_loaded_and_splitted_documents(vectorstore, record_manager):
+async def stream_index_documents(vectorstore, record_manager, path,
+                                 batch_size: int = 100,
+                                 max_buffered_documents: int = 1000):
+    """Streams chunks from the loaders through the splitter into a single
+    `index()` run. `index()` consumes its source in batches of batch_size,
+    so peak memory is bounded by batch_size + max_buffered_documents
+    instead of the corpus size, and parsing the next pages overlaps with
+    embedding and upserting the current batch."""
     try:
         start_time = time.time()
-        document_path = "documents/cel_docs/second_additions/aug_28/"
-        loaded_and_splitted_documents = await load_and_split_documents(
-            path=document_path
+        documents = prefetch_documents(
+            lazy_load_and_split_documents(path=path),
+            max_buffered_documents=max_buffered_documents,
         )
+        with pipeline_metrics.measure_index_run() as index_run:
+            returned_index = await asyncio.to_thread(
+                index,
+                documents,
+                record_manager,
+                InstrumentedVectorStore(vectorstore),
+                batch_size=batch_size,
+                cleanup="incremental",
+                source_id_key="source",
+            )
+            index_run["result"] = returned_index
+        notify_collection_changed(vectorstore)
         print(
-            "Loading and splitting documents completed in: "
+            f"\n\nReturned_index: {returned_index}\nType: " + f"{type(returned_index)}"     # noqa E501
+        )
+        print(
+            "Streaming indexing completed in: "
             + f"{round(time.time()-start_time, 2)} seconds"
         )
-        return
+        print_embedding_cache_statistics(vectorstore)
+        return returned_index
+    except Exception as ex:
+        print(
+            "Exception occurred while trying to stream index documents.\n"
+            + f"Error: {ex}"
+        )
+
+
+async def _iterate_documents_in_thread(documents, batch_size: int = 100):
+    # an async iterator over a blocking one (e.g. a teed stream), so that
+    # waiting for the next documents does not block the event loop
+    iterator = iter(documents)
+    while True:
+        batch = await asyncio.to_thread(
+            lambda: list(itertools.islice(iterator, batch_size)))
+        if not batch:
+            return
+        for document in batch:
+            yield document
+
+
+async def index_documents_into_target(documents, vectorstore,
+                                      record_manager,
+                                      metrics: PipelineMetrics = None):
+    """
+    A method that runs the per target part of the ingestion: the chunk
+    deduplication, the pipelined (async_ingestion) or synchronous index()
+    run measured by the pipeline metrics, and the deferred vector index
+    build of the bulk pgvector store.
+
+    Parameters
+    ==========
+    documents: list or iterator of langchain documents
+        The chunks, an iterator (streaming) is indexed without the chunk
+        deduplication, which needs every chunk of the run
+    vectorstore, record_manager: from initialize_vector_store
+    metrics: PipelineMetrics
+        The metrics of the target, the global pipeline metrics by default
+
+    Returns
+    =======
+    returned_index: dictionary
+        The index() counts
+    """
+    metrics = metrics or pipeline_metrics
+    batch_size = get_config_variable(parameter_name="ingestion_batch_size")
+    chunk_registry = None
+    if get_config_variable(parameter_name="deduplicate_chunks") is True:
+        if isinstance(documents, list):
+            chunk_registry = ChunkRegistry(
+                record_manager.namespace,
+                database_path=get_config_variable(
+                    parameter_name="chunk_registry_path"),
+            )
+            run_sources = {document.metadata.get("source")
+                           for document in documents}
+            documents, chunk_assignments, deduplication_report = \
+                deduplicate_chunks(documents, chunk_registry,
+                                   metrics=metrics)
+            print(f"---> chunk deduplication: {deduplication_report}")
+        else:
+            print("---> chunk deduplication skipped, it needs the non "
+                  + "streaming ingestion")
+    try:
+        with metrics.measure_index_run() as index_run, \
+                get_bulk_load_context(vectorstore):
+            if get_config_variable(parameter_name="async_ingestion") is True:
+                if not isinstance(documents, list):
+                    documents = _iterate_documents_in_thread(documents,
+                                                             batch_size)
+                returned_index = await pipelined_index(
+                    documents,
+                    record_manager,
+                    vectorstore,
+                    batch_size=batch_size,
+                    max_concurrent_upserts=get_config_variable(
+                        parameter_name="async_max_concurrent_upserts"),
+                    upload_parallel=get_config_variable(
+                        parameter_name="qdrant_upload_parallel"),
+                    metrics=metrics,
+                )
+            else:
+                returned_index = await asyncio.to_thread(
+                    index,
+                    documents,
+                    record_manager,
+                    InstrumentedVectorStore(vectorstore, metrics),
+                    batch_size=batch_size,
+                    cleanup="incremental",
+                    source_id_key="source",
+                )
+            index_run["result"] = returned_index
+        if chunk_registry is not None:
+            # only once the canonical copies are indexed
+            chunk_registry.store_assignments(chunk_assignments, run_sources)
+        notify_collection_changed(vectorstore)
+    finally:
+        if chunk_registry is not None:
+            chunk_registry.close()
+    return returned_index
+
+
+async def index_loaded_and_splitted_documents(
+    vectorstore, record_manager, document_path: str = DEFAULT_DOCUMENT_PATH
+):
+    try:
         start_time = time.time()
-        returned_index = index(
-            loaded_and_splitted_documents,
-            record_manager,
-            vectorstore,
-            cleanup="incremental",
-            source_id_key="source",
+        if get_config_variable(parameter_name="streaming_ingestion") is True:
+            with get_bulk_load_context(vectorstore):
+                return await stream_index_documents(
+                    vectorstore,
+                    record_manager,
+                    path=document_path,
+                    batch_size=get_config_variable(
+                        parameter_name="ingestion_batch_size"),
+                    max_buffered_documents=get_config_variable(
+                        parameter_name="max_buffered_documents"),
+                )
+        if get_config_variable(
+                parameter_name="ingest_all_file_types") is True:
+            loaded_and_splitted_documents = \
+                await load_and_split_all_file_types(path=document_path)
+        else:
+            loaded_and_splitted_documents = await load_and_split_documents(
+                path=document_path
+            )
+        print(
+            "Loading and splitting documents completed in: "
+            + f"{round(time.time()-start_time, 2)} seconds"
         )
+        start_time = time.time()
+        returned_index = await index_documents_into_target(
+            loaded_and_splitted_documents, vectorstore, record_manager)
         print(
             f"\n\nReturned_index: {returned_index}\nType: " + f"{type(returned_index)}"     # noqa E501
         )
@@ -172,30 +595,212 @@ async def index_loaded_and_splitted_documents(vectorstore, record_manager):
             "Indexing and storing vectors completed in: "
             + f"{round(time.time()-start_time, 2)} seconds"
         )
+        print_embedding_cache_statistics(vectorstore)
+        return returned_index
     except Exception as ex:
         print(
             "Exception occurred while trying to index loaded and "
             + f"splitted documents.\nError: {ex}"
         )
+    finally:
+        write_metrics(
+            get_config_variable(parameter_name="metrics_output_directory"))
 
 
-asyncio.run(
-    index_loaded_and_splitted_documents(
-        vectorstore=current_vector_store, record_manager=current_record_manager
-    )
-)
-retriever_object = current_vector_store.as_retriever()
-print(f"\n\nretriever object: {retriever_object}\n" + f"Type: {type(retriever_object)}")        # noqa E501
+def get_bulk_load_context(vectorstore):
+    # the deferred vector index build of the bulk pgvector store around a
+    # load, nothing for the other stores
+    if hasattr(vectorstore, "deferred_index_build"):
+        return vectorstore.deferred_index_build()
+    return contextlib.nullcontext()
+
+
+def get_target_namespace(target: dict = None):
+    # the record manager namespace: the config.json store keeps its
+    # historical one, a fan-out target gets one per (vector store, embedding
+    # model, dimension, collection) so that two targets sharing a collection
+    # name and a record manager database do not share their keys
+    def _get_variable(parameter_name):
+        if target and parameter_name in target:
+            return target[parameter_name]
+        return get_config_variable(parameter_name=parameter_name)
+
+    if target and target.get("namespace"):
+        return target["namespace"]
+    collection_name = _get_variable("collection_name")
+    if target is None:
+        return f"qdrant_store_local/{collection_name}"
+    embedding_model = _get_variable("embedding_model")
+    if embedding_model == "ollama":
+        embedding_model += ":" + _get_variable("ollama_embedding_model_name")
+    return "/".join(str(part) for part in (
+        _get_variable("vector_store"), embedding_model,
+        _get_variable("dimension"), collection_name))
+
+
+def get_target_name(target: dict):
+    return target.get("name") or "/".join(
+        str(target.get(parameter_name) or get_config_variable(
+            parameter_name=parameter_name))
+        for parameter_name in ("embedding_model", "vector_store",
+                               "collection_name"))
+
 
+async def fan_out_index_documents(targets, document_path: str =
+                                  DEFAULT_DOCUMENT_PATH,
+                                  use_local_vector_store: bool = True):
+    """
+    A method that loads and splits the documents once and indexes them into
+    several (embedding model, dimension, vector store, collection, record
+    manager namespace) targets at the same time, every target through
+    index_documents_into_target with its own record manager and its own
+    PipelineMetrics, written under metrics_output_directory/targets.
 
-async def ask_index_similarity_search(query: str = ""):
+    Parameters
+    ==========
+    targets: list of dictionaries
+        The config.json overrides of every target, see
+        initialize_vector_store; `name` labels the target in the reports
+    document_path: string
+        The document directory
+
+    Returns
+    =======
+    results: dictionary
+        The index() result, or the error, of every target
+    """
     try:
-        # similarity search
-        results = current_vector_store.similarity_search(query)
+        start_time = time.time()
+        namespaces = [get_target_namespace(target) for target in targets]
+        duplicates = sorted({namespace for namespace in namespaces
+                             if namespaces.count(namespace) > 1})
+        if duplicates:
+            raise ValueError("several targets share the record manager "
+                             + f"namespaces {duplicates}, give them a "
+                             + "distinct `namespace`")
+        initialized_targets = []
+        target_metrics = {}
+        results = {}
+        for target in targets:
+            # the targets run concurrently, the stage times of one must not
+            # include the calls of the others
+            metrics = PipelineMetrics()
+            initialized = await initialize_vector_store(
+                use_local_vector_store=use_local_vector_store, target=target,
+                metrics=metrics)
+            if initialized is None:
+                results[get_target_name(target)] = {
+                    "error": "initialization failed"}
+            else:
+                initialized_targets.append(
+                    (get_target_name(target), *initialized))
+                target_metrics[get_target_name(target)] = metrics
+        if not initialized_targets:
+            return results
+
+        if get_config_variable(parameter_name="streaming_ingestion") is True:
+            # one parse, teed into a bounded queue per target
+            document_streams = tee_documents(
+                lazy_load_and_split_documents(path=document_path),
+                len(initialized_targets),
+                max_buffered_documents=get_config_variable(
+                    parameter_name="max_buffered_documents"),
+            )
+        else:
+            if get_config_variable(
+                    parameter_name="ingest_all_file_types") is True:
+                documents = await load_and_split_all_file_types(
+                    path=document_path)
+            else:
+                documents = await load_and_split_documents(
+                    path=document_path)
+            print(
+                "Loading and splitting documents completed in: "
+                + f"{round(time.time()-start_time, 2)} seconds"
+            )
+            document_streams = [documents] * len(initialized_targets)
+
+        async def _index_target(documents, record_manager, vectorstore,
+                                metrics):
+            try:
+                return await index_documents_into_target(
+                    documents, vectorstore, record_manager, metrics=metrics)
+            finally:
+                if hasattr(documents, "close"):
+                    documents.close()
+
+        target_results = await asyncio.gather(
+            *[
+                _index_target(documents, record_manager, vectorstore,
+                              target_metrics[name])
+                for (name, vectorstore, record_manager), documents
+                in zip(initialized_targets, document_streams)
+            ],
+            return_exceptions=True,
+        )
+        for (name, _, _), result in zip(initialized_targets,
+                                        target_results):
+            if isinstance(result, Exception):
+                results[name] = {"error": str(result)}
+            else:
+                results[name] = result
+            print(f"---> {name}: {results[name]}")
+        for name, metrics in target_metrics.items():
+            write_metrics(
+                os.path.join(
+                    get_config_variable(
+                        parameter_name="metrics_output_directory"),
+                    "targets", re.sub(r"[^\w.-]+", "_", name)),
+                metrics)
+        print(
+            f"Fan-out indexing into {len(initialized_targets)} targets "
+            + f"completed in: {round(time.time()-start_time, 2)} seconds"
+        )
+        return results
+    except Exception as ex:
+        print(
+            "Exception occurred while trying to fan out the indexing.\n"
+            + f"Error: {ex}"
+        )
+    finally:
+        write_metrics(
+            get_config_variable(parameter_name="metrics_output_directory"))
+
+
+async def ask_index_similarity_search(vectorstore, query: str = "",
+                                      k: int = 4, record_manager=None):
+    try:
+        # similarity search through the caching retrieval service
+        retrieval_service = get_retrieval_service(
+            vectorstore, **get_retrieval_service_options(record_manager))
+        results = await retrieval_service.search(query, k=k)
         print(f"similarity search results: {results}\n" + f"Type: {type(results)}\n\n")     # noqa E501
+        print(f"---> latency: {retrieval_service.get_latency_report()}")
+        return results
+    except Exception as ex:
+        print(f"Exception occurred while trying to ask index.\nError: {ex}")
+
+
+async def ask_index_batch_similarity_search(vectorstore, queries, k: int = 4,
+                                            record_manager=None):
+    try:
+        # the queries are embedded together and searched concurrently
+        retrieval_service = get_retrieval_service(
+            vectorstore, **get_retrieval_service_options(record_manager))
+        results = await retrieval_service.search_batch(queries, k=k)
+        for query, documents in zip(queries, results):
+            print(f"query: {query}\nsimilarity search results: {documents}\n\n")     # noqa E501
+        print(f"---> latency: {retrieval_service.get_latency_report()}")
+        return results
     except Exception as ex:
         print(f"Exception occurred while trying to ask index.\nError: {ex}")
 
 
 # query='The multiple myeloma (MM) cell line MM1.R was purchased from?'
-# asyncio.run(ask_index_similarity_search(query))
+# python cli.py query "$query" ["$another_query" ...]
+
+
+if __name__ == "__main__":
+    from cli import main
+
+    main(["ingest"])
@@ -0,0 +1,466 @@
+import time
+import numpy as np
+from typing import List, Optional
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+from collection_snapshot import (
+    load_collection_snapshot,
+    iterate_snapshot_ids,
+    iterate_snapshot_payloads,
+)
+from utils import iterate_collection_pages
+
+# A read-only, in-process copy of a qdrant collection. The vectors live in
+# one contiguous float32 / float16 array searched by vectorized numpy
+# (exact), or for large collections in a faiss HNSW graph (approximate).
+# The replica is built from a collection scroll or from a local snapshot
+# (collection_snapshot.py) and refreshed incrementally from the collection:
+# the rows of removed points become tombstones, reused by new points in the
+# exact search and skipped in the HNSW one (whose graph only grows), and the
+# rows are compacted once there are more than max_tombstones of them.
+
+# rows scored per matrix product, bounds the float32 copy of float16 blocks
+_SEARCH_BLOCK_ROWS = 65536
+
+
+class LocalVectorReplica(VectorStore):
+    """
+    A langchain vector store answering similarity_search style queries from
+    memory, without a network round trip per query.
+
+    Parameters
+    ==========
+    embeddings: langchain embeddings
+        The model the collection was embedded with, used to embed queries
+    ids: list
+        The point id of every row
+    vectors: numpy array
+        The (count x dimension) vectors, float32 or float16
+    payloads: list of dictionaries
+        The point payloads, with the langchain page_content / metadata keys
+    distance: string
+        The qdrant distance of the collection, "Cosine", "Dot" or "Euclid"
+    use_hnsw: bool
+        Search a faiss HNSW graph instead of the exact numpy search, None
+        uses it from hnsw_threshold vectors on when faiss is installed
+    max_tombstones: int
+        The number of rows of removed points kept before refresh() compacts
+        the rows (and rebuilds the HNSW graph)
+    """
+
+    def __init__(
+        self,
+        embeddings,
+        ids: list,
+        vectors: np.ndarray,
+        payloads: List[dict],
+        distance: str = "Cosine",
+        collection_name: str = None,
+        client=None,
+        vector_name: str = None,
+        use_hnsw: Optional[bool] = None,
+        hnsw_threshold: int = 200_000,
+        hnsw_neighbors: int = 32,
+        hnsw_ef_search: int = 128,
+        max_tombstones: int = 1000,
+        content_payload_key: str = "page_content",
+        metadata_payload_key: str = "metadata",
+    ):
+        self._embeddings = embeddings
+        self.distance = distance
+        self.collection_name = collection_name
+        self.client = client
+        self.vector_name = vector_name
+        self.content_payload_key = content_payload_key
+        self.metadata_payload_key = metadata_payload_key
+        self.hnsw_threshold = hnsw_threshold
+        self.hnsw_neighbors = hnsw_neighbors
+        self.hnsw_ef_search = hnsw_ef_search
+        self.max_tombstones = max_tombstones
+        self.use_hnsw = use_hnsw
+        self.hnsw_index = None
+        self._set_rows(list(ids), vectors, list(payloads))
+
+    @property
+    def embeddings(self):
+        return self._embeddings
+
+    def _prepare_vectors(self, vectors):
+        vectors = np.ascontiguousarray(vectors)
+        if self.distance == "Cosine":
+            # qdrant stores cosine vectors normalized, snapshots and
+            # scrolls return them so; normalizing again keeps it exact
+            norms = np.linalg.norm(vectors.astype(np.float32), axis=1,
+                                   keepdims=True)
+            vectors = (vectors / np.maximum(norms, 1e-12)).astype(
+                vectors.dtype)
+        return vectors
+
+    def _get_squared_norms(self, vectors):
+        vectors = vectors.astype(np.float32)
+        return np.einsum("ij,ij->i", vectors, vectors)
+
+    def _set_rows(self, ids, vectors, payloads):
+        # the row buffers grow geometrically, self.vectors, self._live and
+        # self.squared_norms are views of their first len(self.ids) rows
+        self.ids = ids
+        self.payloads = payloads
+        self.row_by_id = {point_id: row for row, point_id in enumerate(ids)}
+        self._free_rows = []
+        self._vector_buffer = self._prepare_vectors(vectors)
+        self._live_buffer = np.ones(len(ids), dtype=bool)
+        self._squared_norm_buffer = None
+        if self.distance == "Euclid":
+            self._squared_norm_buffer = self._get_squared_norms(
+                self._vector_buffer)
+        self._set_views()
+        self._build_hnsw_index()
+
+    def _set_views(self):
+        number_of_rows = len(self.ids)
+        self.vectors = self._vector_buffer[:number_of_rows]
+        self._live = self._live_buffer[:number_of_rows]
+        self.squared_norms = None if self._squared_norm_buffer is None \
+            else self._squared_norm_buffer[:number_of_rows]
+
+    def _reserve(self, number_of_rows):
+        capacity = len(self._vector_buffer)
+        if number_of_rows <= capacity:
+            return
+        capacity = max(number_of_rows, capacity * 3 // 2)
+
+        def _grow(buffer):
+            grown = np.zeros((capacity, *buffer.shape[1:]),
+                             dtype=buffer.dtype)
+            grown[:len(self.ids)] = buffer[:len(self.ids)]
+            return grown
+
+        self._vector_buffer = _grow(self._vector_buffer)
+        self._live_buffer = _grow(self._live_buffer)
+        if self._squared_norm_buffer is not None:
+            self._squared_norm_buffer = _grow(self._squared_norm_buffer)
+
+    def _add_points(self, ids, vectors, payloads):
+        # new points take the rows of removed ones in the exact search, the
+        # HNSW graph cannot replace a node so they are appended there
+        vectors = self._prepare_vectors(
+            np.asarray(vectors, dtype=self.vectors.dtype))
+        reused_rows = [] if self.hnsw_index is not None else [
+            self._free_rows.pop()
+            for _ in range(min(len(self._free_rows), len(ids)))]
+        first_new_row = len(self.ids)
+        number_of_new_rows = len(ids) - len(reused_rows)
+        self._reserve(first_new_row + number_of_new_rows)
+        self.ids.extend([None] * number_of_new_rows)
+        self.payloads.extend([None] * number_of_new_rows)
+        self._set_views()
+        rows = reused_rows + list(range(first_new_row,
+                                        first_new_row + number_of_new_rows))
+        self.vectors[rows] = vectors
+        self._live[rows] = True
+        if self.squared_norms is not None:
+            self.squared_norms[rows] = self._get_squared_norms(vectors)
+        for row, point_id, payload in zip(rows, ids, payloads):
+            self.ids[row] = point_id
+            self.payloads[row] = payload
+            self.row_by_id[point_id] = row
+        if self.hnsw_index is not None:
+            # the labels of the graph are the rows, appended in order
+            self.hnsw_index.add(vectors.astype(np.float32))
+
+    def _remove_rows(self, rows):
+        for row in rows:
+            del self.row_by_id[self.ids[row]]
+            self.ids[row] = None
+            self.payloads[row] = None
+        self._live[rows] = False
+        self._free_rows.extend(rows)
+
+    def _compact(self):
+        rows = np.flatnonzero(self._live)
+        self._set_rows([self.ids[row] for row in rows], self.vectors[rows],
+                       [self.payloads[row] for row in rows])
+
+    def _should_use_hnsw(self):
+        if self.use_hnsw is not None:
+            return self.use_hnsw
+        if len(self.row_by_id) < self.hnsw_threshold:
+            return False
+        try:
+            import faiss  # noqa F401
+            return True
+        except ImportError:
+            return False
+
+    def _build_hnsw_index(self):
+        self.hnsw_index = None
+        if not self._should_use_hnsw() or len(self.ids) == 0:
+            return
+        import faiss
+
+        dimension = self.vectors.shape[1]
+        metric = (faiss.METRIC_L2 if self.distance == "Euclid"
+                  else faiss.METRIC_INNER_PRODUCT)
+        if self.vectors.dtype == np.float16:
+            # keeps the graph's vector storage at 2 bytes per dimension
+            index = faiss.IndexHNSWSQ(dimension,
+                                      faiss.ScalarQuantizer.QT_fp16,
+                                      self.hnsw_neighbors, metric)
+            index.train(self.vectors.astype(np.float32))
+        else:
+            index = faiss.IndexHNSWFlat(dimension, self.hnsw_neighbors,
+                                        metric)
+        index.hnsw.efSearch = self.hnsw_ef_search
+        for start in range(0, len(self.ids), _SEARCH_BLOCK_ROWS):
+            index.add(self.vectors[start:start + _SEARCH_BLOCK_ROWS]
+                      .astype(np.float32))
+        self.hnsw_index = index
+
+    @classmethod
+    def from_collection(
+        cls,
+        client,
+        collection_name: str,
+        embeddings,
+        dtype: str = "float32",
+        page_size: int = 1000,
+        vector_name: str = None,
+        **replica_options,
+    ):
+        # builds the replica from a scroll of the collection
+        start_time = time.time()
+        vectors_config = client.get_collection(
+            collection_name).config.params.vectors
+        if isinstance(vectors_config, dict):
+            vectors_config = vectors_config[vector_name]
+        ids, payloads, vector_pages = [], [], []
+        for points, _ in iterate_collection_pages(
+            client, collection_name, page_size=page_size, with_payload=True,
+            with_vectors=[vector_name] if vector_name else True,
+        ):
+            if not points:
+                continue
+            ids.extend(point.id for point in points)
+            payloads.extend(point.payload or {} for point in points)
+            vector_pages.append(np.asarray(
+                [point.vector[vector_name] if vector_name else point.vector
+                 for point in points], dtype=dtype))
+        vectors = (np.concatenate(vector_pages) if vector_pages
+                   else np.zeros((0, vectors_config.size), dtype=dtype))
+        replica = cls(embeddings, ids, vectors, payloads,
+                      distance=vectors_config.distance.value,
+                      collection_name=collection_name, client=client,
+                      vector_name=vector_name, **replica_options)
+        print(f"---> replica of {collection_name} built from a scroll: "
+              + f"{len(ids)} points in {round(time.time()-start_time, 2)} "
+              + "seconds")
+        return replica
+
+    @classmethod
+    def from_snapshot(cls, snapshot_directory: str, embeddings, client=None,
+                      dtype: str = None, **replica_options):
+        # builds the replica from a local snapshot, without any network call
+        start_time = time.time()
+        manifest, vectors = load_collection_snapshot(snapshot_directory)
+        vectors = np.array(vectors, dtype=dtype or manifest["dtype"])
+        replica = cls(
+            embeddings,
+            list(iterate_snapshot_ids(snapshot_directory)),
+            vectors,
+            list(iterate_snapshot_payloads(snapshot_directory, manifest)),
+            distance=manifest["distance"],
+            collection_name=manifest["collection_name"],
+            client=client,
+            vector_name=manifest["vector_name"],
+            **replica_options,
+        )
+        print(f"---> replica of {manifest['collection_name']} loaded from "
+              + f"{snapshot_directory}: {manifest['count']} points in "
+              + f"{round(time.time()-start_time, 2)} seconds")
+        return replica
+
+    def refresh(self, client=None, page_size: int = 1000):
+        """
+        A method that brings the replica up to date with the collection by
+        id difference: the ids of the collection are scrolled without
+        vectors or payloads, the new points are retrieved and added, the
+        rows of the removed ones become tombstones. Only the changed rows
+        are written, the other rows and the HNSW graph are kept. index()
+        derives the point ids from the content of the chunks, so a changed
+        chunk is a removed id and a new one.
+
+        Returns
+        =======
+        added, removed: int, int
+            The number of points added to and removed from the replica
+        """
+        client = client or self.client
+        if client is None:
+            raise ValueError("refresh needs the qdrant client of the "
+                             + "collection")
+        current_ids = []
+        for points, _ in iterate_collection_pages(
+            client, self.collection_name, page_size=page_size,
+            with_payload=False, with_vectors=False,
+        ):
+            current_ids.extend(point.id for point in points)
+        current_id_set = set(current_ids)
+        removed_rows = [row for point_id, row in self.row_by_id.items()
+                        if point_id not in current_id_set]
+        new_ids = [point_id for point_id in current_ids
+                   if point_id not in self.row_by_id]
+        if not removed_rows and not new_ids:
+            return 0, 0
+
+        self._remove_rows(removed_rows)
+        for start in range(0, len(new_ids), page_size):
+            points = client.retrieve(
+                self.collection_name, ids=new_ids[start:start + page_size],
+                with_payload=True,
+                with_vectors=[self.vector_name] if self.vector_name else True,
+            )
+            if not points:
+                continue
+            self._add_points(
+                [point.id for point in points],
+                [point.vector[self.vector_name] if self.vector_name
+                 else point.vector for point in points],
+                [point.payload or {} for point in points],
+            )
+        if len(self._free_rows) > self.max_tombstones \
+                or (self.hnsw_index is None and self._should_use_hnsw()):
+            self._compact()
+        print(f"---> replica refreshed: {len(new_ids)} added, "
+              + f"{len(removed_rows)} removed")
+        return len(new_ids), len(removed_rows)
+
+    def _to_document(self, row):
+        payload = self.payloads[row]
+        return Document(
+            page_content=payload.get(self.content_payload_key) or "",
+            metadata=payload.get(self.metadata_payload_key) or {},
+        )
+
+    def _filter_rows(self, filter: dict):
+        # exact match on metadata fields, e.g. {"source": "a.pdf"}
+        return np.fromiter(
+            (row for row, payload in enumerate(self.payloads)
+             if payload is not None
+             and all((payload.get(self.metadata_payload_key) or {}).get(key)
+                     == value for key, value in filter.items())),
+            dtype=np.int64,
+        )
+
+    def _prepare_queries(self, query_vectors):
+        queries = np.asarray(query_vectors, dtype=np.float32)
+        if self.distance == "Cosine":
+            queries = queries / np.maximum(
+                np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        return queries
+
+    def _exact_search(self, queries, k, rows=None):
+        # scores every (candidate) row block by block, keeping the k best
+        number_of_rows = len(self.ids) if rows is None else len(rows)
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, number_of_rows, _SEARCH_BLOCK_ROWS):
+            block_rows = (np.arange(start, min(start + _SEARCH_BLOCK_ROWS,
+                                               number_of_rows))
+                          if rows is None
+                          else rows[start:start + _SEARCH_BLOCK_ROWS])
+            block = (self.vectors[start:start + _SEARCH_BLOCK_ROWS]
+                     if rows is None else self.vectors[block_rows])
+            scores = queries @ block.astype(np.float32, copy=False).T
+            if self._free_rows:
+                # the rows of removed points are never returned
+                scores[:, ~self._live[block_rows]] = -np.inf
+            if self.distance == "Euclid":
+                # the negated squared distance, up to the query norm
+                scores = 2 * scores - self.squared_norms[block_rows]
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            best_rows = np.concatenate(
+                [best_rows, np.broadcast_to(block_rows, scores.shape)],
+                axis=1)
+            if best_scores.shape[1] > k:
+                top = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_scores = np.take_along_axis(best_scores, top, axis=1)
+                best_rows = np.take_along_axis(best_rows, top, axis=1)
+        order = np.argsort(-best_scores, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        if self.distance == "Euclid":
+            best_scores = np.sqrt(np.maximum(
+                (queries * queries).sum(axis=1, keepdims=True)
+                - best_scores, 0))
+        return best_scores, best_rows
+
+    def search_vectors(self, query_vectors, k: int = 4, filter=None):
+        """
+        A method that returns, for every query vector, the (document, score)
+        pairs of its k nearest rows, the score being the qdrant one
+        (similarity for Cosine / Dot, distance for Euclid).
+        """
+        if not self.row_by_id:
+            return [[] for _ in query_vectors]
+        queries = self._prepare_queries(query_vectors)
+        k = min(k, len(self.row_by_id))
+        if filter:
+            rows = self._filter_rows(filter)
+            k = min(k, len(rows))
+            if k == 0:
+                return [[] for _ in query_vectors]
+            scores, rows = self._exact_search(queries, k, rows)
+        elif self.hnsw_index is not None:
+            # the tombstones can be among the nearest rows
+            scores, rows = self.hnsw_index.search(
+                queries, k + len(self._free_rows))
+            if self.distance == "Euclid":
+                scores = np.sqrt(np.maximum(scores, 0))
+        else:
+            scores, rows = self._exact_search(queries, k)
+        return [
+            [(self._to_document(row), float(score))
+             for score, row in zip(query_scores, query_rows)
+             if row >= 0 and self._live[row]][:k]
+            for query_scores, query_rows in zip(scores, rows)
+        ]
+
+    def similarity_search_with_score_by_vector(self, embedding, k: int = 4,
+                                               filter=None, **kwargs):
+        return self.search_vectors([embedding], k=k, filter=filter)[0]
+
+    def similarity_search_by_vector(self, embedding, k: int = 4, filter=None,
+                                    **kwargs):
+        return [document for document, _ in
+                self.similarity_search_with_score_by_vector(
+                    embedding, k=k, filter=filter)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4,
+                                     filter=None, **kwargs):
+        return self.similarity_search_with_score_by_vector(
+            self.embeddings.embed_query(query), k=k, filter=filter)
+
+    def similarity_search(self, query: str, k: int = 4, filter=None,
+                          **kwargs):
+        return [document for document, _ in
+                self.similarity_search_with_score(query, k=k, filter=filter)]
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError("LocalVectorReplica is read-only, index "
+                                  + "into the collection and refresh()")
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError("Build the replica with from_collection "
+                                  + "or from_snapshot")
+
+    def get_statistics(self):
+        return {
+            "points": len(self.row_by_id),
+            "tombstones": len(self._free_rows),
+            "dimension": int(self.vectors.shape[1]) if self.vectors.ndim == 2
+            else None,
+            "dtype": str(self.vectors.dtype),
+            "vector_megabytes": round(self.vectors.nbytes / 2**20, 1),
+            "search": "hnsw" if self.hnsw_index is not None else "exact",
+        }
@@ -0,0 +1,342 @@
+import os
+import json
+import time
+import bisect
+import threading
+from typing import List
+from contextlib import contextmanager
+from langchain_core.embeddings import Embeddings
+from langchain_core.indexing import RecordManager
+from langchain_core.vectorstores import VectorStore
+from embedding_cache import get_embedding_model_name
+
+# Counters and latency histograms for the indexing pipeline stages (pdf
+# parsing, splitting, embedding, vector store writes, record manager
+# bookkeeping), exportable as json and as a prometheus text file. Recording
+# a value is a lock plus a dictionary update, cheap enough to stay enabled.
+
+LATENCY_BUCKETS_SECONDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30,
+                           60, 300)
+
+
+class PipelineMetrics:
+    def __init__(self, prefix: str = "indexing"):
+        self.prefix = prefix
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = {
+                    "bucket_counts": [0] * (len(LATENCY_BUCKETS_SECONDS) + 1),
+                    "count": 0,
+                    "sum": 0.0,
+                }
+                self.histograms[stage] = histogram
+            histogram["bucket_counts"][
+                bisect.bisect_left(LATENCY_BUCKETS_SECONDS, seconds)] += 1
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+
+    @contextmanager
+    def time_stage(self, stage: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start_time)
+
+    def get_stage_seconds(self, stage: str):
+        histogram = self.histograms.get(stage)
+        return histogram["sum"] if histogram else 0.0
+
+    @contextmanager
+    def measure_index_run(self):
+        """Times an index() call; store its result under "result" in the
+        yielded dictionary. index() reports its counts, the vector store
+        write time is recorded where the writes happen, by
+        InstrumentedVectorStore or the pipelined writer."""
+        index_run = {}
+        with self.time_stage("index"):
+            yield index_run
+        indexing_result = index_run.get("result")
+        if indexing_result:
+            self.increment("upserted_points",
+                           indexing_result["num_added"]
+                           + indexing_result["num_updated"])
+            self.increment("skipped_documents",
+                           indexing_result["num_skipped"])
+            self.increment("deleted_documents",
+                           indexing_result["num_deleted"])
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "stages": {
+                    stage: {
+                        "count": histogram["count"],
+                        "sum_seconds": round(histogram["sum"], 6),
+                        "buckets": {
+                            str(bound): count
+                            for bound, count in zip(
+                                list(LATENCY_BUCKETS_SECONDS) + ["+Inf"],
+                                histogram["bucket_counts"])
+                        },
+                    }
+                    for stage, histogram in self.histograms.items()
+                },
+            }
+
+    def write_json(self, file_path: str):
+        with open(file_path, "w") as json_file:
+            json.dump(self.to_dict(), json_file, indent=4)
+
+    def to_prometheus(self):
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                metric_name = f"{self.prefix}_{name}_total"
+                lines.append(f"# TYPE {metric_name} counter")
+                lines.append(f"{metric_name} {value}")
+            metric_name = f"{self.prefix}_stage_duration_seconds"
+            if self.histograms:
+                lines.append(f"# TYPE {metric_name} histogram")
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative_count = 0
+                for bound, count in zip(
+                        list(LATENCY_BUCKETS_SECONDS) + ["+Inf"],
+                        histogram["bucket_counts"]):
+                    cumulative_count += count
+                    lines.append(f'{metric_name}_bucket{{stage="{stage}",'
+                                 + f'le="{bound}"}} {cumulative_count}')
+                lines.append(f'{metric_name}_sum{{stage="{stage}"}} '
+                             + f'{histogram["sum"]}')
+                lines.append(f'{metric_name}_count{{stage="{stage}"}} '
+                             + f'{histogram["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, file_path: str):
+        with open(file_path, "w") as prometheus_file:
+            prometheus_file.write(self.to_prometheus())
+
+
+pipeline_metrics = PipelineMetrics()
+
+
+def estimate_tokens(text: str):
+    # ~4 characters per token, tokenizing every chunk would cost more than
+    # the measurement is worth
+    return len(text) // 4 + 1
+
+
+class InstrumentedEmbeddings(Embeddings):
+    """An embedding model wrapper recording texts, estimated tokens and the
+    latency of every embedding call."""
+
+    def __init__(self, embeddings, metrics: PipelineMetrics = None):
+        self.embeddings = embeddings
+        self.model = get_embedding_model_name(embeddings)
+        self.metrics = metrics or pipeline_metrics
+
+    def __repr__(self):
+        return f"InstrumentedEmbeddings({self.embeddings!r})"
+
+    def _record(self, texts):
+        self.metrics.increment("embedding_calls")
+        self.metrics.increment("embedded_texts", len(texts))
+        self.metrics.increment("embedding_tokens_estimated",
+                               sum(estimate_tokens(text) for text in texts))
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self._record(texts)
+        with self.metrics.time_stage("embedding"):
+            return self.embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        self._record(texts)
+        with self.metrics.time_stage("embedding"):
+            return await self.embeddings.aembed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        with self.metrics.time_stage("query_embedding"):
+            return self.embeddings.embed_query(text)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        with self.metrics.time_stage("query_embedding"):
+            return await self.embeddings.aembed_query(text)
+
+
+class InstrumentedRecordManager(RecordManager):
+    """A record manager wrapper timing every bookkeeping call under the
+    record_manager stage."""
+
+    def __init__(self, record_manager, metrics: PipelineMetrics = None):
+        super().__init__(namespace=record_manager.namespace)
+        self.record_manager = record_manager
+        self.metrics = metrics or pipeline_metrics
+
+    def create_schema(self):
+        return self.record_manager.create_schema()
+
+    async def acreate_schema(self):
+        return await self.record_manager.acreate_schema()
+
+    def get_time(self):
+        with self.metrics.time_stage("record_manager"):
+            return self.record_manager.get_time()
+
+    async def aget_time(self):
+        with self.metrics.time_stage("record_manager"):
+            return await self.record_manager.aget_time()
+
+    def update(self, keys, *, group_ids=None, time_at_least=None):
+        with self.metrics.time_stage("record_manager"):
+            return self.record_manager.update(
+                keys, group_ids=group_ids, time_at_least=time_at_least)
+
+    async def aupdate(self, keys, *, group_ids=None, time_at_least=None):
+        with self.metrics.time_stage("record_manager"):
+            return await self.record_manager.aupdate(
+                keys, group_ids=group_ids, time_at_least=time_at_least)
+
+    def exists(self, keys):
+        with self.metrics.time_stage("record_manager"):
+            return self.record_manager.exists(keys)
+
+    async def aexists(self, keys):
+        with self.metrics.time_stage("record_manager"):
+            return await self.record_manager.aexists(keys)
+
+    def list_keys(self, *, before=None, after=None, group_ids=None,
+                  limit=None):
+        with self.metrics.time_stage("record_manager"):
+            return self.record_manager.list_keys(
+                before=before, after=after, group_ids=group_ids, limit=limit)
+
+    async def alist_keys(self, *, before=None, after=None, group_ids=None,
+                         limit=None):
+        with self.metrics.time_stage("record_manager"):
+            return await self.record_manager.alist_keys(
+                before=before, after=after, group_ids=group_ids, limit=limit)
+
+    def delete_keys(self, keys):
+        with self.metrics.time_stage("record_manager"):
+            return self.record_manager.delete_keys(keys)
+
+    async def adelete_keys(self, keys):
+        with self.metrics.time_stage("record_manager"):
+            return await self.record_manager.adelete_keys(keys)
+
+
+class InstrumentedVectorStore(VectorStore):
+    """A vector store wrapper for index() timing the writes and deletes of
+    the wrapped store under the vector_store_write stage. Stores embed
+    inside add_documents, that time is recorded by InstrumentedEmbeddings
+    and left out of the write time; index() calls the store of a run one
+    batch at a time, so no other embedding call of the same metrics runs
+    meanwhile."""
+
+    def __init__(self, vectorstore, metrics: PipelineMetrics = None):
+        self.vectorstore = vectorstore
+        self.metrics = metrics or pipeline_metrics
+
+    def __repr__(self):
+        return f"InstrumentedVectorStore({self.vectorstore!r})"
+
+    def __getattr__(self, name):
+        # collection_name, client ... of the wrapped store
+        if name == "vectorstore":
+            raise AttributeError(name)
+        return getattr(self.vectorstore, name)
+
+    @contextmanager
+    def _time_write(self):
+        embedding_seconds = self.metrics.get_stage_seconds("embedding")
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.metrics.observe(
+                "vector_store_write",
+                max(time.perf_counter() - start_time
+                    - (self.metrics.get_stage_seconds("embedding")
+                       - embedding_seconds), 0.0))
+
+    @property
+    def embeddings(self):
+        return self.vectorstore.embeddings
+
+    def add_texts(self, texts, metadatas=None, **kwargs) -> List[str]:
+        with self._time_write():
+            return self.vectorstore.add_texts(texts, metadatas=metadatas,
+                                              **kwargs)
+
+    def add_documents(self, documents, **kwargs) -> List[str]:
+        with self._time_write():
+            return self.vectorstore.add_documents(documents, **kwargs)
+
+    async def aadd_documents(self, documents, **kwargs) -> List[str]:
+        with self._time_write():
+            return await self.vectorstore.aadd_documents(documents, **kwargs)
+
+    def delete(self, ids=None, **kwargs):
+        with self._time_write():
+            return self.vectorstore.delete(ids, **kwargs)
+
+    async def adelete(self, ids=None, **kwargs):
+        with self._time_write():
+            return await self.vectorstore.adelete(ids, **kwargs)
+
+    def similarity_search(self, query, k: int = 4, **kwargs):
+        return self.vectorstore.similarity_search(query, k=k, **kwargs)
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError(
+            "InstrumentedVectorStore wraps an existing vector store")
+
+
+def record_file_reports(file_reports, metrics: PipelineMetrics = None):
+    # parsing runs in worker processes, so the per file reports they return
+    # are recorded in the parent
+    metrics = metrics or pipeline_metrics
+    for report in file_reports:
+        if report.get("cached"):
+            metrics.increment("files_replayed_from_cache")
+        elif report["error"]:
+            metrics.increment("files_failed")
+        else:
+            metrics.increment("files_parsed")
+            document_type = report.get("document_type", "pdf")
+            stage_seconds = report.get("stage_seconds")
+            if stage_seconds:
+                metrics.observe(f"{document_type}_parse",
+                                stage_seconds["parse"])
+                metrics.observe(f"{document_type}_split",
+                                stage_seconds["split"])
+            else:
+                metrics.observe(f"{document_type}_parse_and_split",
+                                report["elapsed_seconds"])
+        metrics.increment("pages", report["number_of_pages"])
+        metrics.increment("chunks", report["number_of_chunks"])
+
+
+def write_metrics(output_directory: str, metrics: PipelineMetrics = None):
+    metrics = metrics or pipeline_metrics
+    os.makedirs(output_directory, exist_ok=True)
+    metrics.write_json(os.path.join(output_directory, "metrics.json"))
+    metrics.write_prometheus(os.path.join(output_directory, "metrics.prom"))
+    print(f"---> metrics written to {output_directory}")
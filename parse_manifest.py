@@ -0,0 +1,112 @@
+import os
+import json
+import hashlib
+from langchain_core.documents import Document
+
+
+def compute_file_hash(file_path: str, block_size: int = 1024 * 1024):
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+class ParseManifest:
+    """
+    A per-file manifest (path, size, mtime and content hash) plus a cache of
+    the extracted and split chunks of every file, so that only new or
+    modified files have to be parsed again. A file whose size and mtime did
+    not change is trusted without being read; otherwise its content hash is
+    compared, so touched or moved files are still replayed from the cache.
+
+    Parameters
+    ==========
+    manifest_path: string
+        The json file holding the per file entries
+    chunk_cache_directory: string
+        The directory holding the cached chunks, one json file per content
+        hash and chunking configuration
+    """
+
+    def __init__(
+        self,
+        manifest_path: str = "parse_manifest.json",
+        chunk_cache_directory: str = "parse_cache",
+    ):
+        self.manifest_path = manifest_path
+        self.chunk_cache_directory = chunk_cache_directory
+        os.makedirs(chunk_cache_directory, exist_ok=True)
+        self.entries = {}
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, "r") as manifest_file:
+                self.entries = json.load(manifest_file)
+
+    def save(self):
+        # drop the entries of files that no longer exist
+        self.entries = {
+            file_path: entry
+            for file_path, entry in self.entries.items()
+            if os.path.exists(file_path)
+        }
+        temporary_path = f"{self.manifest_path}.tmp"
+        with open(temporary_path, "w") as manifest_file:
+            json.dump(self.entries, manifest_file)
+        os.replace(temporary_path, self.manifest_path)
+
+    def _chunk_cache_path(self, content_hash, chunk_size, chunk_overlap,
+                          length_unit="characters"):
+        # chunks measured in tokens differ from the character ones
+        suffix = "" if length_unit == "characters" else f"_{length_unit}"
+        return os.path.join(
+            self.chunk_cache_directory,
+            f"{content_hash}_{chunk_size}_{chunk_overlap}{suffix}.json",
+        )
+
+    def get_content_hash(self, file_path: str):
+        stat = os.stat(file_path)
+        entry = self.entries.get(file_path)
+        if (entry and entry["size"] == stat.st_size
+                and entry["mtime"] == stat.st_mtime):
+            return entry["content_hash"]
+        content_hash = compute_file_hash(file_path)
+        self.entries[file_path] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "content_hash": content_hash,
+        }
+        return content_hash
+
+    def get_cached_chunks(self, file_path, chunk_size, chunk_overlap,
+                          length_unit="characters"):
+        # returns None when the file has to be parsed
+        content_hash = self.get_content_hash(file_path)
+        chunk_cache_path = self._chunk_cache_path(
+            content_hash, chunk_size, chunk_overlap, length_unit)
+        if not os.path.isfile(chunk_cache_path):
+            return None
+        with open(chunk_cache_path, "r") as chunk_cache_file:
+            cached_chunks = json.load(chunk_cache_file)
+        return [
+            Document(
+                page_content=chunk["page_content"],
+                # the same content may have been cached under another path
+                metadata={**chunk["metadata"], "source": file_path},
+            )
+            for chunk in cached_chunks
+        ]
+
+    def store_chunks(self, file_path, chunks, chunk_size, chunk_overlap,
+                     length_unit="characters"):
+        content_hash = self.get_content_hash(file_path)
+        chunk_cache_path = self._chunk_cache_path(
+            content_hash, chunk_size, chunk_overlap, length_unit)
+        with open(chunk_cache_path, "w") as chunk_cache_file:
+            json.dump(
+                [
+                    {"page_content": chunk.page_content,
+                     "metadata": chunk.metadata}
+                    for chunk in chunks
+                ],
+                chunk_cache_file,
+            )
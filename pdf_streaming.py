@@ -0,0 +1,380 @@
+import os
+import json
+import time
+import signal
+import multiprocessing
+from datetime import datetime, timezone
+from multiprocessing.connection import wait
+from langchain_core.documents import Document
+
+# Page streaming pdf extraction with per file resource limits. The files are
+# parsed by a few long lived worker processes, one file at a time per
+# worker: pages are read one at a time with pypdf straight from the file
+# (PyPDFLoader reads the whole file and extracts every page before yielding
+# the first one), split, and sent to the parent page by page. A file with
+# more than max_pages pages, running longer than max_seconds or allocating
+# more than max_memory_mb of address space (RLIMIT_AS of the worker, unix
+# only) is stopped, its worker replaced, and written to the quarantine file
+# instead of failing or stalling the run; quarantined files are skipped by
+# later runs until they change or the limits are raised. The chunks of a
+# file are released once the file is complete, in file order, so the output
+# is deterministic and a quarantined file never leaves a partial document.
+# Workers get no new file while 2 * max_workers files are unreleased, so a
+# slow file holds at most that many files in memory behind it.
+
+
+def _limit_address_space(max_memory_mb):
+    # the limit is on top of what the worker already mapped (interpreter,
+    # libraries), so it bounds what the parsing of the file allocates
+    try:
+        import resource
+
+        with open("/proc/self/statm") as statm:
+            mapped_bytes = int(statm.read().split()[0]) \
+                * os.sysconf("SC_PAGE_SIZE")
+        limit = mapped_bytes + max_memory_mb * 2**20
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, OSError, ValueError):
+        pass
+
+
+def _extract_file(connection, text_splitter, file_path, max_pages):
+    import pypdf
+
+    with open(file_path, "rb") as pdf_file:
+        reader = pypdf.PdfReader(pdf_file)
+        number_of_pages = len(reader.pages)
+        if max_pages and number_of_pages > max_pages:
+            connection.send(("quarantine", f"{number_of_pages} pages, "
+                             + f"more than the limit of {max_pages}"))
+            return
+        for page_number in range(number_of_pages):
+            start_time = time.perf_counter()
+            page_content = reader.pages[page_number].extract_text()
+            parsed_time = time.perf_counter()
+            chunks = text_splitter.split_documents([Document(
+                page_content=page_content,
+                metadata={"source": file_path, "page": page_number})])
+            connection.send(("chunks", (chunks, parsed_time - start_time,
+                                        time.perf_counter() - parsed_time)))
+    connection.send(("done", number_of_pages))
+
+
+def _run_worker(connection, chunk_size, chunk_overlap, max_pages,
+                max_memory_mb):
+    # extracts the files sent by the parent one after the other, until None
+    from utils import get_configured_text_splitter
+
+    text_splitter = get_configured_text_splitter(chunk_size, chunk_overlap)
+    if max_memory_mb:
+        _limit_address_space(max_memory_mb)
+    try:
+        # the start of the worker does not count in the time of a file
+        connection.send(("ready", None))
+        while True:
+            file_path = connection.recv()
+            if file_path is None:
+                return
+            try:
+                _extract_file(connection, text_splitter, file_path, max_pages)
+            except MemoryError:
+                # the worker state is not trusted after it, it is replaced
+                connection.send(("memory_error", f"more than {max_memory_mb} "
+                                 + "MB of memory"))
+                return
+            except Exception as ex:
+                connection.send(("error", str(ex)))
+    except (EOFError, OSError):
+        return
+    finally:
+        connection.close()
+
+
+def _file_signature(file_path):
+    file_stat = os.stat(file_path)
+    return file_stat.st_size, file_stat.st_mtime_ns
+
+
+def load_quarantine(quarantine_path: str):
+    # the last record of every quarantined file
+    quarantine = {}
+    if quarantine_path and os.path.isfile(quarantine_path):
+        with open(quarantine_path) as quarantine_file:
+            for line in quarantine_file:
+                if line.strip():
+                    record = json.loads(line)
+                    quarantine[record["file_path"]] = record
+    return quarantine
+
+
+def _is_raised(limit, recorded_limit):
+    # a removed limit is raised, a limit that was already None is not
+    if limit is None:
+        return recorded_limit is not None
+    return recorded_limit is not None and limit > recorded_limit
+
+
+def _is_still_quarantined(record, file_path, limits):
+    try:
+        signature = _file_signature(file_path)
+    except OSError:
+        return False
+    if [record["size"], record["mtime_ns"]] != list(signature):
+        return False
+    # a file is retried once the limit it exceeded is raised or removed;
+    # for records without it, once any limit is
+    exceeded_limits = [record["exceeded_limit"]] \
+        if record.get("exceeded_limit") else list(limits)
+    return not any(_is_raised(limits[name], record["limits"].get(name))
+                   for name in exceeded_limits)
+
+
+class _FileExtraction:
+    # the chunks and outcome of one file
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.chunks = []
+        self.number_of_pages = 0
+        self.stage_seconds = {"parse": 0.0, "split": 0.0}
+        self.status = None
+        self.reason = None
+        self.exceeded_limit = None
+        self.started_at = time.perf_counter()
+        self.elapsed_seconds = None
+
+    def finish(self, status, reason=None, exceeded_limit=None):
+        self.status = status
+        self.reason = reason
+        self.exceeded_limit = exceeded_limit
+        if status != "done":
+            # a failed file never leaves a partial document
+            self.chunks = []
+        self.elapsed_seconds = round(time.perf_counter() - self.started_at, 2)
+
+
+class _ExtractionWorker:
+    # one long lived worker process, replaced when a file kills it or is
+    # stopped for its time
+    def __init__(self, context, chunk_size, chunk_overlap, max_pages,
+                 max_memory_mb):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=_run_worker,
+            args=(child_connection, chunk_size, chunk_overlap, max_pages,
+                  max_memory_mb),
+            daemon=True,
+        )
+        self.process.start()
+        child_connection.close()
+        self.extraction = None
+        self.ready = False
+        self.alive = True
+
+    def start(self, file_path):
+        self.extraction = _FileExtraction(file_path)
+        self.connection.send(file_path)
+        return self.extraction
+
+    def _finish(self, status, reason=None, exceeded_limit=None):
+        self.extraction.finish(status, reason, exceeded_limit)
+        self.extraction = None
+
+    def receive(self):
+        # reads every pending message of the current file
+        try:
+            while (self.extraction is not None or not self.ready) \
+                    and self.connection.poll():
+                kind, value = self.connection.recv()
+                if kind == "ready":
+                    self.ready = True
+                elif kind == "chunks":
+                    chunks, parse_seconds, split_seconds = value
+                    self.extraction.chunks.extend(chunks)
+                    self.extraction.number_of_pages += 1
+                    self.extraction.stage_seconds["parse"] += parse_seconds
+                    self.extraction.stage_seconds["split"] += split_seconds
+                elif kind == "done":
+                    self._finish("done")
+                elif kind == "memory_error":
+                    self._finish("quarantine", value, "max_memory_mb")
+                    self.alive = False
+                elif kind == "quarantine":
+                    self._finish("quarantine", value, "max_pages")
+                else:
+                    self._finish(kind, value)
+        except (EOFError, OSError):
+            # the worker died without a last message
+            self.process.join()
+            exit_code = self.process.exitcode
+            self.alive = False
+            if not self.ready:
+                raise RuntimeError("the pdf extraction worker could not "
+                                   + f"start, exit code {exit_code}")
+            if exit_code is not None and exit_code < 0 \
+                    and -exit_code in (signal.SIGKILL, signal.SIGSEGV):
+                self._finish("quarantine", "worker killed by signal "
+                             + f"{-exit_code} (memory limit)",
+                             "max_memory_mb")
+            else:
+                self._finish("error", f"worker exited with code {exit_code}")
+
+    def kill(self, status, reason, exceeded_limit=None):
+        self._finish(status, reason, exceeded_limit)
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+        self.alive = False
+
+    def stop(self):
+        if self.alive:
+            try:
+                self.connection.send(None)
+            except OSError:
+                pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.connection.close()
+
+
+def stream_pdf_chunks(
+    file_paths,
+    chunk_size: int = 1500,
+    chunk_overlap: int = 150,
+    max_workers: int = None,
+    max_pages: int = None,
+    max_seconds: float = 600,
+    max_memory_mb: int = 2048,
+    quarantine_path: str = "pdf_quarantine.jsonl",
+    file_reports: list = None,
+):
+    """
+    A method that yields the chunks of pdf files, extracted page by page in
+    worker processes under per file limits.
+
+    Parameters
+    ==========
+    file_paths: list of strings
+        The pdf files, their chunks are yielded in this order
+    max_workers: int
+        The number of files parsed at the same time, defaults to the cpu
+        count; at most 2 * max_workers files are parsed or waiting for an
+        earlier file at a time
+    max_pages / max_seconds / max_memory_mb: int / float / int
+        The per file limits, None disables a limit
+    quarantine_path: string
+        The jsonl file of the quarantined files
+    file_reports: list
+        When given, a report per file is appended to it
+
+    Yields
+    ======
+    chunk: langchain document
+        The chunks of every completed file, file after file
+    """
+    # spawn, the parent may run threads (prefetch, tee), forking it is not
+    # safe
+    context = multiprocessing.get_context("spawn")
+    max_workers = max_workers or os.cpu_count() or 1
+    limits = {"max_pages": max_pages, "max_seconds": max_seconds,
+              "max_memory_mb": max_memory_mb}
+    quarantine = load_quarantine(quarantine_path)
+    pending_file_paths = []
+    for file_path in file_paths:
+        record = quarantine.get(file_path)
+        if record is not None and _is_still_quarantined(record, file_path,
+                                                        limits):
+            print(f"---> skipping quarantined {file_path}: {record['reason']}")
+            if file_reports is not None:
+                file_reports.append(_make_file_report(
+                    file_path, 0, 0, 0.0, "quarantined: " + record["reason"]))
+        else:
+            pending_file_paths.append(file_path)
+
+    max_unreleased_files = 2 * max_workers
+    workers = []
+    extractions = []
+    next_file = 0
+    try:
+        while extractions or next_file < len(pending_file_paths):
+            for worker in workers:
+                if not worker.alive:
+                    # e.g. after a memory_error, the process is exiting
+                    worker.stop()
+            workers = [worker for worker in workers if worker.alive]
+            while len(workers) < min(
+                    max_workers, len(pending_file_paths) - next_file
+                    + sum(worker.extraction is not None
+                          for worker in workers)):
+                workers.append(_ExtractionWorker(
+                    context, chunk_size, chunk_overlap, max_pages,
+                    max_memory_mb))
+            for worker in workers:
+                if worker.ready and worker.extraction is None \
+                        and next_file < len(pending_file_paths) \
+                        and len(extractions) < max_unreleased_files:
+                    extractions.append(worker.start(
+                        pending_file_paths[next_file]))
+                    next_file += 1
+
+            if workers:
+                wait([worker.connection for worker in workers], timeout=0.5)
+            for worker in workers:
+                worker.receive()
+                if worker.extraction is not None and max_seconds and \
+                        time.perf_counter() - worker.extraction.started_at \
+                        > max_seconds:
+                    worker.kill("quarantine", f"more than {max_seconds} "
+                                + "seconds", "max_seconds")
+
+            # completed files are released in order
+            while extractions and extractions[0].status is not None:
+                extraction = extractions.pop(0)
+                _report_extraction(extraction, limits, quarantine_path,
+                                   file_reports)
+                yield from extraction.chunks
+    finally:
+        for worker in workers:
+            worker.stop()
+
+
+def _make_file_report(file_path, number_of_pages, number_of_chunks,
+                      elapsed_seconds, error, stage_seconds=None):
+    return {
+        "file_path": file_path,
+        "number_of_pages": number_of_pages,
+        "number_of_chunks": number_of_chunks,
+        "elapsed_seconds": elapsed_seconds,
+        "stage_seconds": stage_seconds or {},
+        "error": error,
+    }
+
+
+def _report_extraction(extraction, limits, quarantine_path, file_reports):
+    error = None
+    if extraction.status == "quarantine":
+        error = "quarantined: " + extraction.reason
+        print(f"---> quarantined {extraction.file_path}: {extraction.reason}")
+        if quarantine_path:
+            size, mtime_ns = _file_signature(extraction.file_path)
+            with open(quarantine_path, "a") as quarantine_file:
+                quarantine_file.write(json.dumps({
+                    "file_path": extraction.file_path,
+                    "reason": extraction.reason,
+                    "exceeded_limit": extraction.exceeded_limit,
+                    "size": size,
+                    "mtime_ns": mtime_ns,
+                    "limits": limits,
+                    "pages_read": extraction.number_of_pages,
+                    "elapsed_seconds": extraction.elapsed_seconds,
+                    "timestamp": datetime.now(timezone.utc).isoformat(),
+                }) + "\n")
+    elif extraction.status == "error":
+        error = extraction.reason
+        print(f"---> skipping {extraction.file_path}, error: {error}")
+    if file_reports is not None:
+        file_reports.append(_make_file_report(
+            extraction.file_path, extraction.number_of_pages,
+            len(extraction.chunks), extraction.elapsed_seconds, error,
+            extraction.stage_seconds))
@@ -0,0 +1,323 @@
+import json
+import math
+import uuid
+from contextlib import contextmanager
+from langchain_postgres.vectorstores import PGVector, DistanceStrategy
+
+# Bulk-load fast path of the PGVector backend. PGVector.add_embeddings sends
+# every batch as one ORM INSERT ... ON CONFLICT DO UPDATE with a bound
+# parameter per column and row, each vector rendered by the ORM. Here a batch
+# is streamed with COPY (psycopg 3) into a temporary staging table of the
+# pooled connection and merged into langchain_pg_embedding with a single set
+# based INSERT ... SELECT ... ON CONFLICT, the same upsert semantics as
+# PGVector (the last copy of an id wins). The connections come from the
+# sqlalchemy pool of the store, sized by `pgvector_pool_size`, so concurrent
+# writers (async_ingestion) do not open a connection per batch.
+#
+# The approximate nearest neighbour index (hnsw or ivfflat) is managed here
+# too, one partial index per collection: langchain_pg_embedding holds every
+# collection, possibly of different dimensions, so the embedding column is
+# left without a dimension and the index is built on the expression
+# embedding::vector(dimension) for the rows of the collection only; the
+# searches of the store order by the same expression so the planner can use
+# it. For a large initial load the index of the collection is dropped and
+# built once after the load (deferred_index_build), which is much faster
+# than maintaining it row by row and gives ivfflat lists computed from the
+# loaded data. pgvector indexes at most 2000 dimensions, above that (and
+# without a known dimension) the index management is skipped with a
+# warning and the searches stay exact.
+#
+#   python benchmark.py pgvector-bulk [--pgvector-url URL]
+
+_STAGING_TABLE = "langchain_pg_embedding_staging"
+_OPERATOR_CLASSES = {
+    "cosine": "vector_cosine_ops",
+    "l2": "vector_l2_ops",
+    "inner": "vector_ip_ops",
+}
+_INDEX_METHODS = ("hnsw", "ivfflat")
+_MAX_INDEX_DIMENSION = 2000
+
+
+def _format_vector(embedding):
+    # pgvector's text input, repr keeps the shortest exact float
+    return "[" + ",".join([repr(float(value)) for value in embedding]) + "]"
+
+
+def get_ivfflat_lists(number_of_rows: int):
+    # pgvector's guideline: rows / 1000 up to 1M rows, sqrt(rows) above
+    if number_of_rows <= 1_000_000:
+        return max(1, number_of_rows // 1000)
+    return int(math.sqrt(number_of_rows))
+
+
+class BulkPGVector(PGVector):
+    """
+    A PGVector whose writes go through COPY into a staging table and a set
+    based merge, with a deferred build of the vector index.
+
+    Parameters
+    ==========
+    pool_size: int
+        The number of pooled connections of the sqlalchemy engine
+    dimension: int
+        The dimension of the vectors of the collection, for its index; the
+        writes of vectors of another dimension are refused
+    vector_index: string
+        hnsw, ivfflat or None, the index managed by deferred_index_build
+    initial_load_threshold: int
+        deferred_index_build drops the index of the collection and builds
+        it after the load when the collection has fewer rows than this
+    index_options: dictionary
+        m, ef_construction (hnsw), lists (ivfflat, computed when None),
+        maintenance_work_mem and max_parallel_maintenance_workers of the
+        index build
+    """
+
+    def __init__(self, *args, pool_size: int = 5, dimension: int = None,
+                 vector_index: str = "hnsw",
+                 initial_load_threshold: int = 100_000,
+                 index_options: dict = None, **kwargs):
+        if vector_index is not None and vector_index not in _INDEX_METHODS:
+            raise ValueError(f"unknown vector index {vector_index}, "
+                             + f"expected one of {_INDEX_METHODS} or None")
+        # set before PGVector's init, which can delete the collection
+        self.dimension = dimension
+        self.vector_index = vector_index
+        self.initial_load_threshold = initial_load_threshold
+        self.index_options = index_options or {}
+        self._collection_uuid = None
+        engine_args = {"pool_size": pool_size, "max_overflow": 0,
+                       "pool_pre_ping": True}
+        engine_args.update(kwargs.pop("engine_args", None) or {})
+        super().__init__(*args, engine_args=engine_args, **kwargs)
+        if self.async_mode:
+            raise ValueError("the bulk load path needs a synchronous engine")
+
+    def _get_collection_uuid(self):
+        if self._collection_uuid is None:
+            with self._make_sync_session() as session:
+                collection = self.get_collection(session)
+                if not collection:
+                    raise ValueError("Collection not found")
+                self._collection_uuid = collection.uuid
+        return self._collection_uuid
+
+    @contextmanager
+    def _raw_connection(self):
+        # a pooled psycopg 3 connection, in a transaction
+        pooled_connection = self._engine.raw_connection()
+        try:
+            import psycopg
+
+            connection = pooled_connection.driver_connection
+            if not isinstance(connection, psycopg.Connection):
+                raise ValueError("the bulk load path needs the psycopg 3 "
+                                 + "driver (postgresql+psycopg://)")
+            yield connection
+            connection.commit()
+        except Exception:
+            pooled_connection.rollback()
+            raise
+        finally:
+            pooled_connection.close()
+
+    def add_embeddings(self, texts, embeddings, metadatas=None, ids=None,
+                       **kwargs):
+        texts = list(texts)
+        if ids is None:
+            ids = [str(uuid.uuid4()) for _ in texts]
+        if not metadatas:
+            metadatas = [{} for _ in texts]
+        if not texts:
+            return ids
+        embeddings = list(embeddings)
+        self._check_dimension(embeddings)
+        collection_uuid = self._get_collection_uuid()
+
+        with self._raw_connection() as connection:
+            with connection.cursor() as cursor:
+                # one staging table per pooled connection, emptied by the
+                # commit of every batch
+                cursor.execute(
+                    f"CREATE TEMP TABLE IF NOT EXISTS {_STAGING_TABLE} ("
+                    "ordinal bigint, id varchar, embedding vector, "
+                    "document varchar, cmetadata jsonb) ON COMMIT DELETE ROWS"
+                )
+                with cursor.copy(
+                    f"COPY {_STAGING_TABLE} (ordinal, id, embedding, "
+                    "document, cmetadata) FROM STDIN"
+                ) as copy:
+                    for ordinal, (text, metadata, embedding, id) in enumerate(
+                            zip(texts, metadatas, embeddings, ids)):
+                        copy.write_row((ordinal, id, _format_vector(embedding),
+                                        text, json.dumps(metadata or {})))
+                cursor.execute(
+                    "INSERT INTO langchain_pg_embedding "
+                    "(id, collection_id, embedding, document, cmetadata) "
+                    "SELECT DISTINCT ON (id) id, %s, embedding, document, "
+                    f"cmetadata FROM {_STAGING_TABLE} "
+                    "ORDER BY id, ordinal DESC "
+                    "ON CONFLICT (id) DO UPDATE SET "
+                    "embedding = EXCLUDED.embedding, "
+                    "document = EXCLUDED.document, "
+                    "cmetadata = EXCLUDED.cmetadata",
+                    (collection_uuid,),
+                )
+        return ids
+
+    def _check_dimension(self, embeddings):
+        # the searches cast to vector(dimension), a vector of another size
+        # would be stored but make every search of the collection fail
+        if not self.dimension:
+            return
+        for embedding in embeddings:
+            if len(embedding) != self.dimension:
+                raise ValueError(
+                    f"the embedding model returns {len(embedding)} "
+                    + "dimensional vectors but the dimension of "
+                    + f"{self.collection_name} is {self.dimension}, set "
+                    + "`dimension` to the output size of the model")
+
+    def _is_index_managed(self, warn: bool = False):
+        if self.vector_index is None:
+            return False
+        if not self.dimension or self.dimension > _MAX_INDEX_DIMENSION:
+            if warn:
+                print(f"---> warning: no {self.vector_index} index for "
+                      + f"{self.collection_name}, pgvector indexes 1 to "
+                      + f"{_MAX_INDEX_DIMENSION} dimensions and the "
+                      + f"dimension is {self.dimension}; searches are exact")
+            return False
+        return True
+
+    @property
+    def distance_strategy(self):
+        # the expression of the partial index of the collection
+        if not self._is_index_managed():
+            return super().distance_strategy
+        import sqlalchemy
+        from pgvector.sqlalchemy import Vector
+
+        embedding = sqlalchemy.cast(self.EmbeddingStore.embedding,
+                                    Vector(self.dimension))
+        return {
+            "l2": embedding.l2_distance,
+            "cosine": embedding.cosine_distance,
+            "inner": embedding.max_inner_product,
+        }[DistanceStrategy(self._distance_strategy).value]
+
+    def _get_index_name(self, method, collection_uuid):
+        return f"ix_pg_embedding_{method}_{collection_uuid.hex}"
+
+    def _count_rows(self, cursor, collection_uuid):
+        cursor.execute("SELECT count(*) FROM langchain_pg_embedding "
+                       "WHERE collection_id = %s", (collection_uuid,))
+        return cursor.fetchone()[0]
+
+    def drop_vector_index(self, method: str = None):
+        """Drops the vector index of the collection, if it exists."""
+        method = method or self.vector_index
+        collection_uuid = self._get_collection_uuid()
+        with self._raw_connection() as connection:
+            connection.execute(
+                "DROP INDEX IF EXISTS "
+                + self._get_index_name(method, collection_uuid))
+        print(f"---> dropped the {method} index of {self.collection_name}")
+
+    def create_vector_index(self, method: str = None):
+        """
+        Builds the hnsw or ivfflat index of the collection, if it does not
+        exist, with the distance of the store.
+        """
+        method = method or self.vector_index
+        if method not in _INDEX_METHODS:
+            raise ValueError(f"unknown vector index {method}")
+        if not self._is_index_managed(warn=True):
+            return
+        operator_class = _OPERATOR_CLASSES[
+            DistanceStrategy(self._distance_strategy).value]
+        collection_uuid = self._get_collection_uuid()
+        with self._raw_connection() as connection:
+            with connection.cursor() as cursor:
+                if method == "hnsw":
+                    options = "m = {}, ef_construction = {}".format(
+                        int(self.index_options.get("m", 16)),
+                        int(self.index_options.get("ef_construction", 64)))
+                else:
+                    lists = self.index_options.get("lists") \
+                        or get_ivfflat_lists(
+                            self._count_rows(cursor, collection_uuid))
+                    options = f"lists = {int(lists)}"
+                # settings of the build transaction only
+                cursor.execute(
+                    "SELECT set_config('maintenance_work_mem', %s, true), "
+                    "set_config('max_parallel_maintenance_workers', %s, true)",
+                    (str(self.index_options.get("maintenance_work_mem",
+                                                "1GB")),
+                     str(self.index_options.get(
+                         "max_parallel_maintenance_workers", 2))),
+                )
+                cursor.execute(
+                    "CREATE INDEX IF NOT EXISTS "
+                    + f"{self._get_index_name(method, collection_uuid)} ON "
+                    + f"langchain_pg_embedding USING {method} "
+                    + f"((embedding::vector({int(self.dimension)})) "
+                    + f"{operator_class}) WITH ({options}) "
+                    + f"WHERE collection_id = '{collection_uuid}'"
+                )
+        print(f"---> {method} index of {self.collection_name} ready "
+              + f"({options})")
+
+    def delete_collection(self):
+        # the partial indexes of the collection go with it
+        try:
+            collection_uuid = self._get_collection_uuid()
+        except ValueError:
+            collection_uuid = None
+        if collection_uuid is not None:
+            with self._raw_connection() as connection:
+                for method in _INDEX_METHODS:
+                    connection.execute(
+                        "DROP INDEX IF EXISTS "
+                        + self._get_index_name(method, collection_uuid))
+        super().delete_collection()
+        self._collection_uuid = None
+
+    @contextmanager
+    def deferred_index_build(self):
+        """
+        Wraps a load: below initial_load_threshold rows in the collection its
+        vector index is dropped and built once after the load (even a failed
+        one), above it the index is kept and maintained by the writes. A
+        failed index operation is reported, it does not stop the load.
+        """
+        if not self._is_index_managed(warn=True):
+            yield
+            return
+        defer = False
+        try:
+            with self._raw_connection() as connection:
+                with connection.cursor() as cursor:
+                    number_of_rows = self._count_rows(
+                        cursor, self._get_collection_uuid())
+            defer = number_of_rows < self.initial_load_threshold
+            if defer:
+                print(f"---> {number_of_rows} rows, the {self.vector_index} "
+                      + "index is built after the load")
+                self.drop_vector_index()
+            else:
+                self.create_vector_index()
+        except Exception as ex:
+            print(f"---> warning: vector index of {self.collection_name} "
+                  + f"not managed: {ex}")
+        try:
+            yield
+        finally:
+            if defer:
+                try:
+                    self.create_vector_index()
+                except Exception as ex:
+                    print(f"---> warning: the {self.vector_index} index of "
+                          + f"{self.collection_name} could not be built: "
+                          + f"{ex}")
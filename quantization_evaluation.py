@@ -0,0 +1,352 @@
+import json
+import time
+import numpy as np
+
+# Offline recall / latency evaluation of reduced vector representations.
+# The ground truth is the exact top k of the full dimension float32 vectors,
+# every candidate representation (Matryoshka style truncation, float16, int8
+# scalar quantization, binary quantization with float32 rescoring) is
+# searched exhaustively with numpy, so the measured recall is the loss of
+# the representation itself, not of an approximate index. numpy has no int8
+# or float16 matrix kernels, their blocks are converted to float32 before
+# the product, so their latencies are upper bounds of what qdrant's SIMD
+# kernels get; the recall and memory figures carry over. Every search uses
+# the distance of the collection (Cosine, Dot or Euclid), as scores where
+# larger is nearer.
+#
+#   python cli.py evaluate-quantization --snapshot-directory snapshot/ -k 10
+
+_SEARCH_BLOCK_ROWS = 65536
+# number of set bits of every byte value, for hamming distances
+_POPCOUNT = np.array([bin(value).count("1") for value in range(256)],
+                     dtype=np.uint8)
+
+
+def normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(
+        np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def prepare_vectors(vectors, distance: str = "Cosine"):
+    # qdrant normalizes cosine vectors, dot and euclid ones are kept as is
+    if distance == "Cosine":
+        return normalize_rows(vectors)
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def get_squared_norms(vectors, distance: str = "Cosine"):
+    if distance != "Euclid":
+        return None
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return np.einsum("ij,ij->i", vectors, vectors)
+
+
+def _to_scores(products, squared_norms=None):
+    # the negated squared euclid distance up to the query norm, the products
+    # themselves for cosine and dot
+    if squared_norms is None:
+        return products
+    return 2 * products - squared_norms
+
+
+def _top_k_rows(score_block, number_of_rows, k, largest=True,
+                block_rows=_SEARCH_BLOCK_ROWS):
+    # block-wise top k of score_block(start, end) -> (queries x rows) scores
+    best_scores = None
+    best_rows = None
+    for start in range(0, number_of_rows, block_rows):
+        end = min(start + block_rows, number_of_rows)
+        scores = score_block(start, end)
+        if not largest:
+            scores = -scores.astype(np.float32)
+        rows = np.broadcast_to(np.arange(start, end), scores.shape)
+        if best_scores is not None:
+            scores = np.concatenate([best_scores, scores], axis=1)
+            rows = np.concatenate([best_rows, rows], axis=1)
+        if scores.shape[1] > k:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            scores = np.take_along_axis(scores, top, axis=1)
+            rows = np.take_along_axis(rows, top, axis=1)
+        best_scores, best_rows = scores, rows
+    order = np.argsort(-best_scores, axis=1)
+    return np.take_along_axis(best_rows, order, axis=1)
+
+
+def exact_search(base, queries, k, squared_norms=None):
+    # squared_norms of the base rows for the euclid distance, None otherwise
+    return _top_k_rows(
+        lambda start, end: _to_scores(
+            queries @ base[start:end].T,
+            None if squared_norms is None else squared_norms[start:end]),
+        len(base), k)
+
+
+class Float32Index:
+    # also the truncated (Matryoshka) representation when dimension < full
+    def __init__(self, vectors, dimension=None, distance: str = "Cosine"):
+        self.dimension = dimension or vectors.shape[1]
+        self.distance = distance
+        self.vectors = prepare_vectors(vectors[:, :self.dimension], distance)
+        self.squared_norms = get_squared_norms(self.vectors, distance)
+
+    def bytes_per_vector(self):
+        return 4 * self.dimension
+
+    def search(self, queries, k):
+        queries = prepare_vectors(queries[:, :self.dimension], self.distance)
+        return exact_search(self.vectors, queries, k, self.squared_norms)
+
+
+class Float16Index(Float32Index):
+    def __init__(self, vectors, dimension=None, distance: str = "Cosine"):
+        super().__init__(vectors, dimension, distance)
+        self.vectors = self.vectors.astype(np.float16)
+        self.squared_norms = get_squared_norms(self.vectors, distance)
+
+    def bytes_per_vector(self):
+        return 2 * self.dimension
+
+    def search(self, queries, k):
+        queries = prepare_vectors(queries[:, :self.dimension], self.distance)
+        return _top_k_rows(
+            lambda start, end: _to_scores(
+                queries @ self.vectors[start:end].astype(np.float32).T,
+                None if self.squared_norms is None
+                else self.squared_norms[start:end]),
+            len(self.vectors), k)
+
+
+class Int8Index:
+    # symmetric per dimension scalar quantization to [-127, 127]; the
+    # dimension scales are folded into the query, so a score is one product
+    # of the query with the int8 codes
+    def __init__(self, vectors, dimension=None, distance: str = "Cosine"):
+        self.dimension = dimension or vectors.shape[1]
+        self.distance = distance
+        vectors = prepare_vectors(vectors[:, :self.dimension], distance)
+        self.scales = np.maximum(np.abs(vectors).max(axis=0), 1e-12) / 127
+        self.codes = np.clip(np.rint(vectors / self.scales), -127,
+                             127).astype(np.int8)
+        # the norms of the dequantized vectors
+        self.squared_norms = get_squared_norms(
+            self.codes.astype(np.float32) * self.scales, distance)
+
+    def bytes_per_vector(self):
+        return self.dimension
+
+    def search(self, queries, k):
+        queries = prepare_vectors(queries[:, :self.dimension],
+                                  self.distance) * self.scales
+        return _top_k_rows(
+            lambda start, end: _to_scores(
+                queries @ self.codes[start:end].astype(np.float32).T,
+                None if self.squared_norms is None
+                else self.squared_norms[start:end]),
+            len(self.codes), k)
+
+
+class BinaryIndex:
+    # one sign bit per dimension, searched by hamming distance; with
+    # rescoring, the rescore_factor * k nearest codes are re-ranked with
+    # the float32 vectors, which are counted in the bytes per vector (in
+    # memory, or memory mapped on disk)
+    def __init__(self, vectors, dimension=None, rescore_factor: int = 0,
+                 distance: str = "Cosine"):
+        self.dimension = dimension or vectors.shape[1]
+        self.rescore_factor = rescore_factor
+        self.distance = distance
+        self.vectors = prepare_vectors(vectors[:, :self.dimension], distance)
+        self.squared_norms = get_squared_norms(self.vectors, distance)
+        self.codes = np.packbits(self.vectors > 0, axis=1)
+
+    def bytes_per_vector(self):
+        if self.rescore_factor:
+            return self.codes.shape[1] + 4 * self.dimension
+        return self.codes.shape[1]
+
+    def _hamming_search(self, query_codes, k):
+        # the xor of every query with every code of a block is materialized,
+        # so blocks are sized to keep it around 64 MB
+        block_rows = max(1024, 2**26 // (len(query_codes)
+                                         * self.codes.shape[1]))
+        return _top_k_rows(
+            lambda start, end: _POPCOUNT[np.bitwise_xor(
+                query_codes[:, None, :], self.codes[None, start:end, :])
+            ].sum(axis=2, dtype=np.int32),
+            len(self.codes), k, largest=False, block_rows=block_rows)
+
+    def search(self, queries, k):
+        queries = prepare_vectors(queries[:, :self.dimension], self.distance)
+        query_codes = np.packbits(queries > 0, axis=1)
+        if not self.rescore_factor:
+            return self._hamming_search(query_codes, k)
+        candidates = self._hamming_search(
+            query_codes, min(k * self.rescore_factor, len(self.codes)))
+        scores = _to_scores(
+            np.einsum("qd,qcd->qc", queries, self.vectors[candidates]),
+            None if self.squared_norms is None
+            else self.squared_norms[candidates])
+        order = np.argsort(-scores, axis=1)[:, :k]
+        return np.take_along_axis(candidates, order, axis=1)
+
+
+def recall_at_k(found_rows, true_rows):
+    k = true_rows.shape[1]
+    return float(np.mean([
+        len(set(found[:k]) & set(truth)) / k
+        for found, truth in zip(found_rows.tolist(), true_rows.tolist())
+    ]))
+
+
+def _measure(index, queries, true_rows, k, latency_queries):
+    found_rows = np.concatenate([
+        index.search(queries[start:start + 64], k)
+        for start in range(0, len(queries), 64)
+    ])
+    # one query at a time, as in an online search
+    latencies = []
+    for query in queries[:latency_queries]:
+        start_time = time.perf_counter()
+        index.search(query[None, :], k)
+        latencies.append((time.perf_counter() - start_time) * 1000)
+    latencies.sort()
+    return {
+        f"recall@{k}": round(recall_at_k(found_rows, true_rows), 4),
+        "p50_ms": round(latencies[len(latencies) // 2], 3)
+        if latencies else None,
+        "p99_ms": round(latencies[min(int(len(latencies) * 0.99),
+                                      len(latencies) - 1)], 3)
+        if latencies else None,
+        "bytes_per_vector": index.bytes_per_vector(),
+        "megabytes_per_million_vectors": round(
+            index.bytes_per_vector() * 1_000_000 / 2**20, 1),
+    }
+
+
+def evaluate_quantization(
+    vectors,
+    queries=None,
+    k: int = 10,
+    dimensions=None,
+    representations=("float32", "float16", "int8", "binary",
+                     "binary_rescored"),
+    number_of_sampled_queries: int = 200,
+    latency_queries: int = 50,
+    rescore_factor: int = 4,
+    distance: str = "Cosine",
+    seed: int = 0,
+):
+    """
+    A method that measures recall@k and per query latency of every
+    (dimension, representation) pair against the exact full dimension
+    float32 search.
+
+    Parameters
+    ==========
+    vectors: numpy array
+        The (count x dimension) collection vectors, e.g. from a snapshot
+    queries: numpy array
+        Query vectors; when None number_of_sampled_queries collection
+        vectors are held out of the base and used as queries
+    dimensions: list of int
+        The truncated dimensions to evaluate, the full one is always added
+    representations: list of strings
+        Among float32, float16, int8, binary, binary_rescored
+    distance: string
+        The qdrant distance of the collection, Cosine, Dot or Euclid
+
+    Returns
+    =======
+    rows: list of dictionaries
+        One row per (dimension, representation)
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if distance not in ("Cosine", "Dot", "Euclid"):
+        raise ValueError(f"unsupported distance {distance}")
+    if queries is None:
+        generator = np.random.default_rng(seed)
+        held_out = generator.choice(len(vectors), size=min(
+            number_of_sampled_queries, len(vectors) // 10), replace=False)
+        keep = np.ones(len(vectors), dtype=bool)
+        keep[held_out] = False
+        queries, vectors = vectors[held_out], vectors[keep]
+    queries = np.asarray(queries, dtype=np.float32)
+    if len(queries) == 0 or len(vectors) == 0:
+        raise ValueError(
+            "no queries to evaluate: a collection of fewer than 10 vectors "
+            + "needs explicit queries")
+    full_dimension = vectors.shape[1]
+    dimensions = sorted({dimension for dimension in (dimensions or [])
+                         if dimension < full_dimension} | {full_dimension})
+
+    base = prepare_vectors(vectors, distance)
+    true_rows = exact_search(base, prepare_vectors(queries, distance), k,
+                             get_squared_norms(base, distance))
+    index_classes = {
+        "float32": Float32Index,
+        "float16": Float16Index,
+        "int8": Int8Index,
+        "binary": BinaryIndex,
+        "binary_rescored": lambda vectors, dimension, distance: BinaryIndex(
+            vectors, dimension, rescore_factor=rescore_factor,
+            distance=distance),
+    }
+    rows = []
+    for dimension in dimensions:
+        for representation in representations:
+            index = index_classes[representation](vectors, dimension,
+                                                  distance=distance)
+            row = {
+                "dimension": dimension,
+                "representation": representation,
+                **_measure(index, queries, true_rows, k, latency_queries),
+            }
+            rows.append(row)
+            print(f"---> {row}")
+    return rows
+
+
+def print_evaluation_table(rows):
+    recall_key = next(key for key in rows[0] if key.startswith("recall@"))
+    print(f"\n{'dimension':>9} {'representation':<16} {recall_key:>9} "
+          + f"{'p50 ms':>8} {'p99 ms':>8} {'MB / 1M vectors':>16}")
+    for row in rows:
+        print(f"{row['dimension']:>9} {row['representation']:<16} "
+              + f"{row[recall_key]:>9} {row['p50_ms']:>8} "
+              + f"{row['p99_ms']:>8} "
+              + f"{row['megabytes_per_million_vectors']:>16}")
+
+
+def load_evaluation_vectors(snapshot_directory: str = None, client=None,
+                            collection_name: str = None,
+                            vector_name: str = None):
+    # the collection vectors and distance, from a local snapshot or from a
+    # scroll
+    if snapshot_directory:
+        from collection_snapshot import load_collection_snapshot
+
+        manifest, vectors = load_collection_snapshot(snapshot_directory)
+        return np.asarray(vectors, dtype=np.float32), manifest["distance"]
+    from utils import iterate_collection_pages
+
+    vectors_config = client.get_collection(
+        collection_name).config.params.vectors
+    if isinstance(vectors_config, dict):
+        vectors_config = vectors_config[vector_name]
+
+    pages = []
+    for points, _ in iterate_collection_pages(
+        client, collection_name, with_payload=False,
+        with_vectors=[vector_name] if vector_name else True,
+    ):
+        if points:
+            pages.append(np.asarray(
+                [point.vector[vector_name] if vector_name else point.vector
+                 for point in points], dtype=np.float32))
+    return np.concatenate(pages), vectors_config.distance.value
+
+
+def save_evaluation(rows, output_path: str):
+    with open(output_path, "w") as output_file:
+        json.dump(rows, output_file, indent=4)
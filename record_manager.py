@@ -0,0 +1,336 @@
+import math
+import time
+import sqlite3
+import asyncio
+import threading
+from typing import List, Optional, Sequence
+from langchain_core.indexing import RecordManager
+
+# SQLite parameters per statement, below the default limit of older builds
+_MAX_PARAMETERS = 900
+
+
+def _batched(values, batch_size=_MAX_PARAMETERS):
+    for start in range(0, len(values), batch_size):
+        yield values[start:start + batch_size]
+
+
+class KeyBloomFilter:
+    """An in-memory bloom filter over record keys. A negative answer means
+    the key is certainly not stored, so exists() can skip the database for
+    new keys, which is the common case when indexing new documents."""
+
+    def __init__(self, expected_keys: int = 1_000_000,
+                 false_positive_rate: float = 0.01):
+        expected_keys = max(expected_keys, 1)
+        self.size = max(8, int(-expected_keys * math.log(false_positive_rate)
+                               / math.log(2) ** 2))
+        self.number_of_hashes = max(
+            1, round(self.size / expected_keys * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        # the filter lives in memory only, so the per process salted
+        # builtin hash is enough and much cheaper than a cryptographic one
+        first = hash(key)
+        second = hash((key, 1)) | 1
+        size = self.size
+        return [(first + i * second) % size
+                for i in range(self.number_of_hashes)]
+
+    def add(self, key: str):
+        bits = self.bits
+        for position in self._positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def might_contain(self, key: str):
+        bits = self.bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class BulkSQLiteRecordManager(RecordManager):
+    """
+    A record manager tuned for namespaces with millions of keys: the sqlite
+    database runs in WAL mode, records are stored in a WITHOUT ROWID table
+    keyed by (namespace, key) with indexes for the cleanup queries, every
+    operation is a batched executemany / IN query, and an optional bloom
+    filter answers exists() for new keys without touching the database.
+
+    Parameters
+    ==========
+    namespace: string
+        The namespace of the records, e.g. qdrant_store_local/<collection>
+    database_path: string
+        The sqlite file holding the records
+    use_bloom_filter: bool
+        Keep an in-memory bloom filter of the keys of the namespace. Worth
+        it when the database is slow to reach (network file systems, cold
+        page cache); against a local sqlite file the IN query is faster
+    expected_keys: int
+        The number of keys the bloom filter is sized for
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        database_path: str = "record_manager_cache.sql",
+        use_bloom_filter: bool = False,
+        expected_keys: int = 1_000_000,
+    ):
+        super().__init__(namespace=namespace)
+        self.database_path = database_path
+        self.use_bloom_filter = use_bloom_filter
+        self.expected_keys = expected_keys
+        self.bloom_filter = None
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(database_path,
+                                           check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("PRAGMA temp_store=MEMORY")
+        self._connection.execute("PRAGMA cache_size=-65536")
+
+    @classmethod
+    def from_db_url(cls, namespace: str, db_url: str, **kwargs):
+        # accepts the sqlite:///<path> urls used for SQLRecordManager
+        if not db_url.startswith("sqlite:///"):
+            raise ValueError(f"Only sqlite urls are supported, got {db_url}")
+        return cls(namespace, database_path=db_url[len("sqlite:///"):],
+                   **kwargs)
+
+    def create_schema(self) -> None:
+        with self._lock:
+            self._connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS bulk_upsertion_record (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    group_id TEXT,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS ix_bulk_record_group_updated
+                    ON bulk_upsertion_record (namespace, group_id, updated_at);
+                CREATE INDEX IF NOT EXISTS ix_bulk_record_updated
+                    ON bulk_upsertion_record (namespace, updated_at);
+                """
+            )
+            self._connection.commit()
+            if self.use_bloom_filter:
+                self._build_bloom_filter()
+
+    def _build_bloom_filter(self):
+        (number_of_keys,) = self._connection.execute(
+            "SELECT COUNT(*) FROM bulk_upsertion_record WHERE namespace = ?",
+            (self.namespace,),
+        ).fetchone()
+        self.bloom_filter = KeyBloomFilter(
+            expected_keys=max(self.expected_keys, 2 * number_of_keys))
+        for (key,) in self._connection.execute(
+            "SELECT key FROM bulk_upsertion_record WHERE namespace = ?",
+            (self.namespace,),
+        ):
+            self.bloom_filter.add(key)
+
+    def copy_from_sql_record_manager(self, database_path: str = None):
+        """Copies the records of this namespace from the upsertion_record
+        table of a SQLRecordManager sqlite database, so switching backends
+        does not re-index the namespace."""
+        with self._lock:
+            self._connection.execute("ATTACH DATABASE ? AS source",
+                                     (database_path or self.database_path,))
+            try:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO bulk_upsertion_record "
+                    "(namespace, key, group_id, updated_at) "
+                    "SELECT namespace, key, group_id, updated_at "
+                    "FROM source.upsertion_record WHERE namespace = ?",
+                    (self.namespace,),
+                )
+                self._connection.commit()
+            finally:
+                self._connection.execute("DETACH DATABASE source")
+            if self.use_bloom_filter:
+                self._build_bloom_filter()
+
+    def copy_from_sql_record_manager_if_empty(self, database_path: str = None):
+        """Copies the records of this namespace from the upsertion_record
+        table of a SQLRecordManager sqlite database when this backend has
+        none yet, i.e. the first time an existing namespace is opened with
+        it. Returns the number of records copied."""
+        with self._lock:
+            (has_records,) = self._connection.execute(
+                "SELECT EXISTS (SELECT 1 FROM bulk_upsertion_record "
+                "WHERE namespace = ?)",
+                (self.namespace,),
+            ).fetchone()
+            if has_records:
+                return 0
+            self._connection.execute("ATTACH DATABASE ? AS source",
+                                     (database_path or self.database_path,))
+            try:
+                if self._connection.execute(
+                    "SELECT 1 FROM source.sqlite_master WHERE type = 'table' "
+                    "AND name = 'upsertion_record'"
+                ).fetchone() is None:
+                    return 0
+                (number_of_records,) = self._connection.execute(
+                    "SELECT COUNT(*) FROM source.upsertion_record "
+                    "WHERE namespace = ?",
+                    (self.namespace,),
+                ).fetchone()
+            finally:
+                self._connection.execute("DETACH DATABASE source")
+        if number_of_records:
+            self.copy_from_sql_record_manager(database_path)
+        return number_of_records
+
+    def get_time(self) -> float:
+        return time.time()
+
+    def update(
+        self,
+        keys: Sequence[str],
+        *,
+        group_ids: Optional[Sequence[Optional[str]]] = None,
+        time_at_least: Optional[float] = None,
+    ) -> None:
+        if group_ids is None:
+            group_ids = [None] * len(keys)
+        if len(keys) != len(group_ids):
+            raise ValueError(
+                f"Number of keys ({len(keys)}) does not match number of "
+                f"group_ids ({len(group_ids)})")
+        update_time = self.get_time()
+        if time_at_least and update_time < time_at_least:
+            # same safeguard as SQLRecordManager against clock drift
+            raise AssertionError(f"Time sync issue: {update_time} < "
+                                 f"{time_at_least}")
+        with self._lock:
+            self._connection.executemany(
+                "INSERT INTO bulk_upsertion_record "
+                "(namespace, key, group_id, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (namespace, key) DO UPDATE SET "
+                "group_id = excluded.group_id, "
+                "updated_at = excluded.updated_at",
+                [(self.namespace, key, group_id, update_time)
+                 for key, group_id in zip(keys, group_ids)],
+            )
+            self._connection.commit()
+            if self.bloom_filter is not None:
+                for key in keys:
+                    self.bloom_filter.add(key)
+
+    def exists(self, keys: Sequence[str]) -> List[bool]:
+        candidates = list(keys)
+        if self.bloom_filter is not None:
+            candidates = [key for key in keys
+                          if self.bloom_filter.might_contain(key)]
+        found = set()
+        with self._lock:
+            for key_batch in _batched(candidates):
+                placeholders = ",".join("?" * len(key_batch))
+                found.update(
+                    key for (key,) in self._connection.execute(
+                        "SELECT key FROM bulk_upsertion_record "
+                        f"WHERE namespace = ? AND key IN ({placeholders})",
+                        [self.namespace, *key_batch],
+                    )
+                )
+        return [key in found for key in keys]
+
+    def list_keys(
+        self,
+        *,
+        before: Optional[float] = None,
+        after: Optional[float] = None,
+        group_ids: Optional[Sequence[str]] = None,
+        limit: Optional[int] = None,
+    ) -> List[str]:
+        conditions = ["namespace = ?"]
+        parameters = [self.namespace]
+        if before is not None:
+            conditions.append("updated_at < ?")
+            parameters.append(before)
+        if after is not None:
+            conditions.append("updated_at > ?")
+            parameters.append(after)
+        query = ("SELECT key FROM bulk_upsertion_record WHERE "
+                 + " AND ".join(conditions))
+
+        keys = []
+        with self._lock:
+            if group_ids is None:
+                group_batches = [None]
+            else:
+                group_batches = list(_batched(list(group_ids)))
+            for group_batch in group_batches:
+                batch_query, batch_parameters = query, list(parameters)
+                if group_batch is not None:
+                    batch_query += (" AND group_id IN ("
+                                    + ",".join("?" * len(group_batch)) + ")")
+                    batch_parameters.extend(group_batch)
+                if limit is not None:
+                    batch_query += " LIMIT ?"
+                    batch_parameters.append(limit - len(keys))
+                keys.extend(
+                    key for (key,) in self._connection.execute(
+                        batch_query, batch_parameters))
+                if limit is not None and len(keys) >= limit:
+                    break
+        return keys
+
+    def delete_keys(self, keys: Sequence[str]) -> None:
+        with self._lock:
+            self._connection.executemany(
+                "DELETE FROM bulk_upsertion_record "
+                "WHERE namespace = ? AND key = ?",
+                [(self.namespace, key) for key in keys],
+            )
+            self._connection.commit()
+
+    def delete_keys_for_groups(self, group_ids: Sequence[str],
+                               before: Optional[float] = None) -> int:
+        """Deletes every record of the given groups (sources) in one set
+        based statement per batch, returning the number of deleted records.
+        """
+        deleted = 0
+        with self._lock:
+            for group_batch in _batched(list(group_ids)):
+                query = ("DELETE FROM bulk_upsertion_record "
+                         "WHERE namespace = ? AND group_id IN ("
+                         + ",".join("?" * len(group_batch)) + ")")
+                parameters = [self.namespace, *group_batch]
+                if before is not None:
+                    query += " AND updated_at < ?"
+                    parameters.append(before)
+                deleted += self._connection.execute(query,
+                                                    parameters).rowcount
+            self._connection.commit()
+        return deleted
+
+    async def acreate_schema(self) -> None:
+        await asyncio.to_thread(self.create_schema)
+
+    async def aget_time(self) -> float:
+        return self.get_time()
+
+    async def aupdate(self, keys, *, group_ids=None,
+                      time_at_least=None) -> None:
+        await asyncio.to_thread(self.update, keys, group_ids=group_ids,
+                                time_at_least=time_at_least)
+
+    async def aexists(self, keys) -> List[bool]:
+        return await asyncio.to_thread(self.exists, keys)
+
+    async def alist_keys(self, *, before=None, after=None, group_ids=None,
+                         limit=None) -> List[str]:
+        return await asyncio.to_thread(self.list_keys, before=before,
+                                       after=after, group_ids=group_ids,
+                                       limit=limit)
+
+    async def adelete_keys(self, keys) -> None:
+        await asyncio.to_thread(self.delete_keys, keys)
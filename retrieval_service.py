@@ -0,0 +1,269 @@
+import time
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from metrics import pipeline_metrics
+
+# A retrieval layer over a langchain vector store for the query path:
+# query embeddings are cached (LRU + TTL), search results are cached per
+# collection version, batches of queries are embedded with one embedding
+# call and searched concurrently, and the latency of every query is kept
+# for p50 / p99 reporting. With the chunk deduplication, a text indexed once
+# under its canonical source gets the list of every source containing it from
+# the chunk registry.
+
+
+class TTLCache:
+    """A thread safe LRU cache whose entries also expire after ttl_seconds.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl_seconds: float = 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl_seconds)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def get_statistics(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+def normalize_query(query: str):
+    # questions differing only by surrounding or repeated whitespace share
+    # their embedding and results
+    return " ".join(query.split())
+
+
+def _percentile(sorted_values, percentile):
+    if not sorted_values:
+        return None
+    index = min(int(round(percentile / 100 * (len(sorted_values) - 1))),
+                len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+class RetrievalService:
+    """
+    A caching, batching query service over a langchain vector store.
+
+    The result cache is keyed by the collection version: a local counter
+    bumped by notify_collection_changed() (called after indexing runs of
+    this process) combined with the point count of qdrant collections,
+    checked at most every version_check_interval_seconds, so writes from
+    other processes invalidate the results too. Updates that keep the point
+    count are only picked up by this process' notifications or by the
+    result TTL.
+
+    Parameters
+    ==========
+    vectorstore: langchain vector store
+        The store searched with similarity_search_by_vector
+    query_cache_size / query_ttl_seconds: int / float
+        Bounds of the query embedding cache
+    result_cache_size / result_ttl_seconds: int / float
+        Bounds of the result cache
+    max_concurrent_searches: int
+        The number of searches of a batch running at the same time
+    batch_query_embeddings: bool
+        Embed the queries of a batch with one embed_documents call. Only
+        for models embedding queries and documents the same way (openai);
+        set False for models with query instructions or query encoders
+    chunk_registry: chunk_deduplication.ChunkRegistry
+        The registry of the namespace of the store, adds the `sources` of
+        the text of every result to its metadata
+    """
+
+    def __init__(
+        self,
+        vectorstore,
+        query_cache_size: int = 10000,
+        query_ttl_seconds: float = 3600,
+        result_cache_size: int = 1000,
+        result_ttl_seconds: float = 600,
+        max_concurrent_searches: int = 8,
+        batch_query_embeddings: bool = False,
+        version_check_interval_seconds: float = 5,
+        chunk_registry=None,
+        metrics=None,
+    ):
+        self.vectorstore = vectorstore
+        self.embeddings = vectorstore.embeddings
+        self.query_embedding_cache = TTLCache(query_cache_size,
+                                              query_ttl_seconds)
+        self.result_cache = TTLCache(result_cache_size, result_ttl_seconds)
+        self.max_concurrent_searches = max_concurrent_searches
+        self.batch_query_embeddings = batch_query_embeddings
+        self.version_check_interval_seconds = version_check_interval_seconds
+        self.chunk_registry = chunk_registry
+        self.metrics = metrics or pipeline_metrics
+        self.latencies = deque(maxlen=10000)
+        self._local_version = 0
+        self._collection_version = None
+        self._version_checked_at = 0.0
+
+    def notify_collection_changed(self):
+        self._local_version += 1
+        self._version_checked_at = 0.0
+
+    def _get_collection_version(self):
+        now = time.monotonic()
+        if now - self._version_checked_at >= \
+                self.version_check_interval_seconds:
+            client = getattr(self.vectorstore, "client", None)
+            collection_name = getattr(self.vectorstore, "collection_name",
+                                      None)
+            try:
+                if client is not None and hasattr(client, "get_collection"):
+                    self._collection_version = client.get_collection(
+                        collection_name).points_count
+            except Exception as ex:
+                print(f"---> could not read the collection version: {ex}")
+                self._collection_version = None
+            self._version_checked_at = now
+        return (self._local_version, self._collection_version)
+
+    async def _embed_queries(self, queries):
+        # returns the embeddings of the (normalized) queries, embedding the
+        # uncached ones with a single call when batching is allowed
+        embeddings = [self.query_embedding_cache.get(query)
+                      for query in queries]
+        missing_queries = list(dict.fromkeys(
+            query for query, embedding in zip(queries, embeddings)
+            if embedding is None))
+        if missing_queries:
+            if self.batch_query_embeddings and len(missing_queries) > 1:
+                new_embeddings = await self.embeddings.aembed_documents(
+                    missing_queries)
+            else:
+                new_embeddings = await asyncio.gather(*[
+                    self.embeddings.aembed_query(query)
+                    for query in missing_queries
+                ])
+            for query, embedding in zip(missing_queries, new_embeddings):
+                self.query_embedding_cache.put(query, embedding)
+            embedded = dict(zip(missing_queries, new_embeddings))
+            embeddings = [embedding if embedding is not None
+                          else embedded[query]
+                          for query, embedding in zip(queries, embeddings)]
+        return embeddings
+
+    def _add_sources(self, documents):
+        # the deduplicated copy stands for every source containing its text
+        documents_with_sources = []
+        for document in documents:
+            sources = self.chunk_registry.get_sources(document.page_content) \
+                or [document.metadata.get("source")]
+            documents_with_sources.append(document.copy(update={
+                "metadata": {**document.metadata, "sources": sources}}))
+        return documents_with_sources
+
+    def _record_latency(self, seconds):
+        self.latencies.append(seconds)
+        self.metrics.observe("retrieval_query", seconds)
+
+    async def search_batch(self, queries, k: int = 4, filter=None):
+        """
+        A method that answers many queries at once: cached results are
+        returned directly, the other queries are embedded together and
+        searched concurrently. Returns one list of documents per query.
+        """
+        start_time = time.perf_counter()
+        queries = [normalize_query(query) for query in queries]
+        version = await asyncio.to_thread(self._get_collection_version)
+        result_keys = [(version, query, k, repr(filter)) for query in queries]
+        results = [self.result_cache.get(key) for key in result_keys]
+
+        pending = [position for position, result in enumerate(results)
+                   if result is None]
+        if pending:
+            embeddings = await self._embed_queries(
+                [queries[position] for position in pending])
+            semaphore = asyncio.Semaphore(self.max_concurrent_searches)
+
+            async def _search(embedding):
+                async with semaphore:
+                    return await asyncio.to_thread(
+                        self.vectorstore.similarity_search_by_vector,
+                        embedding, k=k, filter=filter)
+
+            searched = await asyncio.gather(*[
+                _search(embedding) for embedding in embeddings])
+            if self.chunk_registry is not None:
+                searched = await asyncio.to_thread(
+                    lambda: [self._add_sources(documents)
+                             for documents in searched])
+            for position, documents in zip(pending, searched):
+                results[position] = documents
+                self.result_cache.put(result_keys[position], documents)
+
+        # every query of the batch waited for the whole batch
+        elapsed_seconds = time.perf_counter() - start_time
+        for _ in queries:
+            self._record_latency(elapsed_seconds)
+        return results
+
+    async def search(self, query: str, k: int = 4, filter=None):
+        return (await self.search_batch([query], k=k, filter=filter))[0]
+
+    def get_latency_report(self):
+        latencies = sorted(self.latencies)
+        return {
+            "queries": len(latencies),
+            "p50_ms": round(_percentile(latencies, 50) * 1000, 2)
+            if latencies else None,
+            "p99_ms": round(_percentile(latencies, 99) * 1000, 2)
+            if latencies else None,
+            "query_embedding_cache": self.query_embedding_cache
+            .get_statistics(),
+            "result_cache": self.result_cache.get_statistics(),
+        }
+
+
+_retrieval_services = {}
+
+
+def get_retrieval_service(vectorstore, **service_options):
+    # one service, and so one set of caches, per vector store object
+    entry = _retrieval_services.get(id(vectorstore))
+    if entry is None or entry[0] is not vectorstore:
+        entry = (vectorstore, RetrievalService(vectorstore,
+                                               **service_options))
+        _retrieval_services[id(vectorstore)] = entry
+    return entry[1]
+
+
+def notify_collection_changed(vectorstore):
+    entry = _retrieval_services.get(id(vectorstore))
+    if entry is not None and entry[0] is vectorstore:
+        entry[1].notify_collection_changed()
@@ -1,6 +1,24 @@
 import os
+import csv
+import time
+from concurrent.futures import (
+    ALL_COMPLETED,
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
 from PyPDF2 import PdfReader
-import pandas as pd
+from document_inventory import (
+    get_inventory_key,
+    is_inventory_row_current,
+    load_inventory_cache,
+    save_inventory_cache,
+)
+
+INVENTORY_COLUMNS = ['file_path', 'file_name', 'directory', 'file_type',
+                     'size_bytes', 'modified_time', 'encoding_software',
+                     'number_of_pages', 'encrypted', 'scanned', 'error']
 
 def get_pdf_encoding_software(file_path):
     try:
@@ -29,21 +47,206 @@ def list_files_in_directory(directory):
     return file_info
 
 def save_to_excel(file_info, output_path):
+    import pandas as pd
+
     df = pd.DataFrame(file_info, columns=['File Name', 'Directory', 'File Type', 'Encoding Software'])
     df.to_excel(output_path, index=False)
 
 
-directory_path = '../cellectra_documents/'
-# directory_path = 'documents/cel_docs/second_additions/50/'
+def _is_scanned_page(page):
+    # a page without extractable text that draws an image is a scan
+    if len((page.extract_text() or '').strip()) >= 20:
+        return False
+    try:
+        x_objects = page['/Resources']['/XObject'].get_object()
+        return any(x_objects[name].get_object().get('/Subtype') == '/Image'
+                   for name in x_objects)
+    except (KeyError, TypeError, AttributeError):
+        return False
+
+
+def read_pdf_inventory(file_path, sampled_pages=3):
+    # runs in a pool worker: the metadata, page count and flags of one pdf,
+    # the scanned flag is decided on the first sampled_pages pages
+    row = {'encoding_software': None, 'number_of_pages': None,
+           'encrypted': False, 'scanned': False, 'error': None}
+    try:
+        with open(file_path, 'rb') as file:
+            reader = PdfReader(file)
+            if reader.is_encrypted:
+                row['encrypted'] = True
+                row['encoding_software'] = 'Encrypted'
+                return row
+            info = reader.metadata
+            row['encoding_software'] = info.producer \
+                if info and info.producer else 'Unknown'
+            row['number_of_pages'] = len(reader.pages)
+            pages = [reader.pages[i] for i in range(
+                min(sampled_pages, row['number_of_pages']))]
+            row['scanned'] = bool(pages) and all(
+                _is_scanned_page(page) for page in pages)
+    except Exception as e:
+        row['error'] = str(e)
+    return row
+
+
+def _walk_files(directory):
+    # os.scandir based walk, the stat results come with the directory listing
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk_files(entry.path)
+            elif entry.is_file():
+                yield entry.path, entry.stat()
+
+
+class _InventoryWriter:
+    # streams rows to a csv file, or to a parquet file in batches when the
+    # output ends with .parquet (needs pyarrow)
+    def __init__(self, output_path, batch_size=1000):
+        self.output_path = output_path
+        self.batch_size = batch_size
+        self.rows = []
+        self.parquet_writer = None
+        if output_path.endswith('.parquet'):
+            import pyarrow
+            import pyarrow.parquet
+
+            self.pyarrow = pyarrow
+            self.schema = pyarrow.schema([
+                ('file_path', pyarrow.string()),
+                ('file_name', pyarrow.string()),
+                ('directory', pyarrow.string()),
+                ('file_type', pyarrow.string()),
+                ('size_bytes', pyarrow.int64()),
+                ('modified_time', pyarrow.float64()),
+                ('encoding_software', pyarrow.string()),
+                ('number_of_pages', pyarrow.int64()),
+                ('encrypted', pyarrow.bool_()),
+                ('scanned', pyarrow.bool_()),
+                ('error', pyarrow.string()),
+            ])
+            self.parquet_writer = pyarrow.parquet.ParquetWriter(
+                output_path, self.schema)
+        else:
+            self.csv_file = open(output_path, 'w', newline='')
+            self.csv_writer = csv.DictWriter(self.csv_file,
+                                             fieldnames=INVENTORY_COLUMNS)
+            self.csv_writer.writeheader()
+
+    def write(self, row):
+        if self.parquet_writer is None:
+            self.csv_writer.writerow(row)
+            return
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self._flush_parquet()
+
+    def _flush_parquet(self):
+        if self.rows:
+            self.parquet_writer.write_table(
+                self.pyarrow.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        if self.parquet_writer is None:
+            self.csv_file.close()
+        else:
+            self._flush_parquet()
+            self.parquet_writer.close()
+
+
+def build_inventory(directory_path='../cellectra_documents/',
+                    output_path='document_inventory.csv',
+                    cache_path='inventory_cache.json',
+                    max_workers=None,
+                    use_processes=True):
+    """
+    Writes one row per file of a directory tree (pdf metadata, page count,
+    encrypted / scanned flags) to a csv or parquet file as the rows come in.
+    The pdf files are read by a process (or thread) pool while the tree is
+    walked, with a bounded number of files in flight, and the rows are
+    cached by path + size + mtime so that a re-run only opens the new or
+    changed files.
+
+    Returns the number of files and the number read from the cache.
+    """
+    start_time = time.time()
+    cache = load_inventory_cache(cache_path)
+    new_cache = {}
+    writer = _InventoryWriter(output_path)
+    executor_class = ProcessPoolExecutor if use_processes \
+        else ThreadPoolExecutor
+    max_pending = 4 * (max_workers or os.cpu_count() or 1)
+    number_of_files = 0
+    number_of_cached_files = 0
+
+    def _write_results(futures, return_when):
+        done, _ = wait(futures, return_when=return_when)
+        for future in done:
+            row = futures.pop(future)
+            row.update(future.result())
+            # unreadable files are retried on the next run
+            if row['error'] is None:
+                new_cache[get_inventory_key(row['file_path'])] = row
+            writer.write(row)
+
+    try:
+        with executor_class(max_workers=max_workers) as executor:
+            futures = {}
+            for file_path, stat in _walk_files(directory_path):
+                number_of_files += 1
+                row = {
+                    'file_path': file_path,
+                    'file_name': os.path.basename(file_path),
+                    'directory': os.path.dirname(file_path),
+                    'file_type': os.path.splitext(file_path)[1][1:],
+                    'size_bytes': stat.st_size,
+                    'modified_time': stat.st_mtime,
+                }
+                inventory_key = get_inventory_key(file_path)
+                cached = cache.get(inventory_key)
+                if is_inventory_row_current(cached, stat):
+                    number_of_cached_files += 1
+                    new_cache[inventory_key] = cached
+                    writer.write(cached)
+                elif row['file_type'].lower() == 'pdf':
+                    futures[executor.submit(read_pdf_inventory,
+                                            file_path)] = row
+                    if len(futures) >= max_pending:
+                        _write_results(futures, FIRST_COMPLETED)
+                else:
+                    row.update({'encoding_software': 'not pdf',
+                                'number_of_pages': None, 'encrypted': False,
+                                'scanned': False, 'error': None})
+                    new_cache[inventory_key] = row
+                    writer.write(row)
+            if futures:
+                _write_results(futures, ALL_COMPLETED)
+    finally:
+        writer.close()
+        save_inventory_cache(new_cache, cache_path)
+    print(f"---> inventory of {number_of_files} files "
+          + f"({number_of_cached_files} from the cache) written to "
+          + f"{output_path} in {round(time.time()-start_time, 2)} seconds")
+    return number_of_files, number_of_cached_files
+
+
+def main(directory_path='../cellectra_documents/',
+         output_path='cellectra_document_details.xlsx'):
+    # List all files with their directories and file types
+    all_files_info = list_files_in_directory(directory_path)
 
-output_path = 'cellectra_document_details.xlsx'
+    print("\n\n\nAll Files in Directory:")
+    for i, (file_name, dir_path, file_type, encoding) in enumerate(
+            all_files_info, 1):
+        print(f"{i} : File: {file_name}, Directory: {dir_path}, "
+              f"File Type: {file_type}, Encoding Software: {encoding}\n")
 
-# List all files with their directories and file types
-all_files_info = list_files_in_directory(directory_path)
+    # Save to Excel
+    save_to_excel(all_files_info, output_path)
 
-print("\n\n\nAll Files in Directory:")
-for i, (file_name, dir_path, file_type, encoding) in enumerate(all_files_info, 1):
-    print(f"{i} : File: {file_name}, Directory: {dir_path}, File Type: {file_type}, Encoding Software: {encoding}\n")
 
-# Save to Excel
-save_to_excel(all_files_info, output_path)
\ No newline at end of file
+if __name__ == "__main__":
+    # directory_path = 'documents/cel_docs/second_additions/50/'
+    main()
\ No newline at end of file
@@ -0,0 +1,111 @@
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# A local server that imitates the OpenAI (/embeddings, /v1/embeddings) and
+# Ollama (/api/embeddings) embedding endpoints with deterministic vectors, an
+# artificial latency and an optional 429 every n-th request. Used to exercise
+# embedding_scheduler.AsyncEmbeddingScheduler without a remote provider.
+
+
+def fake_embedding(text: str, dimension: int):
+    seed = int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:16], 16)
+    generator = random.Random(seed)
+    return [generator.uniform(-1, 1) for _ in range(dimension)]
+
+
+def _make_handler(dimension, latency_seconds, rate_limit_every):
+    state = {"requests": 0}
+    lock = threading.Lock()
+
+    class StubEmbeddingHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, body, headers=None):
+            content = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            with lock:
+                state["requests"] += 1
+                request_number = state["requests"]
+            if rate_limit_every and request_number % rate_limit_every == 0:
+                self._send_json(429, {"error": {"message": "rate limited"}},
+                                headers={"Retry-After": "0.1"})
+                return
+            time.sleep(latency_seconds)
+
+            if self.path in ("/embeddings", "/v1/embeddings"):
+                texts = body["input"]
+                if isinstance(texts, str):
+                    texts = [texts]
+                size = body.get("dimensions") or dimension
+                self._send_json(200, {
+                    "object": "list",
+                    "model": body.get("model"),
+                    "data": [
+                        {"object": "embedding", "index": index,
+                         "embedding": fake_embedding(text, size)}
+                        for index, text in enumerate(texts)
+                    ],
+                    "usage": {"prompt_tokens": 0, "total_tokens": 0},
+                })
+            elif self.path == "/api/embeddings":
+                self._send_json(200, {
+                    "embedding": fake_embedding(body["prompt"], dimension)})
+            else:
+                self._send_json(404, {"error": f"unknown path {self.path}"})
+
+    return StubEmbeddingHandler
+
+
+def run_stub_embedding_server(
+    host: str = "127.0.0.1",
+    port: int = 0,
+    dimension: int = 1024,
+    latency_seconds: float = 0.05,
+    rate_limit_every: int = 0,
+):
+    # port 0 picks a free port, read it back from server.server_address
+    server = ThreadingHTTPServer(
+        (host, port),
+        _make_handler(dimension, latency_seconds, rate_limit_every),
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, thread
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Stub OpenAI/Ollama embedding server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--dimension", type=int, default=1024)
+    parser.add_argument("--latency-seconds", type=float, default=0.05)
+    parser.add_argument("--rate-limit-every", type=int, default=0)
+    arguments = parser.parse_args()
+    server, thread = run_stub_embedding_server(
+        host=arguments.host,
+        port=arguments.port,
+        dimension=arguments.dimension,
+        latency_seconds=arguments.latency_seconds,
+        rate_limit_every=arguments.rate_limit_every,
+    )
+    print("---> stub embedding server listening on "
+          + f"http://{arguments.host}:{server.server_address[1]}")
+    thread.join()
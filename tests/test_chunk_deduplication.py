@@ -0,0 +1,92 @@
+import pytest
+from langchain_core.documents import Document
+from chunk_deduplication import (
+    ChunkRegistry,
+    deduplicate_chunks,
+    hash_chunk_text,
+)
+from metrics import PipelineMetrics
+
+LICENSE = "This article is licensed under a Creative Commons license."
+
+
+def _chunk(text, source):
+    return Document(page_content=text, metadata={"source": source})
+
+
+def _run(registry, documents):
+    # one deduplicated run, its assignments stored as after indexing
+    unique_documents, assignments, report = deduplicate_chunks(
+        documents, registry, metrics=PipelineMetrics())
+    registry.store_assignments(
+        assignments, {document.metadata["source"] for document in documents})
+    return unique_documents, report
+
+
+@pytest.fixture
+def registry(tmp_path):
+    registry = ChunkRegistry("qdrant/test",
+                             database_path=str(tmp_path / "registry.sql"))
+    yield registry
+    registry.close()
+
+
+def test_duplicates_within_a_run_are_indexed_once(registry):
+    unique_documents, report = _run(registry, [
+        _chunk(LICENSE, "b.pdf"), _chunk("only in a", "a.pdf"),
+        _chunk("  this ARTICLE is licensed under a creative commons "
+               + "license. ", "a.pdf"),
+    ])
+    assert report["indexed_chunks"] == 2
+    assert report["duplicates_within_run"] == 1
+    # the smallest source is the canonical one
+    assert [document.metadata["source"] for document in unique_documents
+            if document.page_content.startswith("  this")] == ["a.pdf"]
+    assert registry.get_sources(LICENSE) == ["a.pdf", "b.pdf"]
+
+
+def test_text_of_an_earlier_source_is_not_reindexed(registry):
+    _run(registry, [_chunk(LICENSE, "a.pdf"), _chunk(LICENSE, "b.pdf")])
+    unique_documents, report = _run(registry, [_chunk(LICENSE, "b.pdf")])
+    assert unique_documents == []
+    assert report["duplicates_of_namespace"] == 1
+    assert registry.get_sources(LICENSE) == ["a.pdf", "b.pdf"]
+
+
+def test_another_source_takes_over_a_dropped_text(registry):
+    _run(registry, [_chunk(LICENSE, "a.pdf"), _chunk(LICENSE, "b.pdf")])
+    # a.pdf no longer contains the text, b.pdf becomes its canonical source
+    unique_documents, _ = _run(registry, [
+        _chunk("a without the license", "a.pdf"), _chunk(LICENSE, "b.pdf")])
+    assert [(document.page_content, document.metadata["source"])
+            for document in unique_documents
+            if document.page_content == LICENSE] == [(LICENSE, "b.pdf")]
+    assert registry.get_canonical_sources([hash_chunk_text(LICENSE)]) == {
+        hash_chunk_text(LICENSE): "b.pdf"}
+    assert registry.get_sources(LICENSE) == ["b.pdf"]
+
+
+def test_cleared_registry_reindexes_a_partial_run(registry):
+    _run(registry, [_chunk(LICENSE, "a.pdf"), _chunk(LICENSE, "b.pdf")])
+    registry.clear()
+    assert registry.get_sources(LICENSE) == []
+    # after a clear of the collection, only b.pdf's folder is re-indexed
+    unique_documents, report = _run(registry, [_chunk(LICENSE, "b.pdf")])
+    assert report["indexed_chunks"] == 1
+    assert report["duplicates_of_namespace"] == 0
+    assert unique_documents[0].metadata["source"] == "b.pdf"
+
+
+def test_clear_keeps_the_other_namespaces(tmp_path):
+    database_path = str(tmp_path / "registry.sql")
+    first = ChunkRegistry("first", database_path=database_path)
+    second = ChunkRegistry("second", database_path=database_path)
+    try:
+        _run(first, [_chunk(LICENSE, "a.pdf")])
+        _run(second, [_chunk(LICENSE, "a.pdf")])
+        first.clear()
+        assert first.get_sources(LICENSE) == []
+        assert second.get_sources(LICENSE) == ["a.pdf"]
+    finally:
+        first.close()
+        second.close()
@@ -0,0 +1,89 @@
+import os
+import json
+import pytest
+from qdrant_client import QdrantClient, models
+import collection_migration
+from collection_migration import migrate_collection_with_checkpoints
+
+# A migration between two in-memory Qdrant clients, stopped by a failing
+# upsert and run again: the second run resumes from the checkpoint instead
+# of recreating the destination, and both collections end with the same
+# points.
+
+NUMBER_OF_POINTS = 2500
+DIMENSION = 4
+
+
+@pytest.fixture
+def source_client():
+    client = QdrantClient(":memory:")
+    client.create_collection(
+        "documents",
+        vectors_config=models.VectorParams(size=DIMENSION,
+                                           distance=models.Distance.COSINE))
+    client.upsert("documents", points=[
+        models.PointStruct(id=point_id,
+                           vector=[float(point_id % 7 + 1)] * DIMENSION,
+                           payload={"page_content": f"text {point_id}"})
+        for point_id in range(NUMBER_OF_POINTS)
+    ])
+    return client
+
+
+def test_interrupted_migration_resumes(source_client, tmp_path,
+                                       monkeypatch):
+    destination_client = QdrantClient(":memory:")
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+    upsert_page = collection_migration._upsert_page
+    calls = {"count": 0}
+
+    def _failing_upsert_page(*args):
+        calls["count"] += 1
+        if calls["count"] == 10:
+            raise ConnectionError("destination went away")
+        return upsert_page(*args)
+
+    monkeypatch.setattr(collection_migration, "_upsert_page",
+                        _failing_upsert_page)
+    with pytest.raises(ConnectionError):
+        migrate_collection_with_checkpoints(
+            source_client, destination_client, "documents", page_size=100,
+            max_workers=2, checkpoint_path=checkpoint_path)
+    with open(checkpoint_path) as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+    assert 0 < checkpoint["migrated_points"] < NUMBER_OF_POINTS
+    migrated_before = destination_client.count("documents",
+                                               exact=True).count
+    assert migrated_before >= checkpoint["migrated_points"]
+
+    monkeypatch.setattr(collection_migration, "_upsert_page", upsert_page)
+    report = migrate_collection_with_checkpoints(
+        source_client, destination_client, "documents", page_size=100,
+        max_workers=2, checkpoint_path=checkpoint_path)
+
+    assert report["source_count"] == NUMBER_OF_POINTS
+    assert report["destination_count"] == NUMBER_OF_POINTS
+    assert report["migrated_points"] == NUMBER_OF_POINTS
+    assert not os.path.exists(checkpoint_path)
+    points, _ = destination_client.scroll("documents",
+                                          limit=NUMBER_OF_POINTS + 1,
+                                          with_vectors=True)
+    assert sorted(point.id for point in points) == list(
+        range(NUMBER_OF_POINTS))
+    source_points = source_client.retrieve(
+        "documents", [point.id for point in points[:50]], with_vectors=True)
+    source_vectors = {point.id: point.vector for point in source_points}
+    for point in points[:50]:
+        assert point.vector == pytest.approx(source_vectors[point.id])
+
+
+def test_checkpoint_names_the_destination():
+    local_client = QdrantClient(":memory:")
+    remote_client = QdrantClient(url="http://localhost:6333")
+    paths = {
+        collection_migration._get_default_checkpoint_path(
+            client, "documents", destination_collection_name)
+        for client in (local_client, remote_client)
+        for destination_collection_name in ("documents", "documents_v2")
+    }
+    assert len(paths) == 4
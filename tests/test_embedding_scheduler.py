@@ -0,0 +1,54 @@
+import pytest
+from embedding_scheduler import AsyncEmbeddingScheduler, count_tokens
+from stub_embedding_server import fake_embedding, run_stub_embedding_server
+
+# AsyncEmbeddingScheduler against the stub server answering every third
+# request with a 429: each vector must come back at the position of its
+# text, and every 429 must be counted and retried.
+
+DIMENSION = 16
+RATE_LIMIT_EVERY = 3
+
+
+@pytest.fixture
+def base_url():
+    server, thread = run_stub_embedding_server(
+        port=0, dimension=DIMENSION, latency_seconds=0.005,
+        rate_limit_every=RATE_LIMIT_EVERY)
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+@pytest.mark.parametrize("provider", ["openai", "ollama"])
+def test_every_vector_in_order_with_rate_limits(base_url, provider):
+    scheduler = AsyncEmbeddingScheduler(
+        provider=provider, model="stub", base_url=base_url,
+        max_concurrent_requests=4, max_batch_tokens=40, max_retries=20)
+    texts = [f"chunk {i} " + "word " * (i % 13) for i in range(60)]
+
+    vectors = scheduler.embed_documents(texts)
+
+    sent_texts = texts if provider == "openai" else [
+        scheduler.embed_instruction + text for text in texts]
+    assert vectors == [fake_embedding(text, DIMENSION)
+                       for text in sent_texts]
+    statistics = scheduler.statistics
+    # the server counts the requests of the scheduler, 429s included
+    assert statistics["rate_limited"] == \
+        statistics["requests"] // RATE_LIMIT_EVERY
+    assert statistics["rate_limited"] > 0
+    assert statistics["tokens"] == sum(count_tokens(text)
+                                       for text in sent_texts)
+    if provider == "ollama":
+        # one prompt per request
+        assert statistics["requests"] - statistics["rate_limited"] \
+            == len(texts)
+
+
+def test_query_is_embedded_with_its_instruction(base_url):
+    scheduler = AsyncEmbeddingScheduler(provider="ollama", model="stub",
+                                        base_url=base_url)
+    assert scheduler.embed_query("a question") == fake_embedding(
+        scheduler.query_instruction + "a question", DIMENSION)
@@ -0,0 +1,78 @@
+import random
+import string
+import logging
+import pytest
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from text_splitter import FastRecursiveCharacterTextSplitter, get_text_splitter
+
+# FastRecursiveCharacterTextSplitter must return exactly the chunks of
+# RecursiveCharacterTextSplitter. The texts are random mixes of words,
+# separators and runs of separators, with the edge cases of the merge
+# (pieces longer than the chunk, overlap close to the chunk size, empty and
+# whitespace only texts).
+
+SETTINGS = [(500, 50), (1500, 150), (100, 0), (40, 39), (10, 5), (1, 0),
+            (7, 6), (64, 16)]
+NUMBER_OF_TEXTS = 300
+
+
+def _random_text(generator):
+    tokens = ["\n\n", "\n", " ", "  ", "\n \n", "\t", "é", "ﬁ", "-"]
+    pieces = []
+    for _ in range(generator.randint(0, 400)):
+        if generator.random() < 0.35:
+            pieces.append(generator.choice(tokens))
+        else:
+            word_length = generator.choice([1, 2, 5, 12, 60, 250])
+            pieces.append("".join(generator.choice(string.ascii_lowercase)
+                                  for _ in range(word_length)))
+    return "".join(pieces)
+
+
+@pytest.fixture(scope="module")
+def texts():
+    generator = random.Random(20240611)
+    return ["", " ", "\n\n\n", "a" * 3000, "word " * 700] + [
+        _random_text(generator) for _ in range(NUMBER_OF_TEXTS)]
+
+
+@pytest.fixture(autouse=True)
+def no_oversized_chunk_warnings():
+    # both splitters warn about every chunk longer than chunk_size
+    logging.disable(logging.WARNING)
+    yield
+    logging.disable(logging.NOTSET)
+
+
+def _word_count(text):
+    return len(text.split())
+
+
+@pytest.mark.parametrize("chunk_size, chunk_overlap", SETTINGS)
+@pytest.mark.parametrize("length_function", [len, _word_count],
+                         ids=["characters", "words"])
+def test_same_chunks_as_langchain(texts, chunk_size, chunk_overlap,
+                                  length_function):
+    expected_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+        length_function=length_function)
+    splitter = FastRecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+        length_function=length_function)
+    for text in texts:
+        assert splitter.split_text(text) == expected_splitter.split_text(text)
+
+
+@pytest.mark.parametrize("chunk_size, chunk_overlap", [(100, 10), (40, 39)])
+def test_same_chunks_as_langchain_in_tokens(texts, chunk_size,
+                                            chunk_overlap):
+    try:
+        expected_splitter = get_text_splitter(
+            chunk_size, chunk_overlap, engine="langchain",
+            length_unit="tokens")
+    except Exception as ex:
+        pytest.skip(f"the cl100k_base encoding is not available: {ex}")
+    splitter = get_text_splitter(chunk_size, chunk_overlap,
+                                 length_unit="tokens")
+    for text in texts[:100]:
+        assert splitter.split_text(text) == expected_splitter.split_text(text)
@@ -0,0 +1,205 @@
+import logging
+import functools
+from typing import List
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+# A faster engine for the RecursiveCharacterTextSplitter configuration used
+# by the loaders (keep_separator=True, literal separators "\n\n", "\n", " ",
+# ""). The chunks are identical to the langchain splitter, which is checked
+# by benchmark.py compare-text-splitters. The speed up comes from finding
+# the separators with str.find instead of a regex per recursion level, and
+# from merging over piece offsets instead of piece strings.
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SEPARATORS = ("\n\n", "\n", " ", "")
+
+
+@functools.lru_cache(maxsize=None)
+def get_token_counter(encoding_name: str = "cl100k_base",
+                      max_cached_pieces: int = 65536):
+    """
+    A method that returns a token counting length function for the token
+    mode. The tokenizer is built once per encoding and the counts of the
+    pieces are cached, the same words and lines are measured over and over
+    while merging.
+    """
+    import tiktoken
+
+    encoding = tiktoken.get_encoding(encoding_name)
+
+    @functools.lru_cache(maxsize=max_cached_pieces)
+    def count_tokens(text: str) -> int:
+        return len(encoding.encode(text, disallowed_special=()))
+
+    return count_tokens
+
+
+def _find_piece_starts(text: str, start: int, end: int, separator: str):
+    # the start offsets of the pieces of text[start:end] split before every
+    # occurrence of the separator, the same non overlapping left to right
+    # matches as re.split; an empty first piece is dropped
+    if not separator:
+        return list(range(start, end))
+    piece_starts = [start]
+    separator_length = len(separator)
+    position = text.find(separator, start, end)
+    while position != -1:
+        if position == start:
+            piece_starts[0] = position
+        else:
+            piece_starts.append(position)
+        position = text.find(separator, position + separator_length, end)
+    return piece_starts
+
+
+class FastRecursiveCharacterTextSplitter(RecursiveCharacterTextSplitter):
+    """
+    A drop-in RecursiveCharacterTextSplitter producing the same chunks, for
+    literal (non regex) separators kept at the start of the pieces.
+
+    With the separators kept, the pieces of a text are contiguous slices of
+    it, so the splitter works on offsets: the separator positions of a span
+    are found in one str.find pass, the recursion and the merge window move
+    over integer boundaries, and every chunk is sliced out of the page once
+    instead of being joined from piece strings.
+
+    Parameters
+    ==========
+    chunk_size: int
+        The maximum chunk length, in characters or in tokens
+    chunk_overlap: int
+        The overlap between consecutive chunks
+    separators: list
+        The separators tried in order, the default is the langchain one
+    length_function: callable
+        Measures a piece of text, len unless the token mode is used
+    """
+
+    def __init__(self, separators=None, **kwargs):
+        if kwargs.get("keep_separator") is False or kwargs.get(
+                "is_separator_regex"):
+            raise ValueError(
+                "FastRecursiveCharacterTextSplitter only supports literal "
+                + "separators kept in the chunks")
+        super().__init__(separators=list(separators or DEFAULT_SEPARATORS),
+                         **kwargs)
+
+    @classmethod
+    def from_token_counter(cls, encoding_name: str = "cl100k_base",
+                           **kwargs):
+        # chunk_size and chunk_overlap are then counted in tokens
+        return cls(length_function=get_token_counter(encoding_name), **kwargs)
+
+    def split_text(self, text: str) -> List[str]:
+        chunks = []
+        self._split_span(text, 0, len(text), self._separators, chunks)
+        return chunks
+
+    def _split_span(self, text, start, end, separators, chunks):
+        separator = separators[-1]
+        new_separators = []
+        for i, candidate in enumerate(separators):
+            if candidate == "":
+                separator = candidate
+                break
+            if text.find(candidate, start, end) != -1:
+                separator = candidate
+                new_separators = separators[i + 1:]
+                break
+
+        piece_starts = _find_piece_starts(text, start, end, separator)
+        piece_ends = piece_starts[1:] + [end]
+        if self._length_function is len:
+            piece_lengths = [piece_end - piece_start for piece_start, piece_end
+                             in zip(piece_starts, piece_ends)]
+        else:
+            length_function = self._length_function
+            piece_lengths = [length_function(text[piece_start:piece_end])
+                             for piece_start, piece_end
+                             in zip(piece_starts, piece_ends)]
+
+        chunk_size = self._chunk_size
+        run_start = None
+        for piece in range(len(piece_starts)):
+            if piece_lengths[piece] < chunk_size:
+                if run_start is None:
+                    run_start = piece
+                continue
+            if run_start is not None:
+                self._merge_run(text, piece_starts, piece_ends, piece_lengths,
+                                run_start, piece, chunks)
+                run_start = None
+            if not new_separators:
+                chunks.append(text[piece_starts[piece]:piece_ends[piece]])
+            else:
+                self._split_span(text, piece_starts[piece], piece_ends[piece],
+                                 new_separators, chunks)
+        if run_start is not None:
+            self._merge_run(text, piece_starts, piece_ends, piece_lengths,
+                            run_start, len(piece_starts), chunks)
+
+    def _merge_run(self, text, piece_starts, piece_ends, piece_lengths,
+                   first_piece, end_piece, chunks):
+        # the langchain merge loop over the pieces [first_piece, end_piece),
+        # the merge window is the pieces [window_start, window_end) and the
+        # kept separators make the joining separator empty
+        chunk_size = self._chunk_size
+        chunk_overlap = self._chunk_overlap
+        strip_whitespace = self._strip_whitespace
+        window_start = first_piece
+        total = 0
+        for piece in range(first_piece, end_piece):
+            piece_length = piece_lengths[piece]
+            if total + piece_length > chunk_size:
+                if total > chunk_size:
+                    logger.warning(
+                        f"Created a chunk of size {total}, "
+                        f"which is longer than the specified {chunk_size}")
+                if window_start < piece:
+                    chunk = text[piece_starts[window_start]:
+                                 piece_ends[piece - 1]]
+                    if strip_whitespace:
+                        chunk = chunk.strip()
+                    if chunk:
+                        chunks.append(chunk)
+                    while total > chunk_overlap or (
+                        total + piece_length > chunk_size and total > 0
+                    ):
+                        total -= piece_lengths[window_start]
+                        window_start += 1
+            total += piece_length
+        if window_start < end_piece:
+            chunk = text[piece_starts[window_start]:piece_ends[end_piece - 1]]
+            if strip_whitespace:
+                chunk = chunk.strip()
+            if chunk:
+                chunks.append(chunk)
+
+
+@functools.lru_cache(maxsize=32)
+def get_text_splitter(chunk_size: int = 1500, chunk_overlap: int = 150,
+                      engine: str = "fast", length_unit: str = "characters"):
+    """
+    A method that returns a shared text splitter for the given settings,
+    instead of building one on every load call. Splitters keep no state
+    between calls, so sharing them is safe.
+
+    Parameters
+    ==========
+    engine: string
+        "fast" for FastRecursiveCharacterTextSplitter, "langchain" for
+        RecursiveCharacterTextSplitter
+    length_unit: string
+        "characters" or "tokens" (cl100k_base, the text-embedding-3
+        tokenizer)
+    """
+    length_function = (get_token_counter() if length_unit == "tokens"
+                       else len)
+    splitter_class = (RecursiveCharacterTextSplitter if engine == "langchain"
+                      else FastRecursiveCharacterTextSplitter)
+    return splitter_class(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=length_function,
+    )
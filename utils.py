@@ -1,19 +1,34 @@
 import os
+import re
 import csv
+import zlib
 import json
+import time
+import hashlib
+import queue
 import shutil
 import asyncio
-from qdrant_client import QdrantClient
+import threading
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from langchain_community.document_loaders.csv_loader import CSVLoader
 from langchain_community.document_loaders import (
     PyPDFLoader,
     TextLoader,
     WebBaseLoader,
     PyPDFDirectoryLoader,
-    UnstructuredMarkdownLoader,
 )
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from text_splitter import get_text_splitter
+import numpy as np
 from PyPDF2 import PdfReader
+from parse_manifest import ParseManifest, compute_file_hash
+from pdf_streaming import stream_pdf_chunks
+from document_inventory import (
+    get_inventory_key,
+    is_inventory_row_current,
+    load_inventory_cache,
+)
+from metrics import pipeline_metrics, record_file_reports
 
 from dotenv import load_dotenv
 
@@ -28,6 +43,9 @@ async def load_document_data_from_file(
     chunk_size: int = 1500,
     chunk_overlap: int = 150,
     print_information_of_only_unread_documents: bool = False,
+    parallel: bool = False,
+    max_workers: int = None,
+    use_parse_manifest: bool = False,
 ):
     """
     A method that loads data from several data type of documents
@@ -38,6 +56,14 @@ async def load_document_data_from_file(
         The data type of the document
     file_name: string
         The name of the document
+    parallel: bool
+        Load and split the pdf files of a directory (multi_pdf) in a
+        process pool instead of one after the other
+    max_workers: int
+        The number of worker processes, defaults to the number of cores
+    use_parse_manifest: bool
+        Only parse the new or modified pdf files of a directory (multi_pdf)
+        and replay the cached chunks of the unchanged ones
 
     Returns
     =======
@@ -46,16 +72,43 @@ async def load_document_data_from_file(
     """
     # step 1 - determine file type
     try:
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-            length_function=len,
-        )
+        text_splitter = get_configured_text_splitter(
+            chunk_size, chunk_overlap)
         if document_type == "pdf":
-            if multi_pdf:
+            if multi_pdf and use_parse_manifest:
+                print(f"---> directory_path: {path}")
+                pages, file_reports = await load_and_split_pdf_directory_incrementally(  # noqa E501
+                    path=path,
+                    chunk_size=chunk_size,
+                    chunk_overlap=chunk_overlap,
+                    parallel=parallel,
+                    max_workers=max_workers,
+                )
+                print_file_reports(file_reports)
+                record_file_reports(file_reports)
+                print(f"---> length of pages: {len(pages)}\n\n")
+                return pages
+            elif multi_pdf and parallel:
+                print(f"---> directory_path: {path}")
+                pages, file_reports = await load_and_split_pdf_directory_in_parallel(  # noqa E501
+                    path=path,
+                    chunk_size=chunk_size,
+                    chunk_overlap=chunk_overlap,
+                    max_workers=max_workers,
+                )
+                print_file_reports(file_reports)
+                record_file_reports(file_reports)
+                print(f"---> length of pages: {len(pages)}\n\n")
+                return pages
+            elif multi_pdf:
                 print(f"---> directory_path: {path}")
                 loader = PyPDFDirectoryLoader(path=path)
-                pages = loader.load_and_split(text_splitter=text_splitter)
+                loaded_pages, pages, stage_seconds = _load_and_split_timed(
+                    loader, text_splitter)
+                pipeline_metrics.observe("pdf_parse", stage_seconds["parse"])
+                pipeline_metrics.observe("pdf_split", stage_seconds["split"])
+                pipeline_metrics.increment("pages", len(loaded_pages))
+                pipeline_metrics.increment("chunks", len(pages))
                 print(f"---> type of loader: {type(loader)}")
                 print(f"---> length of pages: {len(pages)}")
                 print(f"---> type of a single page: {type(pages[0])}")
@@ -92,6 +145,652 @@ async def load_document_data_from_file(
         return error_message
 
 
+def get_text_splitter_length_unit():
+    length_unit = get_config_variable(
+        parameter_name="text_splitter_length_unit")
+    return "tokens" if length_unit == "tokens" else "characters"
+
+
+def get_configured_text_splitter(chunk_size: int, chunk_overlap: int):
+    # the splitter engine and length unit come from config.json, the
+    # splitter instances are shared between calls
+    engine = get_config_variable(parameter_name="text_splitter_engine")
+    return get_text_splitter(
+        chunk_size,
+        chunk_overlap,
+        engine="langchain" if engine == "langchain" else "fast",
+        length_unit=get_text_splitter_length_unit(),
+    )
+
+
+def list_pdf_files(path):
+    # same selection as PyPDFDirectoryLoader (visible *.pdf files, searched
+    # recursively), but sorted so that the output order is deterministic
+    directory = Path(path)
+    return [
+        str(file_path)
+        for file_path in sorted(directory.glob("**/[!.]*.pdf"))
+        if file_path.is_file()
+        and not any(
+            part.startswith(".")
+            for part in file_path.relative_to(directory).parts
+        )
+    ]
+
+
+def _load_and_split_timed(loader, text_splitter):
+    # the parse and split seconds are returned separately, for the
+    # <type>_parse and <type>_split stages
+    start_time = time.perf_counter()
+    loaded_documents = loader.load()
+    parse_seconds = time.perf_counter() - start_time
+    chunks = text_splitter.split_documents(loaded_documents)
+    stage_seconds = {"parse": parse_seconds,
+                     "split": time.perf_counter() - start_time
+                     - parse_seconds}
+    return loaded_documents, chunks, stage_seconds
+
+
+def _load_and_split_single_pdf(file_path, chunk_size, chunk_overlap):
+    # runs inside a worker process, so a failure only affects this file
+    start_time = time.time()
+    try:
+        text_splitter = get_configured_text_splitter(
+            chunk_size, chunk_overlap)
+        loader = PyPDFLoader(file_path=file_path)
+        loaded_pages, pages, stage_seconds = _load_and_split_timed(
+            loader, text_splitter)
+        return (file_path, pages, len(loaded_pages),
+                round(time.time() - start_time, 2), None, stage_seconds)
+    except Exception as ex:
+        return (file_path, [], 0, round(time.time() - start_time, 2),
+                str(ex), {})
+
+
+def order_files_for_scheduling(file_paths, inventory_cache_path=None):
+    # longest files first, so that a large file submitted last does not
+    # leave the other workers idle at the end. The length is a number of
+    # pages: the page count of the document inventory (runner.build_inventory)
+    # while the size and mtime of the file match its row, otherwise the size
+    # divided by the average bytes per page of the inventory
+    inventory = load_inventory_cache(inventory_cache_path) \
+        if inventory_cache_path else {}
+    paged_rows = [row for row in inventory.values()
+                  if row.get("number_of_pages") and row.get("size_bytes")]
+    bytes_per_page = sum(row["size_bytes"] for row in paged_rows) / sum(
+        row["number_of_pages"] for row in paged_rows) if paged_rows \
+        else 100_000
+
+    def _number_of_pages(file_path):
+        stat = os.stat(file_path)
+        row = inventory.get(get_inventory_key(file_path))
+        if is_inventory_row_current(row, stat) \
+                and row.get("number_of_pages"):
+            return row["number_of_pages"]
+        return stat.st_size / bytes_per_page
+
+    return sorted(file_paths, key=_number_of_pages, reverse=True)
+
+
+async def _load_and_split_pdf_files_in_process_pool(
+    file_paths, chunk_size, chunk_overlap, max_workers
+):
+    # the results keep the order of file_paths
+    if not file_paths:
+        return []
+    inventory_cache_path = get_config_variable(
+        parameter_name="document_inventory_cache_path")
+    scheduled_file_paths = order_files_for_scheduling(
+        file_paths,
+        inventory_cache_path if isinstance(inventory_cache_path, str)
+        else None,
+    )
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = await asyncio.gather(
+            *[
+                loop.run_in_executor(
+                    executor,
+                    _load_and_split_single_pdf,
+                    file_path,
+                    chunk_size,
+                    chunk_overlap,
+                )
+                for file_path in scheduled_file_paths
+            ]
+        )
+    results_by_file = {result[0]: result for result in results}
+    return [results_by_file[file_path] for file_path in file_paths]
+
+
+async def load_and_split_pdf_directory_in_parallel(
+    path: str,
+    chunk_size: int = 1500,
+    chunk_overlap: int = 150,
+    max_workers: int = None,
+):
+    """
+    A method that loads and splits every pdf file of a directory using a
+    process pool, one file per task
+
+    Parameters
+    ==========
+    path: string
+        The directory holding the pdf files
+    max_workers: int
+        The number of worker processes, defaults to the number of cores
+
+    Returns
+    =======
+    pages, file_reports: list of langchain documents, list of dictionaries
+        The split documents in file name order and a report per file with
+        its number of chunks, elapsed time and error (if any)
+    """
+    file_paths = list_pdf_files(path)
+    results = await _load_and_split_pdf_files_in_process_pool(
+        file_paths, chunk_size, chunk_overlap, max_workers)
+
+    pages = []
+    file_reports = []
+    for (file_path, file_pages, number_of_pages, elapsed_seconds, error,
+         stage_seconds) in results:
+        pages.extend(file_pages)
+        file_reports.append(
+            {
+                "file_path": file_path,
+                "number_of_pages": number_of_pages,
+                "number_of_chunks": len(file_pages),
+                "elapsed_seconds": elapsed_seconds,
+                "stage_seconds": stage_seconds,
+                "error": error,
+            }
+        )
+    return pages, file_reports
+
+
+async def load_and_split_pdf_directory_incrementally(
+    path: str,
+    chunk_size: int = 1500,
+    chunk_overlap: int = 150,
+    parallel: bool = False,
+    max_workers: int = None,
+    manifest_path: str = "parse_manifest.json",
+    chunk_cache_directory: str = "parse_cache",
+):
+    # replays the cached chunks of unchanged files and only parses the new or
+    # modified ones, the output keeps the file name order of list_pdf_files
+    manifest = ParseManifest(
+        manifest_path=manifest_path,
+        chunk_cache_directory=chunk_cache_directory,
+    )
+    file_paths = list_pdf_files(path)
+    length_unit = get_text_splitter_length_unit()
+    chunks_by_file = {}
+    file_reports_by_file = {}
+    for file_path in file_paths:
+        cached_chunks = manifest.get_cached_chunks(
+            file_path, chunk_size, chunk_overlap, length_unit=length_unit)
+        if cached_chunks is not None:
+            chunks_by_file[file_path] = cached_chunks
+            file_reports_by_file[file_path] = {
+                "file_path": file_path,
+                "number_of_pages": len({
+                    chunk.metadata.get("page") for chunk in cached_chunks}),
+                "number_of_chunks": len(cached_chunks),
+                "elapsed_seconds": 0.0,
+                "error": None,
+                "cached": True,
+            }
+
+    files_to_parse = [
+        file_path for file_path in file_paths
+        if file_path not in chunks_by_file
+    ]
+    print(
+        f"---> unchanged files: {len(chunks_by_file)}, "
+        + f"files to parse: {len(files_to_parse)}"
+    )
+    if parallel:
+        parsed_results = await _load_and_split_pdf_files_in_process_pool(
+            files_to_parse, chunk_size, chunk_overlap, max_workers)
+    else:
+        parsed_results = [
+            _load_and_split_single_pdf(file_path, chunk_size, chunk_overlap)
+            for file_path in files_to_parse
+        ]
+
+    for (file_path, pages, number_of_pages, elapsed_seconds, error,
+         stage_seconds) in parsed_results:
+        chunks_by_file[file_path] = pages
+        file_reports_by_file[file_path] = {
+            "file_path": file_path,
+            "number_of_pages": number_of_pages,
+            "number_of_chunks": len(pages),
+            "elapsed_seconds": elapsed_seconds,
+            "stage_seconds": stage_seconds,
+            "error": error,
+            "cached": False,
+        }
+        # failed files are not cached so that they are retried next run
+        if error is None:
+            manifest.store_chunks(file_path, pages, chunk_size, chunk_overlap,
+                                  length_unit=length_unit)
+    manifest.save()
+
+    pages = []
+    for file_path in file_paths:
+        pages.extend(chunks_by_file[file_path])
+    file_reports = [file_reports_by_file[file_path]
+                    for file_path in file_paths]
+    return pages, file_reports
+
+
+def print_file_reports(file_reports):
+    failed_reports = [report for report in file_reports if report["error"]]
+    for report in file_reports:
+        print(
+            f"---> {report['file_path']} : {report['number_of_chunks']} "
+            + f"chunks in {report['elapsed_seconds']} seconds"
+            + (f" (failed: {report['error']})" if report["error"] else "")
+        )
+    print(
+        f"---> files loaded: {len(file_reports) - len(failed_reports)}, "
+        + f"files failed: {len(failed_reports)}"
+    )
+
+
+DOCUMENT_TYPES_BY_EXTENSION = {
+    ".pdf": "pdf",
+    ".md": "md",
+    ".markdown": "md",
+    ".txt": "txt",
+    ".csv": "csv",
+}
+
+# the pdf files are parsed in processes, the text formats are fast enough
+# for threads; None means the number of cores
+DEFAULT_POOL_SIZES = {"pdf": None, "md": 4, "txt": 4, "csv": 2}
+
+
+def scan_directory_by_type(path):
+    """
+    A method that walks a directory tree once with os.scandir and groups
+    the visible files by document type (the extension, case insensitive)
+
+    Returns
+    =======
+    file_paths_by_type, skipped_files: dictionary, list
+        The sorted file paths of every document type and the files with an
+        unsupported extension
+    """
+    file_paths_by_type = {
+        document_type: [] for document_type in DEFAULT_POOL_SIZES}
+    skipped_files = []
+
+    def _scan(directory):
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    _scan(entry.path)
+                elif entry.is_file():
+                    document_type = DOCUMENT_TYPES_BY_EXTENSION.get(
+                        os.path.splitext(entry.name)[1].lower())
+                    if document_type is None:
+                        skipped_files.append(entry.path)
+                    else:
+                        file_paths_by_type[document_type].append(
+                            str(Path(entry.path)))
+
+    _scan(path)
+    for file_paths in file_paths_by_type.values():
+        file_paths.sort()
+    return file_paths_by_type, skipped_files
+
+
+def _load_and_split_single_file(document_type, file_path, chunk_size,
+                                chunk_overlap):
+    # runs inside a pool worker, returns the same tuple as
+    # _load_and_split_single_pdf with a number of pages, rows or 1 file
+    if document_type == "pdf":
+        result = _load_and_split_single_pdf(file_path, chunk_size,
+                                            chunk_overlap)
+    else:
+        start_time = time.time()
+        try:
+            if document_type == "csv":
+                loader = CSVLoader(file_path=file_path)
+            else:
+                # markdown is split as text, like the other text chunks
+                loader = TextLoader(file_path=file_path,
+                                    autodetect_encoding=True)
+            loaded_documents, chunks, stage_seconds = _load_and_split_timed(
+                loader, get_configured_text_splitter(chunk_size,
+                                                     chunk_overlap))
+            result = (file_path, chunks, len(loaded_documents),
+                      round(time.time() - start_time, 2), None, stage_seconds)
+        except Exception as ex:
+            result = (file_path, [], 0, round(time.time() - start_time, 2),
+                      str(ex), {})
+    # one source key for every loader, so index() cleans up per file
+    for chunk in result[1]:
+        chunk.metadata["source"] = file_path
+        chunk.metadata["file_type"] = document_type
+    return result
+
+
+async def load_and_split_directory(
+    path: str,
+    chunk_size: int = 1500,
+    chunk_overlap: int = 150,
+    pool_sizes: dict = None,
+    use_parse_manifest: bool = False,
+    manifest_path: str = "parse_manifest.json",
+    chunk_cache_directory: str = "parse_cache",
+):
+    """
+    A method that loads and splits the pdf, markdown, text and csv files of
+    a directory tree in a single pass. Every document type has its own
+    worker pool, so the text files are not queued behind slow pdf files,
+    and every chunk carries the file path as its `source` metadata
+
+    Parameters
+    ==========
+    pool_sizes: dictionary
+        The number of workers per document type, see DEFAULT_POOL_SIZES
+    use_parse_manifest: bool
+        Replay the cached chunks of the unchanged files
+
+    Returns
+    =======
+    documents, file_reports: list of langchain documents, list of dictionaries
+        The chunks ordered by document type and file name, and a report per
+        file
+    """
+    file_paths_by_type, skipped_files = scan_directory_by_type(path)
+    print(
+        "---> files found: "
+        + ", ".join(f"{document_type}: {len(file_paths)}"
+                    for document_type, file_paths
+                    in file_paths_by_type.items())
+        + f", skipped: {len(skipped_files)}"
+    )
+    pool_sizes = {**DEFAULT_POOL_SIZES, **(pool_sizes or {})}
+    manifest = None
+    length_unit = get_text_splitter_length_unit()
+    if use_parse_manifest:
+        manifest = ParseManifest(manifest_path=manifest_path,
+                                 chunk_cache_directory=chunk_cache_directory)
+
+    results_by_file = {}
+    loop = asyncio.get_running_loop()
+    executors = []
+    pending = []
+    try:
+        for document_type, file_paths in file_paths_by_type.items():
+            files_to_parse = []
+            for file_path in file_paths:
+                cached_chunks = manifest.get_cached_chunks(
+                    file_path, chunk_size, chunk_overlap,
+                    length_unit=length_unit) if manifest else None
+                if cached_chunks is None:
+                    files_to_parse.append(file_path)
+                else:
+                    # the manifest can be shared with the pdf only loader,
+                    # whose chunks lack these keys; the same metadata as a
+                    # fresh parse keeps index() from re-embedding them
+                    for chunk in cached_chunks:
+                        chunk.metadata["source"] = file_path
+                        chunk.metadata["file_type"] = document_type
+                    results_by_file[file_path] = (
+                        file_path, cached_chunks, None, 0.0, None, {}, True)
+            if not files_to_parse:
+                continue
+            if document_type == "pdf":
+                executor = ProcessPoolExecutor(
+                    max_workers=pool_sizes[document_type])
+                inventory_cache_path = get_config_variable(
+                    parameter_name="document_inventory_cache_path")
+                files_to_parse = order_files_for_scheduling(
+                    files_to_parse,
+                    inventory_cache_path
+                    if isinstance(inventory_cache_path, str) else None,
+                )
+            else:
+                executor = ThreadPoolExecutor(
+                    max_workers=pool_sizes[document_type])
+            executors.append(executor)
+            pending.extend(
+                loop.run_in_executor(
+                    executor,
+                    _load_and_split_single_file,
+                    document_type,
+                    file_path,
+                    chunk_size,
+                    chunk_overlap,
+                )
+                for file_path in files_to_parse
+            )
+        for result in await asyncio.gather(*pending):
+            results_by_file[result[0]] = (*result, False)
+    finally:
+        for executor in executors:
+            executor.shutdown()
+
+    documents = []
+    file_reports = []
+    for document_type, file_paths in file_paths_by_type.items():
+        for file_path in file_paths:
+            (_, chunks, number_of_pages, elapsed_seconds, error,
+             stage_seconds, cached) = results_by_file[file_path]
+            if manifest and not cached and error is None:
+                manifest.store_chunks(file_path, chunks, chunk_size,
+                                      chunk_overlap, length_unit=length_unit)
+            documents.extend(chunks)
+            file_reports.append({
+                "file_path": file_path,
+                "document_type": document_type,
+                "number_of_pages": number_of_pages if not cached else len({
+                    chunk.metadata.get("page") for chunk in chunks}),
+                "number_of_chunks": len(chunks),
+                "elapsed_seconds": elapsed_seconds,
+                "stage_seconds": stage_seconds,
+                "error": error,
+                "cached": cached,
+            })
+    if manifest:
+        manifest.save()
+    return documents, file_reports
+
+
+def lazy_load_and_split_documents(
+    path: str, chunk_size: int = 1500, chunk_overlap: int = 150
+):
+    # yields the chunks of the pdf files of a directory one page at a time so
+    # that only the page being split is held in memory
+    if get_config_variable(
+            parameter_name="isolated_pdf_extraction") is True:
+        yield from _stream_isolated_pdf_chunks(path, chunk_size,
+                                               chunk_overlap)
+        return
+    text_splitter = get_configured_text_splitter(chunk_size, chunk_overlap)
+    for file_path in list_pdf_files(path):
+        try:
+            parse_seconds = 0.0
+            split_seconds = 0.0
+            loader = PyPDFLoader(file_path=file_path)
+            pages = loader.lazy_load()
+            while True:
+                # only the parsing and splitting is timed, not the consumer
+                start_time = time.perf_counter()
+                page = next(pages, None)
+                parsed_time = time.perf_counter()
+                parse_seconds += parsed_time - start_time
+                if page is None:
+                    break
+                chunks = text_splitter.split_documents([page])
+                split_seconds += time.perf_counter() - parsed_time
+                pipeline_metrics.increment("pages")
+                pipeline_metrics.increment("chunks", len(chunks))
+                yield from chunks
+            pipeline_metrics.increment("files_parsed")
+            pipeline_metrics.observe("pdf_parse", parse_seconds)
+            pipeline_metrics.observe("pdf_split", split_seconds)
+        except Exception as ex:
+            pipeline_metrics.increment("files_failed")
+            print(f"---> skipping {file_path}, error: {ex}")
+
+
+def _stream_isolated_pdf_chunks(path, chunk_size, chunk_overlap):
+    # every file in a worker process under the configured limits, see
+    # pdf_streaming
+    def _get_limit(parameter_name):
+        value = get_config_variable(parameter_name=parameter_name)
+        return value if isinstance(value, (int, float)) else None
+
+    file_reports = []
+    quarantine_path = get_config_variable(
+        parameter_name="pdf_quarantine_path")
+    for chunk in stream_pdf_chunks(
+        list_pdf_files(path),
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        max_workers=_get_limit("pdf_loader_max_workers"),
+        max_pages=_get_limit("pdf_max_pages_per_file"),
+        max_seconds=_get_limit("pdf_max_seconds_per_file"),
+        max_memory_mb=_get_limit("pdf_max_memory_mb_per_file"),
+        quarantine_path=quarantine_path
+        if isinstance(quarantine_path, str) else None,
+        file_reports=file_reports,
+    ):
+        yield chunk
+    quarantined = sum(1 for report in file_reports
+                      if (report["error"] or "").startswith("quarantined"))
+    pipeline_metrics.increment("files_quarantined", quarantined)
+    # the pages and chunks are counted from the reports
+    record_file_reports(file_reports)
+    print(f"---> files quarantined: {quarantined}")
+
+
+_END_OF_DOCUMENTS = object()
+
+
+def prefetch_documents(document_iterator, max_buffered_documents: int = 1000):
+    """
+    A method that consumes a document iterator in a background thread and
+    hands its documents over through a bounded queue, so that producing the
+    next documents overlaps with consuming the current ones. The producer
+    blocks once max_buffered_documents are waiting (backpressure).
+    """
+    buffer = queue.Queue(maxsize=max_buffered_documents)
+    stop_event = threading.Event()
+
+    def _put(item):
+        while not stop_event.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce():
+        try:
+            for document in document_iterator:
+                if not _put(document):
+                    return
+            _put(_END_OF_DOCUMENTS)
+        except Exception as ex:
+            _put(ex)
+
+    producer = threading.Thread(target=_produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _END_OF_DOCUMENTS:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop_event.set()
+
+
+class _TeedDocuments:
+    # one consumer of tee_documents
+    def __init__(self, max_buffered_documents):
+        self.buffer = queue.Queue(maxsize=max_buffered_documents)
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed.is_set():
+            raise StopIteration
+        item = self.buffer.get()
+        if item is _END_OF_DOCUMENTS:
+            self.close()
+            raise StopIteration
+        if isinstance(item, Exception):
+            self.close()
+            raise item
+        return item
+
+    def close(self):
+        self.closed.set()
+
+    def __del__(self):
+        self.close()
+
+
+def tee_documents(document_iterator, number_of_consumers: int,
+                  max_buffered_documents: int = 1000):
+    """
+    A method that consumes a document iterator once in a background thread
+    and hands every document to number_of_consumers iterators, each with its
+    own bounded queue. The producer runs at the pace of the slowest
+    consumer; a consumer that is closed before the end is skipped, so a
+    failed consumer does not block the others.
+
+    Returns
+    =======
+    consumers: list of iterators
+        One document iterator per consumer, to be consumed concurrently and
+        closed when their consumer stops early
+    """
+    consumers = [_TeedDocuments(max_buffered_documents)
+                 for _ in range(number_of_consumers)]
+
+    def _put(item):
+        open_consumers = 0
+        for consumer in consumers:
+            while not consumer.closed.is_set():
+                try:
+                    consumer.buffer.put(item, timeout=0.1)
+                    open_consumers += 1
+                    break
+                except queue.Full:
+                    continue
+        return open_consumers > 0
+
+    def _produce():
+        try:
+            for document in document_iterator:
+                if not _put(document):
+                    return
+            _put(_END_OF_DOCUMENTS)
+        except Exception as ex:
+            _put(ex)
+
+    # the producer only holds the queues, so unused consumers can be
+    # garbage collected
+    threading.Thread(target=_produce, daemon=True).start()
+    return consumers
+
+
 def get_all_file_names(directory):
     try:
         # Get a list of all files and directories in the specified directory
@@ -173,50 +872,204 @@ def get_all_file_names(directory):
 
 
 # region FIND_DUPLICATE
-# function to determine duplicate pdf content in a folder
-def find_duplicate_pdfs(directory):
+_MINHASH_PRIME = (1 << 31) - 1
+
+
+def _get_minhash_permutations(num_permutations: int):
+    generator = np.random.default_rng(seed=1)
+    a = generator.integers(1, _MINHASH_PRIME, size=num_permutations,
+                           dtype=np.uint64)
+    b = generator.integers(0, _MINHASH_PRIME, size=num_permutations,
+                           dtype=np.uint64)
+    return a[:, None], b[:, None]
+
+
+def normalize_text(text: str):
+    return " ".join(re.sub(r"[^0-9a-z]+", " ", text.lower()).split())
+
+
+def compute_minhash_signature(text: str, num_permutations: int = 128,
+                              shingle_size: int = 5):
+    words = text.split()
+    shingles = {
+        " ".join(words[i:i + shingle_size])
+        for i in range(max(1, len(words) - shingle_size + 1))
+    }
+    shingle_hashes = np.fromiter(
+        (zlib.crc32(shingle.encode("utf-8")) for shingle in shingles),
+        dtype=np.uint64,
+        count=len(shingles),
+    )
+    a, b = _get_minhash_permutations(num_permutations)
+    signature = np.full(num_permutations, _MINHASH_PRIME, dtype=np.uint64)
+    # blocks keep the (permutations x shingles) matrix small for books
+    for start in range(0, len(shingle_hashes), 8192):
+        block = shingle_hashes[start:start + 8192][None, :]
+        signature = np.minimum(
+            signature, ((a * block + b) % _MINHASH_PRIME).min(axis=1))
+    return signature
+
+
+def _fingerprint_pdf(file_path, num_permutations, shingle_size):
+    # runs in a worker process: the bytes are hashed and the text extracted
+    # exactly once per file
+    fingerprint = {
+        "file_path": file_path,
+        "file_size": None,
+        "content_hash": None,
+        "text_hash": None,
+        "signature": None,
+        "error": None,
+    }
+    try:
+        # an unreadable file is reported, it does not stop the pool
+        fingerprint["file_size"] = os.path.getsize(file_path)
+        fingerprint["content_hash"] = compute_file_hash(file_path)
+        with open(file_path, "rb") as pdf_file:
+            reader = PdfReader(pdf_file)
+            text = normalize_text(
+                " ".join(page.extract_text() or "" for page in reader.pages))
+        if text:
+            fingerprint["text_hash"] = hashlib.sha256(
+                text.encode("utf-8")).hexdigest()
+            fingerprint["signature"] = compute_minhash_signature(
+                text, num_permutations, shingle_size)
+    except Exception as ex:
+        fingerprint["error"] = str(ex)
+    return fingerprint
+
+
+# function to determine duplicate and near duplicate pdf content in a folder
+def find_duplicate_pdfs(
+    directory,
+    output_csv: str = "duplicated_files.csv",
+    similarity_threshold: float = 0.9,
+    max_workers: int = None,
+    num_permutations: int = 128,
+    bands: int = 32,
+    shingle_size: int = 5,
+):
+    """
+    A method that finds the duplicated pdf files of a directory. Every file
+    is hashed and its text extracted once (in a process pool); byte identical
+    and text identical files are grouped by hash and near duplicates are
+    found with MinHash signatures over word shingles and LSH banding, so the
+    work grows roughly linearly with the number of files.
+
+    Parameters
+    ==========
+    directory: string
+        The directory holding the pdf files
+    output_csv: string
+        The report, one row per duplicated pair ranked by similarity
+    similarity_threshold: float
+        The minimum estimated Jaccard similarity of near duplicates
+
+    Returns
+    =======
+    duplicates: list of dictionaries
+        The rows written to the report
+    """
     # Check if the provided directory exists
     if not os.path.isdir(directory):
         print(f"The directory '{directory}' does not exist.")
         return
 
-    # Dictionary to store files by their size
-    size_dict = {}
-
-    # List all files in the directory
-    files = os.listdir(directory)
-
-    # Filter PDF files and group them by size
-    for file in files:
-        if file.endswith(".pdf"):
-            file_path = os.path.join(directory, file)
-            file_size = os.path.getsize(file_path)
-
-            if file_size in size_dict:
-                size_dict[file_size].append(file)
-            else:
-                size_dict[file_size] = [file]
+    file_paths = [
+        os.path.join(directory, file)
+        for file in sorted(os.listdir(directory))
+        if file.lower().endswith(".pdf")
+    ]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        fingerprints = list(
+            executor.map(
+                _fingerprint_pdf,
+                file_paths,
+                [num_permutations] * len(file_paths),
+                [shingle_size] * len(file_paths),
+                chunksize=8,
+            )
+        )
 
+    duplicates = {}
+
+    def _add_duplicate(first, second, match_type, similarity):
+        pair = (first["file_path"], second["file_path"])
+        if pair not in duplicates:
+            duplicates[pair] = {
+                "Similarity": round(similarity, 4),
+                "Match Type": match_type,
+                "File Size 1 (bytes)": first["file_size"],
+                "File 1": os.path.basename(first["file_path"]),
+                "File Size 2 (bytes)": second["file_size"],
+                "File 2": os.path.basename(second["file_path"]),
+            }
+
+    # exact duplicates, the first file (in name order) of a group is kept
+    exact_duplicate_positions = set()
+    for hash_key, match_type in (("content_hash", "exact_bytes"),
+                                 ("text_hash", "exact_text")):
+        groups = {}
+        for position, fingerprint in enumerate(fingerprints):
+            if fingerprint[hash_key] is not None:
+                groups.setdefault(fingerprint[hash_key], []).append(
+                    position)
+        for group in groups.values():
+            for duplicate in group[1:]:
+                _add_duplicate(fingerprints[group[0]],
+                               fingerprints[duplicate], match_type, 1.0)
+                exact_duplicate_positions.add(duplicate)
+
+    # near duplicates, only the files sharing an LSH bucket are compared;
+    # an exact duplicate is represented by the kept file of its group, so
+    # the pairs inside a group are not compared again
+    rows_per_band = num_permutations // bands
+    buckets = {}
+    for position, fingerprint in enumerate(fingerprints):
+        signature = fingerprint["signature"]
+        if signature is None or position in exact_duplicate_positions:
+            continue
+        for band in range(bands):
+            band_values = signature[
+                band * rows_per_band:(band + 1) * rows_per_band]
+            buckets.setdefault((band, band_values.tobytes()), []).append(
+                position)
+    candidate_pairs = set()
+    for positions in buckets.values():
+        for i in range(len(positions)):
+            for j in range(i + 1, len(positions)):
+                candidate_pairs.add((positions[i], positions[j]))
+    for i, j in sorted(candidate_pairs):
+        first, second = fingerprints[i], fingerprints[j]
+        similarity = float(
+            np.mean(first["signature"] == second["signature"]))
+        if similarity >= similarity_threshold:
+            _add_duplicate(first, second, "near_duplicate", similarity)
+
+    for fingerprint in fingerprints:
+        if fingerprint["error"]:
+            print(f"Error reading {fingerprint['file_path']}: "
+                  + f"{fingerprint['error']}")
+
+    ranked_duplicates = sorted(
+        duplicates.values(),
+        key=lambda row: (-row["Similarity"], row["File 1"], row["File 2"]),
+    )
     # Open the CSV file for writing
-    with open("duplicated_files.csv", mode="w", newline="") as csv_file:
-        csv_writer = csv.writer(csv_file)
-        csv_writer.writerow(["File Size (bytes)", "File 1", "File 2"])
-
-        # Iterate through size_dict to find files with the same size
-        for file_size, file_list in size_dict.items():
-            if len(file_list) > 1:
-                # Compare the content of PDFs with the same size
-                for i in range(len(file_list)):
-                    for j in range(i + 1, len(file_list)):
-                        file1_path = os.path.join(directory, file_list[i])
-                        file2_path = os.path.join(directory, file_list[j])
-
-                        if are_pdfs_identical(file1_path, file2_path):
-                            # Write the identical files to the CSV file
-                            csv_writer.writerow([file_size, file_list[i], file_list[j]])
-                            print(
-                                f"\nDuplicate found::- {file_list[i]} and {file_list[j]}"
-                            )
+    with open(output_csv, mode="w", newline="") as csv_file:
+        csv_writer = csv.DictWriter(
+            csv_file,
+            fieldnames=["Similarity", "Match Type", "File Size 1 (bytes)",
+                        "File 1", "File Size 2 (bytes)", "File 2"],
+        )
+        csv_writer.writeheader()
+        csv_writer.writerows(ranked_duplicates)
+    for row in ranked_duplicates:
+        print(
+            f"\nDuplicate found::- {row['File 1']} and {row['File 2']} "
+            + f"({row['Match Type']}, similarity {row['Similarity']})"
+        )
+    return ranked_duplicates
 
 
 def are_pdfs_identical(file1_path, file2_path):
@@ -249,7 +1102,9 @@ def are_pdfs_identical(file1_path, file2_path):
 
 
 # region DELETE_DUPLICATES
-def delete_files_from_csv(csv_path, directory):
+def delete_files_from_csv(
+    csv_path, directory, match_types=("exact_bytes", "exact_text")
+):
     # Check if the CSV file exists
     if not os.path.isfile(csv_path):
         print(f"The CSV file '{csv_path}' does not exist.")
@@ -269,6 +1124,10 @@ def delete_files_from_csv(csv_path, directory):
 
         # Iterate through each row in the CSV file
         for row in csv_reader:
+            # near duplicates are only deleted when asked for, reports
+            # without a match type only hold exact duplicates
+            if row.get("Match Type", "exact_text") not in match_types:
+                continue
             file_to_delete = row["File 2"]
             file_path = os.path.join(directory, file_to_delete)
 
@@ -387,28 +1246,88 @@ def gather_file_info(folder_path, output_csv):
 # gather_file_info(folder_path, output_csv)
 
 
+def iterate_collection_pages(
+    client,
+    collection_name: str,
+    page_size: int = 1000,
+    with_payload=True,
+    with_vectors=True,
+    offset=None,
+):
+    """
+    A generator that scrolls through a collection one page at a time,
+    resuming every request from the offset returned by the previous one.
+
+    Parameters
+    ==========
+    page_size: int
+        The number of points fetched per request
+    with_payload: bool or list of strings
+        Whether to include the payloads, or the payload fields to include
+    with_vectors: bool or list of strings
+        Whether to include the vectors, or the named vectors to include
+    offset: point id
+        The point id to start from, e.g. to resume an interrupted scroll
+
+    Yields
+    ======
+    points, next_offset: list of records, point id
+        A page of points and the offset of the next page (None at the end)
+    """
+    while True:
+        points, next_offset = client.scroll(
+            collection_name=collection_name,
+            limit=page_size,
+            offset=offset,
+            with_payload=with_payload,
+            with_vectors=with_vectors,
+        )
+        yield points, next_offset
+        if next_offset is None:
+            break
+        offset = next_offset
+
+
+def _point_to_json(point):
+    return json.dumps(
+        {"id": point.id, "payload": point.payload, "vector": point.vector})
+
+
 # # Function to retrieve all points from the source collection
-def fetch_all_points(client, collection_name):
+def fetch_all_points(
+    client,
+    collection_name,
+    page_size: int = 1000,
+    with_payload=True,
+    with_vectors=True,
+    spill_path: str = None,
+):
+    # returns every point as a list, or, when spill_path is given, writes the
+    # points page by page to a json lines file and returns the number of
+    # points written so that memory use stays constant
     try:
-        points = []
-        limit = 10000  # Number of points to fetch per request
-        offset = None  # Start with no offset
-
-        while True:
-            # Fetch points using the scroll method
-            print(f"Fetching points from a collection named {collection_name} ...")
-            response, offset = client.scroll(
-                collection_name=collection_name,
-                limit=limit,
-                with_payload=True,  # Set to True to include payloads
-                with_vectors=True,  # Set to True to include vectors if needed
-            )
-            # Append the fetched points to the list
-            points.extend(response)
-            # Break if no more points are returned
-            if offset is None:
-                break
-        return points
+        print(f"Fetching points from a collection named {collection_name} ...")
+        pages = iterate_collection_pages(
+            client,
+            collection_name,
+            page_size=page_size,
+            with_payload=with_payload,
+            with_vectors=with_vectors,
+        )
+        if spill_path is None:
+            points = []
+            for page, _ in pages:
+                points.extend(page)
+            return points
+
+        number_of_points = 0
+        with open(spill_path, "w") as spill_file:
+            for page, _ in pages:
+                spill_file.writelines(
+                    _point_to_json(point) + "\n" for point in page)
+                number_of_points += len(page)
+        print(f"---> {number_of_points} points written to {spill_path}")
+        return number_of_points
     except Exception as ex:
         print(
             f"An error occurred while fetching all points from the collection {collection_name}.\nError : {ex}"
@@ -422,8 +1341,14 @@ def migrate_collection(
     source_collection_name: str,
     batch_size: int = 1000,
     recreate_on_collision: bool = True,
+    max_workers: int = 4,
+    checkpoint_path: str = None,
 ):
-    # source : https://stackoverflow.com/questions/77733255/how-to-copy-a-collection-from-one-instance-to-another-instance-with-qdrant
+    # pages are upserted by several workers and the progress is checkpointed,
+    # so a failed migration resumes where it stopped when run again
+    from qdrant_client import QdrantClient
+    from collection_migration import migrate_collection_with_checkpoints
+
     try:
         destination_client = QdrantClient(
             url=destination_url,
@@ -433,10 +1358,13 @@ def migrate_collection(
         source_client = QdrantClient(
             url=source_url, api_key=os.environ["QDRANT_API_KEY"], timeout=600
         )
-        source_client.migrate(
+        return migrate_collection_with_checkpoints(
+            source_client,
             destination_client,
-            [source_collection_name],
-            batch_size=batch_size,
+            source_collection_name,
+            page_size=batch_size,
+            max_workers=max_workers,
+            checkpoint_path=checkpoint_path,
             recreate_on_collision=recreate_on_collision,
         )
     except Exception as ex: